@@ -0,0 +1,477 @@
+from __future__ import annotations
+import asyncio
+import dedupe
+import incremental
+import log_config
+import logging
+import metrics
+import os
+import posixpath
+import preflight
+import remote_dirs
+import remote_script
+import time
+from async_session import AsyncSession
+from disser import Candidate, Disser
+from metrics import FileMetric
+from remote_script import ScriptOutput, ScriptResult
+from server_data import Server
+from source_data import TransferItem
+from typing import Awaitable, Callable, Iterable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from paramiko import SFTPAttributes
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+log: logging.Logger = log_config.get_logger("AsyncDisser")
+files_log: logging.Logger = log_config.get_file_logger()
+
+
+def available() -> bool:
+    return asyncssh is not None
+
+
+class AsyncDisser(Disser):
+    # Same API as Disser, but targets and uploads are coroutines on one event
+    # loop instead of threads, so hundreds of targets only cost a socket each.
+    # max_workers limits targets at once and window limits uploads per host.
+    def __init__(self, max_workers: int = 1):
+        super().__init__(max_workers)
+        # Kept between phases so the script phase reuses the connections
+        self.loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+        self.connections: dict[str, object] = {}
+
+    def run_on_targets(
+        self,
+        phase: str,
+        action: Callable[[Server, list], Awaitable[bool]],
+        items: list,
+        max_failures: int = 0,
+    ) -> dict[str, bool]:
+        results: dict[str, bool] = {}
+        if len(self.targets) == 0:
+            log.warn("No targets for {} phase".format(phase))
+            return results
+
+        results = self.loop.run_until_complete(
+            self.gather_targets(phase, action, items, max_failures)
+        )
+        self.log_summary(phase, results)
+        return results
+
+    async def gather_targets(
+        self,
+        phase: str,
+        action: Callable[[Server, list], Awaitable[bool]],
+        items: list,
+        max_failures: int = 0,
+    ) -> dict[str, bool]:
+        limit: asyncio.Semaphore = asyncio.Semaphore(self.max_workers)
+        log.info(
+            "Starting {} phase on {} targets, {} at a time".format(
+                phase, len(self.targets), min(self.max_workers, len(self.targets))
+            )
+        )
+
+        failures: list[int] = [0]
+
+        async def job(target: Server) -> bool:
+            async with limit:
+                if self.pool.health.is_quarantined(target.name):
+                    log.warn(
+                        "Server ({}) is quarantined, skipped during {} phase".format(
+                            target.name, phase
+                        )
+                    )
+                    return False
+                if 0 < max_failures <= failures[0]:
+                    log.warn(
+                        "Server ({}) skipped during {} phase".format(target.name, phase)
+                    )
+                    return False
+                started: float = time.monotonic()
+                try:
+                    result: bool = await action(target, items)
+                except Exception as e:
+                    # Never let one host take down the rest of the run
+                    log.error(
+                        "Server ({}) failed during {} phase".format(target.name, phase)
+                    )
+                    log.exception(e)
+                    result = False
+                self.metrics.target(target.name).phase(
+                    phase, time.monotonic() - started, result
+                )
+                if not result:
+                    failures[0] += 1
+                    if failures[0] == max_failures:
+                        log.error(
+                            "{} targets failed during {} phase, not starting the rest".format(
+                                failures[0], phase
+                            )
+                        )
+                return result
+
+        done: list[bool] = await asyncio.gather(*(job(t) for t in self.targets))
+        return {target.name: result for target, result in zip(self.targets, done)}
+
+    def probe_targets(
+        self, timeout: float = preflight.PROBE_TIMEOUT
+    ) -> dict[str, bool]:
+        started: float = time.monotonic()
+        results: dict[str, bool] = self.loop.run_until_complete(self.probe_all(timeout))
+        self.metrics.phase("preflight", time.monotonic() - started)
+        self.log_summary("preflight", results)
+        return results
+
+    async def probe_all(self, timeout: float) -> dict[str, bool]:
+        limit: asyncio.Semaphore = asyncio.Semaphore(preflight.PROBE_WORKERS)
+
+        async def probe(target: Server) -> bool:
+            async with limit:
+                try:
+                    # Connecting covers both reaching and logging in
+                    await asyncio.wait_for(self.connect(target), timeout)
+                    return True
+                except Exception as e:
+                    self.pool.health.quarantine(
+                        target, "connect failed, {}".format(str(e) or type(e).__name__)
+                    )
+                    return False
+
+        done: list[bool] = await asyncio.gather(*(probe(t) for t in self.targets))
+        return {target.name: result for target, result in zip(self.targets, done)}
+
+    async def connect(self, server: Server):
+        connection = self.connections.get(server.name)
+        if connection is not None:
+            if not connection.is_closed():
+                return connection
+            log.warn(
+                "Connection to server ({}) was lost. Reconnecting.".format(server.name)
+            )
+
+        options: dict = {"username": server.username}
+        if server.password is not None:
+            options["password"] = server.password
+        if server.identity_file is not None:
+            options["client_keys"] = [server.identity_file]
+        port: int = 22
+        if server.port is not None:
+            port = int(server.port)
+        log.info("Opening connection to server ({})".format(server.name))
+        started: float = time.monotonic()
+        connection = await asyncssh.connect(str(server.hostname), port, **options)
+        self.metrics.target(server.name).connected(time.monotonic() - started)
+        self.connections[server.name] = connection
+        return connection
+
+    def discard(self, server: Server):
+        connection = self.connections.pop(server.name, None)
+        if connection is not None:
+            connection.close()
+
+    def transfer_files(self) -> dict[str, bool]:
+        self.warn_unsupported()
+        started: float = time.monotonic()
+        files = self.schedule_files(self.get_file_plan())
+        results = self.run_on_targets("transfer", self.transfer_to_target_async, files)
+        self.metrics.phase("transfer", time.monotonic() - started)
+        self.log_sync_totals()
+        return results
+
+    def warn_unsupported(self):
+        ignored: list[str] = []
+        if self.tar_mode:
+            ignored.append("tar streams")
+        if self.delta_min_size > 0:
+            ignored.append("delta transfers")
+        if self.compression is not None or any(
+            s.compression is not None for s in self.source_data
+        ):
+            ignored.append("compression")
+        if self.relay_fanout > 0:
+            ignored.append("relays")
+        if self.journal is not None:
+            ignored.append("the transfer journal")
+        if self.dedupe_mode != dedupe.DEDUPE_OFF:
+            ignored.append("remote copies of duplicates")
+        if len(ignored) > 0:
+            log.warn(
+                "The asyncio backend sends plain SFTP, ignoring {}".format(
+                    ", ".join(ignored)
+                )
+            )
+
+    async def transfer_to_target_async(
+        self, server: Server, files: Iterable[TransferItem]
+    ) -> bool:
+        try:
+            session = AsyncSession(
+                server, await self.connect(server), self.window, self.preserve_owner
+            )
+            self.transfer_stats[server.name] = session.stats
+            self.metrics.target(server.name).stats = session.stats
+            await session.open()
+        except (OSError, asyncssh.Error) as e:
+            log.error(
+                "Server ({}) unable to connect or ssh".format(server._to_string())
+            )
+            log.exception(e)
+            self.discard(server)
+            return False
+
+        try:
+            for batch in remote_dirs.batched(files):
+                await self.attempt(
+                    session,
+                    self.create_parents_async(batch, session),
+                    "directories for {} items".format(len(batch)),
+                )
+                for file in batch:
+                    await self.attempt(
+                        session,
+                        self.transfer_item_async(file, session),
+                        "file {}".format(file),
+                    )
+                await self.attempt(
+                    session, session.flush_metadata(), "file modes and times"
+                )
+            await session.wait()
+            await self.attempt(
+                session, session.flush_metadata(True), "file modes and times"
+            )
+            await session.close()
+        except (OSError, asyncssh.Error) as e:
+            log.error("Server ({}) lost its connection".format(server.name))
+            log.exception(e)
+            session.abort()
+            self.discard(server)
+            return False
+
+        if self.sync_mode != incremental.SYNC_OFF:
+            log.info(
+                "Server ({}) incremental sync: {}".format(
+                    server.name, session.stats._to_string()
+                )
+            )
+        return session.success
+
+    async def attempt(self, session: AsyncSession, step: Awaitable, description: str):
+        try:
+            await step
+        except (OSError, asyncssh.Error) as e:
+            if not session.is_alive():
+                # Nothing else can reach this target, give up on it
+                raise
+            log.error("Failed to transfer {}".format(description))
+            log.exception(e)
+            session.success = False
+
+    async def create_parents_async(
+        self, files: list[TransferItem], session: AsyncSession
+    ):
+        for file in files:
+            session.directories.ensure(posixpath.dirname(file.destination))
+        await session.flush_directories()
+
+    async def transfer_item_async(self, file: TransferItem, session: AsyncSession):
+        if file.is_directory:
+            await self.transfer_directory_async(file, session)
+            log.info(
+                "Successfully transferred directory ({}) to ({})".format(
+                    file.source, file.destination
+                )
+            )
+            session.metadata.record(
+                file.destination, self.scanner.stat(file.source), True
+            )
+            return
+
+        remote: SFTPAttributes | None = None
+        if self.sync_mode != incremental.SYNC_OFF:
+            remote = await session.attributes(file.destination)
+        await self.upload_changed(
+            [(file.source, file.destination, self.scanner.stat(file.source), remote)],
+            session,
+        )
+
+    async def transfer_directory_async(self, file: TransferItem, session: AsyncSession):
+        # Same layout as put_r, which copies into destination/<source name>
+        remote_root: str = posixpath.join(
+            file.destination, os.path.basename(file.source)
+        )
+        walk = self.scanner.walk(file.source, file.source_filter)
+        for batch in remote_dirs.batched(walk):
+            remote_paths: list[str] = []
+            for directory in batch:
+                relative: str = os.path.relpath(directory.path, file.source)
+                remote_dir: str = remote_root
+                if relative != ".":
+                    remote_dir = posixpath.join(remote_root, *relative.split(os.sep))
+                remote_paths.append(remote_dir)
+
+            # The listings of a batch share the connection instead of waiting
+            # on each other
+            listings: list[dict[str, SFTPAttributes] | None] = [None] * len(batch)
+            if self.sync_mode != incremental.SYNC_OFF:
+                listings = await asyncio.gather(
+                    *(session.listing(path) for path in remote_paths)
+                )
+            for remote_dir, listing in zip(remote_paths, listings):
+                if listing is None:
+                    session.directories.ensure(remote_dir)
+                else:
+                    session.directories.exists(remote_dir)
+            await session.flush_directories()
+
+            for directory, remote_dir, listing in zip(batch, remote_paths, listings):
+                session.metadata.record(remote_dir, directory.status, True)
+                candidates: list[Candidate] = []
+                for entry in directory.files:
+                    name: str = os.path.basename(entry.path)
+                    candidates.append(
+                        (
+                            entry.path,
+                            posixpath.join(remote_dir, name),
+                            entry.status,
+                            None if listing is None else listing.get(name),
+                        )
+                    )
+                await self.upload_changed(candidates, session)
+            await session.flush_metadata()
+
+    async def upload_changed(self, candidates: list[Candidate], session: AsyncSession):
+        changed: list[Candidate] = candidates
+        if self.sync_mode != incremental.SYNC_OFF:
+            changed, to_hash = self.split_changed(candidates, session)
+            digests = await session.digests([c[1] for c in to_hash])
+            changed += self.match_digests(to_hash, digests, session)
+        for candidate in self.order(changed):
+            await session.upload(
+                "file ({})".format(candidate[1]),
+                lambda c=candidate: self.send_file_async(c, session),
+            )
+
+    async def send_file_async(self, candidate: Candidate, session: AsyncSession):
+        source, destination, local, remote = candidate
+        started: float = time.monotonic()
+        retries: int = await session.put_file(
+            source,
+            destination,
+            self.may_be_link(remote),
+        )
+        session.stats.sent(local.st_size)
+        self.metrics.file(
+            FileMetric(
+                session.server.name,
+                destination,
+                metrics.METHOD_SFTP,
+                local.st_size,
+                time.monotonic() - started,
+                retries,
+            )
+        )
+        files_log.info(
+            "Successfully transferred file (%s) to (%s)", source, destination
+        )
+        # Only complete uploads get their mode and time applied
+        session.metadata.record(destination, local)
+
+    def run_scripts(self) -> dict[str, bool]:
+        started: float = time.monotonic()
+        scripts: list[str] = self.get_script_list()
+        results = self.run_on_targets(
+            "script", self.execute_on_target_async, scripts, self.max_failures
+        )
+        self.metrics.phase("script", time.monotonic() - started)
+        return results
+
+    async def execute_on_target_async(self, server: Server, scripts: list[str]) -> bool:
+        success: bool = True
+        try:
+            connection = await self.connect(server)
+        except (OSError, asyncssh.Error) as e:
+            log.error(
+                "Server ({}) unable to connect or ssh".format(server._to_string())
+            )
+            log.exception(e)
+            self.discard(server)
+            return False
+
+        for index, script in enumerate(scripts):
+            try:
+                result = await self.execute_script_async(script, connection, server)
+                remote_script.log_result(server.name, result)
+                succeeded: bool = result.succeeded()
+            except (OSError, asyncssh.Error) as e:
+                log.error("Failed to execute script {}".format(script))
+                log.exception(e)
+                succeeded = False
+            if not succeeded:
+                success = False
+                # Opt in, later scripts may build on this one or not need it
+                if self.stop_on_script_failure and index + 1 < len(scripts):
+                    log.error(
+                        "Server ({}) skipping {} scripts after ({})".format(
+                            server.name, len(scripts) - index - 1, script
+                        )
+                    )
+                    break
+        return success
+
+    async def execute_script_async(
+        self, script: str, connection, server: Server
+    ) -> ScriptResult:
+        log.info("Running script ({}) on server ({})".format(script, server.name))
+        started: float = time.monotonic()
+        deadline: float | None = remote_script.local_deadline(self.script_timeout)
+        process = await connection.create_process(
+            remote_script.script_command(script, self.script_timeout),
+            errors="replace",
+        )
+        try:
+            process.stdin.write_eof()
+            await asyncio.wait_for(
+                asyncio.gather(
+                    self.log_lines(process.stdout, ScriptOutput(server.name)),
+                    self.log_lines(process.stderr, ScriptOutput(server.name, True)),
+                    process.wait_closed(),
+                ),
+                deadline,
+            )
+        except asyncio.TimeoutError:
+            return ScriptResult(script, None, time.monotonic() - started, True)
+        finally:
+            process.close()
+        status: int | None = process.exit_status
+        return ScriptResult(
+            script,
+            status,
+            time.monotonic() - started,
+            self.script_timeout is not None and status == remote_script.TIMEOUT_STATUS,
+        )
+
+    async def log_lines(self, stream, output: ScriptOutput):
+        async for line in stream:
+            # The stream ends with an empty read rather than a line
+            if len(line) > 0:
+                output.line(line.rstrip("\r\n"))
+
+    async def close_connections(self):
+        for name in list(self.connections.keys()):
+            connection = self.connections.pop(name)
+            connection.close()
+            await connection.wait_closed()
+            log.info("Closed connection to server ({})".format(name))
+
+    def close(self):
+        try:
+            self.loop.run_until_complete(self.close_connections())
+        finally:
+            self.loop.close()
+            super().close()
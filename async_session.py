@@ -0,0 +1,207 @@
+from __future__ import annotations
+import asyncio
+import incremental
+import log_config
+import logging
+import pipeline
+from incremental import TransferStats
+from remote_dirs import RemoteDirectories
+from remote_metadata import Metadata, MetadataBatch
+from server_data import Server
+from typing import Awaitable, Callable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from paramiko import SFTPAttributes
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+log: logging.Logger = log_config.get_logger("AsyncSession")
+
+
+def to_attributes(attrs) -> SFTPAttributes:
+    # Same shape the incremental helpers get from paramiko
+    from paramiko import SFTPAttributes
+
+    result = SFTPAttributes()
+    result.st_size = attrs.size
+    result.st_mtime = attrs.mtime
+    result.st_mode = attrs.permissions
+    result.st_uid = attrs.uid
+    result.st_gid = attrs.gid
+    return result
+
+
+class AsyncSession:
+    # One target on the event loop, the asyncio counterpart of TargetSession.
+    # Uploads are tasks on the one connection, limited per host by window.
+    def __init__(
+        self, server: Server, connection, window: int = 1, preserve_owner: bool = False
+    ) -> None:
+        self.server: Server = server
+        self.connection = connection
+        self.sftp = None
+        self.stats: TransferStats = TransferStats()
+        self.directories: RemoteDirectories = RemoteDirectories()
+        self.metadata: MetadataBatch = MetadataBatch(preserve_owner)
+        self.window: int = max(1, window)
+        self.slots: asyncio.Semaphore = asyncio.Semaphore(self.window)
+        # Like the pipeline workers, each upload in flight gets its own SFTP
+        # channel so a slow request does not hold up the others
+        self.clients: list = []
+        self.idle: asyncio.Queue = asyncio.Queue()
+        self.tasks: set[asyncio.Task] = set()
+        self.success: bool = True
+        # Duplicates are not copied remotely on this backend, the shared
+        # file handling checks for these like on a TargetSession
+        self.dedupe = None
+        self.copies = None
+
+    async def open(self):
+        self.sftp = await self.connection.start_sftp_client()
+
+    def is_alive(self) -> bool:
+        return not self.connection.is_closed()
+
+    async def run(self, command: str, input: str | None = None):
+        return await self.connection.run(command, input=input, check=False)
+
+    async def flush_directories(self):
+        for command in self.directories.commands():
+            result = await self.run(command)
+            if result.exit_status != 0:
+                raise IOError(
+                    "Unable to create remote directories: {}".format(
+                        result.stderr.strip()
+                    )
+                )
+        self.directories.done()
+
+    async def flush_metadata(self, final: bool = False):
+        entries: list[Metadata] = self.metadata.take(final)
+        if len(entries) == 0:
+            return
+        try:
+            result = await self.run("sh -s", self.metadata.script(entries))
+        except BaseException:
+            self.metadata.restore(entries)
+            raise
+        if result.exit_status != 0:
+            raise IOError(
+                "Unable to apply metadata to {} paths: {}".format(
+                    len(entries), result.stderr.strip()
+                )
+            )
+        self.metadata.applied_to(entries)
+
+    async def attributes(self, path: str) -> SFTPAttributes | None:
+        try:
+            return to_attributes(await self.sftp.stat(path))
+        except asyncssh.SFTPError:
+            return None
+
+    async def listing(self, directory: str) -> dict[str, SFTPAttributes] | None:
+        try:
+            names = await self.sftp.readdir(directory)
+        except asyncssh.SFTPError:
+            return None
+        return {
+            name.filename: to_attributes(name.attrs)
+            for name in names
+            if name.filename not in (".", "..")
+        }
+
+    async def digests(self, paths: list[str]) -> dict[str, str]:
+        digests: dict[str, str] = {}
+        if len(paths) == 0:
+            return digests
+        for command in incremental.digest_commands(paths):
+            result = await self.run(command)
+            for line in result.stdout.splitlines():
+                incremental.parse_digest(line, digests)
+        return digests
+
+    async def client(self):
+        if self.idle.empty() and len(self.clients) < self.window:
+            client = await self.connection.start_sftp_client()
+            self.clients.append(client)
+            return client
+        return await self.idle.get()
+
+    async def put_file(
+        self, source: str, destination: str, replace: bool = False
+    ) -> int:
+        client = await self.client()
+        try:
+            if replace:
+                await self.break_link(client, destination)
+            return await self.put_with_retries(client, source, destination)
+        finally:
+            self.idle.put_nowait(client)
+
+    async def break_link(self, client, path: str):
+        # Same as pipeline.break_link, a link is replaced instead of written
+        # through
+        try:
+            await client.remove(path)
+        except (OSError, asyncssh.SFTPError):
+            pass
+
+    async def put_with_retries(self, client, source: str, destination: str) -> int:
+        delay: float = pipeline.RETRY_DELAY
+        for attempt in range(1, pipeline.PUT_TRIES + 1):
+            try:
+                await client.put(source, destination)
+                return attempt - 1
+            except (OSError, asyncssh.SFTPError) as e:
+                if (
+                    attempt == pipeline.PUT_TRIES
+                    or not pipeline.retryable(e)
+                    or not self.is_alive()
+                ):
+                    raise
+                log.warn(
+                    "Upload of ({}) failed, retry {} of {}. {}".format(
+                        destination, attempt, pipeline.PUT_TRIES - 1, e
+                    )
+                )
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    async def upload(self, description: str, job: Callable[[], Awaitable[None]]):
+        # Waits here once window uploads are in flight to this host
+        await self.slots.acquire()
+        task = asyncio.create_task(self._run(description, job))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, description: str, job: Callable[[], Awaitable[None]]):
+        try:
+            await job()
+        except (OSError, asyncssh.Error) as e:
+            log.error("Failed to transfer {}".format(description))
+            log.exception(e)
+            self.success = False
+        finally:
+            self.slots.release()
+
+    async def wait(self):
+        if len(self.tasks) > 0:
+            await asyncio.gather(*self.tasks)
+
+    def abort(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def close(self) -> bool:
+        await self.wait()
+        if self.sftp is not None:
+            self.clients.append(self.sftp)
+            self.sftp = None
+        for client in self.clients:
+            client.exit()
+            await client.wait_closed()
+        self.clients = []
+        return self.success
@@ -0,0 +1,329 @@
+import log_config
+import logging
+import os
+import paramiko
+import posixpath
+import socket
+import subprocess
+import threading
+from paramiko import (
+    SFTPAttributes,
+    SFTPHandle,
+    SFTPServer,
+    SFTPServerInterface,
+    ServerInterface,
+)
+from paramiko.sftp import SFTP_NO_SUCH_FILE, SFTP_OK
+from tar_stream import TAR_EXTRACT_COMMAND
+from typing import Callable
+
+log: logging.Logger = log_config.get_logger("BenchServer")
+
+# Remote paths of the benchmark all start here, each stand-in target keeps
+# them under its own directory so targets do not overwrite each other
+REMOTE_PREFIX: str = "/disser-bench"
+USERNAME: str = "bench"
+PASSWORD: str = "bench"
+RECV_SIZE: int = 32768
+
+
+class StandInTarget:
+    # One fake target: a listening socket on 127.0.0.1 that speaks SSH with
+    # an SFTP subsystem and runs exec requests with the local /bin/sh
+    def __init__(self, name: str, root: str, host_key: paramiko.PKey) -> None:
+        self.name: str = name
+        self.root: str = root
+        self.host_key: paramiko.PKey = host_key
+        self.socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen(64)
+        self.port: int = self.socket.getsockname()[1]
+        self.transports: list[paramiko.Transport] = []
+        self.running: bool = True
+        self.thread: threading.Thread = threading.Thread(
+            target=self.accept, name="bench-" + name, daemon=True
+        )
+        self.thread.start()
+
+    def local_path(self, path: str) -> str:
+        return self.root + posixpath.normpath("/" + path)
+
+    def local_command(self, command: str) -> str:
+        command = command.replace(REMOTE_PREFIX, self.root + REMOTE_PREFIX)
+        # Tar streams hold paths relative to / instead
+        return command.replace(
+            TAR_EXTRACT_COMMAND, TAR_EXTRACT_COMMAND.rstrip("/") + self.root
+        )
+
+    def accept(self):
+        while self.running:
+            try:
+                client, _ = self.socket.accept()
+            except OSError:
+                return
+            # Negotiation blocks, one slow or probing client must not hold up
+            # the others
+            threading.Thread(target=self.serve, args=(client,), daemon=True).start()
+
+    def serve(self, client: socket.socket):
+        transport = paramiko.Transport(client)
+        transport.add_server_key(self.host_key)
+        transport.set_subsystem_handler("sftp", SFTPServer, StandInSFTP, self)
+        self.transports.append(transport)
+        try:
+            transport.start_server(server=StandInSSH(self))
+        except (paramiko.SSHException, EOFError, OSError):
+            # Reachability probes connect and hang up without a banner
+            transport.close()
+
+    def close(self):
+        self.running = False
+        self.socket.close()
+        for transport in self.transports:
+            transport.close()
+
+
+class StandInSSH(ServerInterface):
+    def __init__(self, target: StandInTarget) -> None:
+        self.target: StandInTarget = target
+
+    def get_allowed_auths(self, username: str) -> str:
+        return "password"
+
+    def check_auth_password(self, username: str, password: str) -> int:
+        if username == USERNAME and password == PASSWORD:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind: str, chanid: int) -> int:
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel: paramiko.Channel, command) -> bool:
+        if isinstance(command, bytes):
+            command = command.decode("utf-8")
+        # Scripts read from stdin carry remote paths too, other input is data
+        script_stdin = None
+        if command.strip() == "sh -s":
+            script_stdin = self.target.local_command
+        threading.Thread(
+            target=run_exec,
+            args=(channel, self.target.local_command(command), script_stdin),
+            daemon=True,
+        ).start()
+        return True
+
+
+def run_exec(
+    channel: paramiko.Channel,
+    command: str,
+    script_stdin: Callable[[str], str] | None = None,
+):
+    process = subprocess.Popen(
+        ["/bin/sh", "-c", command],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+    def feed():
+        script: bytearray = bytearray()
+        try:
+            while True:
+                data: bytes = channel.recv(RECV_SIZE)
+                if len(data) == 0:
+                    break
+                if script_stdin is None:
+                    process.stdin.write(data)
+                else:
+                    script.extend(data)
+            if script_stdin is not None:
+                process.stdin.write(
+                    script_stdin(script.decode("utf-8")).encode("utf-8")
+                )
+        except (OSError, EOFError):
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+    def pump(stream, send):
+        try:
+            for data in iter(lambda: stream.read1(RECV_SIZE), b""):
+                send(data)
+        except (OSError, EOFError):
+            pass
+
+    threads: list[threading.Thread] = [
+        threading.Thread(target=feed, daemon=True),
+        threading.Thread(
+            target=pump, args=(process.stdout, channel.sendall), daemon=True
+        ),
+        threading.Thread(
+            target=pump, args=(process.stderr, channel.sendall_stderr), daemon=True
+        ),
+    ]
+    for thread in threads:
+        thread.start()
+    status: int = process.wait()
+    # Output is sent before the exit status so the client sees all of it
+    threads[1].join()
+    threads[2].join()
+    try:
+        channel.send_exit_status(status)
+        channel.shutdown_write()
+        channel.close()
+    except (OSError, EOFError):
+        pass
+
+
+class StandInHandle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr: SFTPAttributes) -> int:
+        try:
+            SFTPServer.set_file_attr(self.filename, attr)
+            return SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+class StandInSFTP(SFTPServerInterface):
+    # Serves the target's directory as if it were /, like a chroot
+    def __init__(self, server, target: StandInTarget, *args, **kwargs) -> None:
+        super().__init__(server, *args, **kwargs)
+        self.target: StandInTarget = target
+
+    def list_folder(self, path: str):
+        local: str = self.target.local_path(path)
+        try:
+            entries: list[SFTPAttributes] = []
+            for name in os.listdir(local):
+                attr = SFTPAttributes.from_stat(os.lstat(os.path.join(local, name)))
+                attr.filename = name
+                entries.append(attr)
+            return entries
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path: str):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self.target.local_path(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path: str):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self.target.local_path(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path: str, flags: int, attr: SFTPAttributes):
+        local: str = self.target.local_path(path)
+        try:
+            mode: int = 0o666
+            if attr is not None and attr._flags & attr.FLAG_PERMISSIONS:
+                mode = attr.st_mode
+            fd: int = os.open(local, flags | getattr(os, "O_BINARY", 0), mode)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_CREAT and attr is not None:
+            attr._flags &= ~attr.FLAG_PERMISSIONS
+            SFTPServer.set_file_attr(local, attr)
+        if flags & os.O_WRONLY:
+            fstr: str = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            fstr = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            fstr = "rb"
+        try:
+            handle_file = os.fdopen(fd, fstr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        handle = StandInHandle(flags)
+        handle.filename = local
+        handle.readfile = handle_file
+        handle.writefile = handle_file
+        return handle
+
+    def remove(self, path: str) -> int:
+        try:
+            os.remove(self.target.local_path(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath: str, newpath: str) -> int:
+        try:
+            os.rename(self.target.local_path(oldpath), self.target.local_path(newpath))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def posix_rename(self, oldpath: str, newpath: str) -> int:
+        return self.rename(oldpath, newpath)
+
+    def mkdir(self, path: str, attr: SFTPAttributes) -> int:
+        local: str = self.target.local_path(path)
+        try:
+            os.mkdir(local)
+            if attr is not None:
+                SFTPServer.set_file_attr(local, attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rmdir(self, path: str) -> int:
+        try:
+            os.rmdir(self.target.local_path(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def chattr(self, path: str, attr: SFTPAttributes) -> int:
+        try:
+            SFTPServer.set_file_attr(self.target.local_path(path), attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def canonicalize(self, path: str) -> str:
+        return posixpath.normpath("/" + path)
+
+    def readlink(self, path: str):
+        return SFTP_NO_SUCH_FILE
+
+
+class StandInFleet:
+    # Several stand-in targets sharing one host key, each on its own port
+    def __init__(self, root: str, count: int) -> None:
+        self.host_key: paramiko.PKey = paramiko.RSAKey.generate(2048)
+        self.targets: list[StandInTarget] = []
+        for index in range(count):
+            name: str = "bench{}".format(index)
+            directory: str = os.path.join(root, name)
+            os.makedirs(directory, exist_ok=True)
+            self.targets.append(StandInTarget(name, directory, self.host_key))
+        log.info("Started {} stand-in targets".format(count))
+
+    def host_keys(self) -> paramiko.HostKeys:
+        keys = paramiko.HostKeys()
+        for target in self.targets:
+            keys.add(
+                "[127.0.0.1]:{}".format(target.port),
+                self.host_key.get_name(),
+                self.host_key,
+            )
+        return keys
+
+    def close(self):
+        for target in self.targets:
+            target.close()
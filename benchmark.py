@@ -0,0 +1,234 @@
+import argparse
+import bench_server
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from bench_server import StandInFleet
+from connection_pool import ConnectionPool
+from disser import Disser
+from metrics import Metrics
+from server_data import Server
+from sftpretty import CnOpts, Connection
+from typing import NamedTuple
+
+
+class Workload(NamedTuple):
+    name: str
+    files: int
+    file_size: int
+    targets: int
+    # Files per source directory
+    per_directory: int = 100
+
+
+WORKLOADS: dict[str, Workload] = {
+    "small": Workload("small", 2000, 4 * 1024, 1),
+    "large": Workload("large", 4, 64 * 1024 * 1024, 1, 1),
+    "targets": Workload("targets", 200, 64 * 1024, 8),
+}
+
+SCRIPT: str = '#!/bin/sh\nfind "$(dirname "$0")/files" -type f | wc -l\n'
+
+
+class BenchPool(ConnectionPool):
+    # The stand-in targets have a host key made for this run, so it is checked
+    # against that instead of ~/.ssh/known_hosts
+    def __init__(self, fleet: StandInFleet, metrics: Metrics) -> None:
+        super().__init__(metrics)
+        self.fleet: StandInFleet = fleet
+
+    def connect(self, server: Server, timeout: float | None = None) -> Connection:
+        cnopts = CnOpts(knownhosts=None)
+        cnopts.hostkeys = self.fleet.host_keys()
+        sftp: Connection = Connection(
+            host=str(server.hostname),
+            username=server.username,
+            password=server.password,
+            port=int(server.port),
+            cnopts=cnopts,
+            timeout=timeout,
+        )
+        sftp.timeout = None
+        return sftp
+
+
+def make_sources(root: str, workload: Workload) -> tuple[str, str]:
+    source: str = os.path.join(root, "files")
+    block: bytes = os.urandom(min(workload.file_size, 1024 * 1024))
+    for index in range(workload.files):
+        directory: str = os.path.join(
+            source, "d{:04d}".format(index // workload.per_directory)
+        )
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "f{:06d}".format(index)), "wb") as output:
+            remaining: int = workload.file_size
+            while remaining > 0:
+                output.write(block[:remaining])
+                remaining -= len(block)
+    script: str = os.path.join(root, "bench.sh")
+    with open(script, "w") as output:
+        output.write(SCRIPT)
+    os.chmod(script, 0o755)
+    return source, script
+
+
+def timed(action) -> tuple[float, dict[str, bool]]:
+    started: float = time.monotonic()
+    results: dict[str, bool] = action()
+    return time.monotonic() - started, results
+
+
+def run_workload(workload: Workload, args: argparse.Namespace) -> dict:
+    root: str = tempfile.mkdtemp(prefix="disser-bench-")
+    fleet: StandInFleet | None = None
+    disser: Disser | None = None
+    try:
+        source, script = make_sources(os.path.join(root, "local"), workload)
+        fleet = StandInFleet(os.path.join(root, "remote"), workload.targets)
+        disser = Disser(args.workers)
+        disser.pool = BenchPool(fleet, disser.metrics)
+        disser.window = max(1, args.window)
+        disser.tar_mode = args.tar_mode
+        disser.schedule = args.schedule
+        disser.add_file_source(source, bench_server.REMOTE_PREFIX)
+        disser.add_script_source(script, bench_server.REMOTE_PREFIX + "/bench.sh")
+        for target in fleet.targets:
+            disser.add_server(
+                Server(
+                    target.name,
+                    hostname="127.0.0.1",
+                    username=bench_server.USERNAME,
+                    password=bench_server.PASSWORD,
+                    port=target.port,
+                )
+            )
+
+        transfer_time, transferred = timed(disser.transfer_files)
+        script_time, scripts = timed(disser.run_scripts)
+        connects: list[float] = [
+            target.connect_seconds / target.connects
+            for target in disser.metrics.targets.values()
+            if target.connects > 0
+        ]
+        files: int = workload.files * workload.targets
+        size: int = workload.files * workload.file_size * workload.targets
+        return {
+            "workload": workload.name,
+            "targets": workload.targets,
+            "files": files,
+            "bytes": size,
+            "transfer_seconds": transfer_time,
+            "script_seconds": script_time,
+            "connect_seconds_max": max(connects) if len(connects) > 0 else 0.0,
+            "connect_seconds_mean": (
+                sum(connects) / len(connects) if len(connects) > 0 else 0.0
+            ),
+            "files_per_second": files / transfer_time if transfer_time > 0 else 0.0,
+            "mb_per_second": (
+                size / transfer_time / 1024 / 1024 if transfer_time > 0 else 0.0
+            ),
+            "transfer_ok": sum(transferred.values()),
+            "script_ok": sum(scripts.values()),
+        }
+    finally:
+        if disser is not None:
+            disser.close()
+        if fleet is not None:
+            fleet.close()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def scaled(workload: Workload, scale: float) -> Workload:
+    return workload._replace(files=max(1, int(workload.files * scale)))
+
+
+def quiet_loggers():
+    # Disser logs every file, which would be most of what gets measured
+    logging.disable(logging.INFO)
+    # The stand-in targets drop their sockets when a workload ends
+    logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+
+def report(result: dict):
+    print(
+        "{workload}: {files} files, {mib:.1f} MiB to {targets} targets, "
+        "transfer {transfer_seconds:.2f}s ({files_per_second:.1f} files/s, "
+        "{mb_per_second:.1f} MiB/s), scripts {script_seconds:.2f}s, "
+        "connect {connect_seconds_mean:.3f}s mean {connect_seconds_max:.3f}s max, "
+        "{transfer_ok}/{targets} transferred, {script_ok}/{targets} scripts ok".format(
+            mib=result["bytes"] / 1024 / 1024, **result
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+        prog="benchmark",
+        description="Measure Disser against local stand-in SFTP targets",
+    )
+    parser.add_argument(
+        "workloads",
+        nargs="*",
+        help="Workloads to run out of {}, all of them when none are given.".format(
+            ", ".join(WORKLOADS.keys())
+        ),
+    )
+    parser.add_argument(
+        "--scale",
+        dest="scale",
+        type=float,
+        default=1.0,
+        help="Multiply the number of files in every workload.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        dest="workers",
+        type=int,
+        default=8,
+        help="Number of targets worked on concurrently.",
+    )
+    parser.add_argument(
+        "--window",
+        dest="window",
+        type=int,
+        default=1,
+        help="Uploads kept in flight per target.",
+    )
+    parser.add_argument(
+        "--tar", dest="tar_mode", action="store_true", help="Send through tar."
+    )
+    parser.add_argument(
+        "--schedule",
+        dest="schedule",
+        action="store_true",
+        help="Send the largest files first.",
+    )
+    parser.add_argument(
+        "--json", dest="json_file", help="Also write the results to this file."
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="verbose",
+        action="store_true",
+        help="Keep the per file logging of Disser.",
+    )
+    args = parser.parse_args()
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error("unknown workload ({})".format(name))
+    if not args.verbose:
+        quiet_loggers()
+
+    results: list[dict] = []
+    for name in args.workloads or list(WORKLOADS.keys()):
+        result: dict = run_workload(scaled(WORKLOADS[name], args.scale), args)
+        report(result)
+        results.append(result)
+    if args.json_file is not None:
+        with open(args.json_file, "w") as output:
+            json.dump(results, output, indent=2)
@@ -0,0 +1,178 @@
+from __future__ import annotations
+import log_config
+import logging
+import os
+import remote_exec
+import shlex
+import zlib
+from typing import NamedTuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from paramiko import Channel, Transport
+    from sftpretty import Connection
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log: logging.Logger = log_config.get_logger("Compression")
+files_log: logging.Logger = log_config.get_file_logger()
+
+NONE = "none"
+GZIP = "gzip"
+ZSTD = "zstd"
+ALGORITHMS: list[str] = [NONE, GZIP, ZSTD]
+LEVELS: dict[str, tuple[int, int, int]] = {
+    # min, max, default
+    GZIP: (1, 9, 6),
+    ZSTD: (1, 22, 3),
+}
+DECOMPRESS_COMMANDS: dict[str, str] = {
+    GZIP: "gzip -dc",
+    ZSTD: "zstd -dcq",
+}
+CHUNK_SIZE: int = 1024 * 1024
+# Below this the extra exec channel costs more than compression saves
+MIN_COMPRESS_SIZE: int = 16384
+
+ALREADY_COMPRESSED_SUFFIXES: set[str] = {
+    ".7z", ".br", ".bz2", ".deb", ".gif", ".gz", ".jar", ".jpeg", ".jpg",
+    ".lz4", ".lzma", ".mkv", ".mov", ".mp3", ".mp4", ".png", ".rar", ".rpm",
+    ".tbz2", ".tgz", ".txz", ".webm", ".webp", ".whl", ".xz", ".zip", ".zst",
+}  # fmt: skip
+ALREADY_COMPRESSED_MAGIC: list[bytes] = [
+    b"\x1f\x8b",  # gzip
+    b"\x28\xb5\x2f\xfd",  # zstd
+    b"\xfd7zXZ\x00",  # xz
+    b"BZh",  # bzip2
+    b"PK\x03\x04",  # zip, jar, docx
+    b"7z\xbc\xaf\x27\x1c",  # 7z
+    b"\x89PNG",  # png
+    b"\xff\xd8\xff",  # jpeg
+]
+
+
+class Compression(NamedTuple):
+    algorithm: str
+    level: int
+
+    def enabled(self) -> bool:
+        return self.algorithm != NONE
+
+    def _to_string(self) -> str:
+        if not self.enabled():
+            return NONE
+        return "{}:{}".format(self.algorithm, self.level)
+
+
+def parse_compression(value) -> Compression | None:
+    if type(value) is not str or len(value) == 0:
+        log.error("Compression ({}) is not a non empty str.".format(value))
+        return None
+    algorithm, _, level_text = value.strip().lower().partition(":")
+    if algorithm not in ALGORITHMS:
+        log.error(
+            "Unknown compression ({}). Choose one of {}.".format(algorithm, ALGORITHMS)
+        )
+        return None
+    if algorithm == NONE:
+        return Compression(NONE, 0)
+
+    low, high, level = LEVELS[algorithm]
+    if len(level_text) > 0:
+        if not level_text.isdigit() or not low <= int(level_text) <= high:
+            log.error(
+                "Compression level ({}) for {} must be between {} and {}.".format(
+                    level_text, algorithm, low, high
+                )
+            )
+            return None
+        level = int(level_text)
+
+    if algorithm == ZSTD and zstandard is None:
+        log.warn("zstandard module is not installed. Using gzip instead of zstd.")
+        return Compression(GZIP, LEVELS[GZIP][2])
+    return Compression(algorithm, level)
+
+
+def is_compressible(path: str, status: os.stat_result) -> bool:
+    if status.st_size < MIN_COMPRESS_SIZE:
+        return False
+    if os.path.splitext(path)[1].lower() in ALREADY_COMPRESSED_SUFFIXES:
+        return False
+    with open(path, "rb") as file:
+        head: bytes = file.read(8)
+    return not any(head.startswith(magic) for magic in ALREADY_COMPRESSED_MAGIC)
+
+
+def compressor(compression: Compression):
+    if compression.algorithm == ZSTD:
+        return zstandard.ZstdCompressor(level=compression.level).compressobj()
+    # wbits 31 writes a gzip header so the remote side can use plain gzip
+    return zlib.compressobj(compression.level, zlib.DEFLATED, 31)
+
+
+def decompress_command(compression: Compression) -> str:
+    return DECOMPRESS_COMMANDS[compression.algorithm]
+
+
+class CompressingWriter:
+    def __init__(self, channel: Channel, compression: Compression) -> None:
+        self.channel: Channel = channel
+        self.compressor = compressor(compression)
+        self.raw_bytes: int = 0
+        self.wire_bytes: int = 0
+
+    def _send(self, data: bytes):
+        if len(data) > 0:
+            self.channel.sendall(data)
+            self.wire_bytes += len(data)
+
+    def write(self, data: bytes) -> int:
+        self.raw_bytes += len(data)
+        self._send(self.compressor.compress(data))
+        return len(data)
+
+    def close(self):
+        self._send(self.compressor.flush())
+
+
+def upload(
+    ssh: Connection | Transport,
+    source: str,
+    destination: str,
+    compression: Compression,
+) -> int:
+    tmp: str = shlex.quote("{}.disser-part".format(destination))
+    command: str = "{} > {} && mv -f {} {} || {{ rm -f {}; exit 1; }}".format(
+        decompress_command(compression), tmp, tmp, shlex.quote(destination), tmp
+    )
+    channel: Channel = remote_exec.open_command(ssh, command)
+    writer = CompressingWriter(channel, compression)
+    try:
+        with open(source, "rb") as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                writer.write(chunk)
+        writer.close()
+    except BaseException:
+        channel.close()
+        raise
+    result = remote_exec.finish_command(channel)
+    if result.exit_status != 0:
+        raise IOError(
+            "Compressed upload of ({}) failed with {}: {}".format(
+                destination,
+                result.exit_status,
+                result.stderr.decode("utf-8", "replace").strip(),
+            )
+        )
+    files_log.info(
+        "Transferred file (%s) to (%s) with %s: %s of %s bytes sent",
+        source,
+        destination,
+        compression._to_string(),
+        writer.wire_bytes,
+        writer.raw_bytes,
+    )
+    return writer.wire_bytes
@@ -0,0 +1,145 @@
+from __future__ import annotations
+import log_config
+import logging
+import threading
+import time
+from metrics import Metrics
+from preflight import HostHealth, HostUnavailable
+from server_data import Server
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from paramiko import Transport
+    from sftpretty import Connection
+
+log: logging.Logger = log_config.get_logger("ConnectionPool")
+
+
+# sftpretty and paramiko are only imported once something connects, these are
+# called in except clauses so they are never evaluated before that
+def connection_errors() -> tuple[type[Exception], ...]:
+    import sftpretty
+
+    return (sftpretty.ConnectionException, HostUnavailable)
+
+
+def auth_errors() -> tuple[type[Exception], ...]:
+    import sftpretty
+
+    return (
+        sftpretty.CredentialException,
+        sftpretty.HostKeysException,
+        sftpretty.SSHException,
+        sftpretty.PasswordRequiredException,
+        sftpretty.LoggingException,
+    )
+
+
+def permanent_errors() -> tuple[type[Exception], ...]:
+    # Credentials and host keys do not fix themselves between connects
+    import paramiko
+    import sftpretty
+
+    return (
+        sftpretty.CredentialException,
+        sftpretty.HostKeysException,
+        sftpretty.PasswordRequiredException,
+        paramiko.AuthenticationException,
+        paramiko.BadHostKeyException,
+    )
+
+
+class ConnectionPool:
+    def __init__(self, metrics: Metrics | None = None) -> None:
+        self.metrics: Metrics | None = metrics
+        # Backoff and quarantine of targets that fail to connect
+        self.health: HostHealth = HostHealth()
+        self.connections: dict[str, Connection] = {}
+        self.transports: dict[str, Transport] = {}
+        self.lock: threading.Lock = threading.Lock()
+        self.server_locks: dict[str, threading.Lock] = {}
+
+    def _server_lock(self, server: Server) -> threading.Lock:
+        with self.lock:
+            if server.name not in self.server_locks:
+                self.server_locks[server.name] = threading.Lock()
+            return self.server_locks[server.name]
+
+    def connect(self, server: Server, timeout: float | None = None) -> Connection:
+        # timeout bounds the SSH negotiation, None waits as long as it takes
+        from sftpretty import Connection
+
+        port: int = 22
+        if server.port is not None:
+            port = int(server.port)
+        log.info("Opening connection to server ({})".format(server.name))
+        sftp: Connection = Connection(
+            host=str(server.hostname),
+            username=server.username,
+            password=server.password,
+            port=port,
+            private_key=server.identity_file,
+            timeout=timeout,
+        )
+        # sftpretty also applies it to every channel, transfers take longer
+        sftp.timeout = None
+        return sftp
+
+    def get(self, server: Server, timeout: float | None = None) -> Connection:
+        with self._server_lock(server):
+            sftp = self.connections.get(server.name)
+            if sftp is not None:
+                if self.is_alive(server):
+                    return sftp
+                log.warn(
+                    "Connection to server ({}) was lost. Reconnecting.".format(
+                        server.name
+                    )
+                )
+                self._close(server.name)
+
+            self.health.check(server)
+            started: float = time.monotonic()
+            try:
+                sftp = self.connect(server, timeout)
+            except permanent_errors() as e:
+                self.health.quarantine(server, "cannot log in: {}".format(e))
+                raise
+            except Exception as e:
+                self.health.failed(server, e)
+                raise
+            self.health.succeeded(server)
+            if self.metrics is not None:
+                self.metrics.target(server.name).connected(time.monotonic() - started)
+            self.connections[server.name] = sftp
+            # Keep a handle on the transport so liveness checks are free
+            self.transports[server.name] = (
+                sftp.sftp_client.get_channel().get_transport()
+            )
+            return sftp
+
+    def is_alive(self, server: Server) -> bool:
+        transport = self.transports.get(server.name)
+        return transport is not None and transport.is_active()
+
+    def discard(self, server: Server):
+        with self._server_lock(server):
+            self._close(server.name)
+
+    def _close(self, name: str):
+        sftp = self.connections.pop(name, None)
+        self.transports.pop(name, None)
+        if sftp is None:
+            return
+        try:
+            sftp.close()
+            log.info("Closed connection to server ({})".format(name))
+        except Exception as e:
+            log.error("Error closing connection to server ({})".format(name))
+            log.exception(e)
+
+    def close_all(self):
+        with self.lock:
+            names: list[str] = list(self.connections.keys())
+        for name in names:
+            self._close(name)
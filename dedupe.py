@@ -0,0 +1,166 @@
+from __future__ import annotations
+import log_config
+import logging
+import os
+import remote_exec
+import shlex
+import threading
+from incremental import TransferStats
+from remote_metadata import MetadataBatch
+from typing import Callable, NamedTuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from paramiko import Transport
+    from sftpretty import Connection
+
+log: logging.Logger = log_config.get_logger("Dedupe")
+
+DEDUPE_OFF = "off"
+# Each way a duplicate is made on the target from the copy that was sent
+DEDUPE_COPY = "copy"
+DEDUPE_HARDLINK = "hardlink"
+DEDUPE_SYMLINK = "symlink"
+DEDUPE_MODES: list[str] = [DEDUPE_OFF, DEDUPE_COPY, DEDUPE_HARDLINK, DEDUPE_SYMLINK]
+
+# Smaller files cost less to send than to hash and copy
+DEDUPE_MIN_SIZE: int = 64 * 1024
+# Copies made per remote script
+COPY_BATCH: int = 1000
+
+# cp without reflink support, busybox for one, falls back to a plain copy.
+# The destination goes first so a link left by an earlier run is replaced
+# instead of written through.
+COPY_COMMANDS: dict[str, str] = {
+    DEDUPE_COPY: "rm -f -- {1} && {{ cp --reflink=auto -p -- {0} {1} 2>/dev/null || cp -p -- {0} {1}; }}",
+    DEDUPE_HARDLINK: "ln -f -- {0} {1}",
+    DEDUPE_SYMLINK: "ln -sfn -- {0} {1}",
+}
+
+
+class Copy(NamedTuple):
+    # Remote path that was sent and the duplicate made from it
+    source: str
+    destination: str
+    local: os.stat_result
+
+
+def copy_script(mode: str, copies: list[Copy]) -> str:
+    lines: list[str] = ["status=0"]
+    for copy in copies:
+        lines.append(
+            COPY_COMMANDS[mode].format(
+                shlex.quote(copy.source), shlex.quote(copy.destination)
+            )
+            + " || status=1"
+        )
+    lines.append("exit $status")
+    return "\n".join(lines) + "\n"
+
+
+class DedupeIndex:
+    # Contents already on one target or on their way there, keyed by size and
+    # then digest. A file is only hashed once another one of its size shows
+    # up, so sources without duplicates read nothing twice.
+    def __init__(
+        self,
+        digest: Callable[[str, os.stat_result], str],
+        min_size: int = DEDUPE_MIN_SIZE,
+    ) -> None:
+        self.digest: Callable[[str, os.stat_result], str] = digest
+        self.min_size: int = min_size
+        self.unhashed: dict[int, tuple[str, str, os.stat_result]] = {}
+        self.hashed: dict[int, dict[str, str]] = {}
+
+    def primary(
+        self, source: str, destination: str, local: os.stat_result
+    ) -> str | None:
+        # The remote path already holding these contents, or None after
+        # taking note of this one
+        size: int = local.st_size
+        if size < self.min_size:
+            return None
+        first = self.unhashed.pop(size, None)
+        if first is None and size not in self.hashed:
+            self.unhashed[size] = (source, destination, local)
+            return None
+        group: dict[str, str] = self.hashed.setdefault(size, {})
+        if first is not None:
+            group.setdefault(self.digest(first[0], first[2]), first[1])
+        digest: str = self.digest(source, local)
+        found: str | None = group.setdefault(digest, destination)
+        if found == destination:
+            return None
+        return found
+
+
+class RemoteCopies:
+    # Duplicates waiting for the copy they are made from to land, made in
+    # bulk with one remote script instead of an upload each
+    def __init__(
+        self, mode: str, metadata: MetadataBatch, stats: TransferStats
+    ) -> None:
+        self.mode: str = mode
+        self.metadata: MetadataBatch = metadata
+        self.stats: TransferStats = stats
+        self.lock: threading.Lock = threading.Lock()
+        self.pending: list[Copy] = []
+        self.ready: set[str] = set()
+        self.made: int = 0
+
+    def add(self, source: str, destination: str, local: os.stat_result):
+        with self.lock:
+            self.pending.append(Copy(source, destination, local))
+
+    def landed(self, path: str):
+        with self.lock:
+            self.ready.add(path)
+
+    def take(self, final: bool = False) -> tuple[list[Copy], list[Copy]]:
+        # Copies that can be made now, and at the end the ones whose source
+        # never made it
+        with self.lock:
+            ready: list[Copy] = [c for c in self.pending if c.source in self.ready]
+            if not final and len(ready) < COPY_BATCH:
+                return [], []
+            lost: list[Copy] = []
+            if final:
+                lost = [c for c in self.pending if c.source not in self.ready]
+                self.pending = []
+            else:
+                self.pending = [c for c in self.pending if c.source not in self.ready]
+        return ready, lost
+
+    def restore(self, copies: list[Copy]):
+        with self.lock:
+            self.pending = copies + self.pending
+
+    def flush(self, ssh: Connection | Transport, final: bool = False):
+        copies, lost = self.take(final)
+        if len(copies) > 0:
+            try:
+                result = remote_exec.run_command(
+                    ssh, "sh -s", copy_script(self.mode, copies).encode("utf-8")
+                )
+            except BaseException:
+                self.restore(copies + lost)
+                raise
+            if result.exit_status != 0:
+                raise IOError(
+                    "Unable to make {} duplicate files: {}".format(
+                        len(copies), result.stderr.decode("utf-8", "replace").strip()
+                    )
+                )
+            self.made += len(copies)
+            for copy in copies:
+                self.stats.copied(copy.local.st_size)
+            log.debug("Made {} duplicate files remotely".format(len(copies)))
+            if self.mode == DEDUPE_COPY:
+                # Links share the attributes of what they point at
+                for copy in copies:
+                    self.metadata.record(copy.destination, copy.local)
+        if len(lost) > 0:
+            raise IOError(
+                "{} duplicate files not made, their source was not sent: {}".format(
+                    len(lost), ", ".join(copy.destination for copy in lost[:10])
+                )
+            )
@@ -0,0 +1,279 @@
+from __future__ import annotations
+import hashlib
+import log_config
+import logging
+import math
+import mmap
+import os
+import remote_exec
+import shlex
+import struct
+from itertools import accumulate
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from paramiko import Channel, Transport
+    from sftpretty import Connection
+
+log: logging.Logger = log_config.get_logger("DeltaTransfer")
+files_log: logging.Logger = log_config.get_file_logger()
+
+MIN_BLOCK_SIZE: int = 2048
+MAX_BLOCK_SIZE: int = 131072
+WEAK_MODULUS: int = 1 << 16
+# Longest literal run sent as one record
+LITERAL_CHUNK: int = 1024 * 1024
+# Give up and send the whole file once this share of it is literal data
+MAX_LITERAL_RATIO: float = 0.5
+
+SIGNATURE_RECORD = struct.Struct(">I16s")
+COPY_RECORD = struct.Struct(">QI")
+LITERAL_HEADER = struct.Struct(">I")
+
+# Both helpers run on the target with python3. They must stay in sync with
+# weak_checksum and the record layout used by build_delta.
+REMOTE_SIGNATURE = """
+import hashlib, struct, sys
+from itertools import accumulate
+path, bs = sys.argv[1], int(sys.argv[2])
+out = sys.stdout.buffer
+with open(path, "rb") as src:
+    for block in iter(lambda: src.read(bs), b""):
+        a = sum(block) % 65536
+        b = sum(accumulate(block)) % 65536
+        out.write(struct.pack(">I16s", (b << 16) | a, hashlib.md5(block).digest()))
+"""
+
+REMOTE_APPLY = """
+import hashlib, os, struct, sys
+dest, tmp, bs, mtime = sys.argv[1], sys.argv[2], int(sys.argv[3]), sys.argv[4]
+inp = sys.stdin.buffer
+def read(n):
+    data = inp.read(n)
+    if len(data) != n:
+        raise ValueError("truncated delta stream")
+    return data
+try:
+    digest = hashlib.sha256()
+    with open(dest, "rb") as src, open(tmp, "wb") as out:
+        while True:
+            op = read(1)
+            if op == b"C":
+                index, count = struct.unpack(">QI", read(12))
+                src.seek(index * bs)
+                data = src.read(count * bs)
+            elif op == b"L":
+                data = read(struct.unpack(">I", read(4))[0])
+            elif op == b"E":
+                expected = read(32).hex()
+                break
+            else:
+                raise ValueError("bad delta record")
+            out.write(data)
+            digest.update(data)
+    if digest.hexdigest() != expected:
+        raise ValueError("reconstructed file does not match source digest")
+    os.chmod(tmp, os.stat(dest).st_mode & 0o7777)
+    if mtime != "-":
+        os.utime(tmp, (int(mtime), int(mtime)))
+    os.replace(tmp, dest)
+except BaseException as e:
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    sys.stderr.write(str(e))
+    sys.exit(2)
+"""
+
+
+class DeltaAborted(Exception):
+    pass
+
+
+def block_size_for(size: int) -> int:
+    # Same rule of thumb as rsync, roughly sqrt(size) rounded to 1K
+    block: int = int(math.sqrt(size)) // 1024 * 1024
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block))
+
+
+def weak_checksum(block) -> tuple[int, int]:
+    return sum(block) % WEAK_MODULUS, sum(accumulate(block)) % WEAK_MODULUS
+
+
+def python_command(script: str, *args: str) -> str:
+    return "python3 -c {} {}".format(
+        shlex.quote(script), " ".join(shlex.quote(a) for a in args)
+    )
+
+
+def remote_signature(
+    ssh: Connection | Transport, destination: str, block_size: int
+) -> list[tuple[int, bytes]]:
+    result = remote_exec.run_command(
+        ssh, python_command(REMOTE_SIGNATURE, destination, str(block_size))
+    )
+    if result.exit_status != 0:
+        raise DeltaAborted(
+            "Unable to read signature of ({}): {}".format(
+                destination, result.stderr.decode("utf-8", "replace").strip()
+            )
+        )
+    return [
+        SIGNATURE_RECORD.unpack_from(result.stdout, offset)
+        for offset in range(0, len(result.stdout), SIGNATURE_RECORD.size)
+    ]
+
+
+class DeltaWriter:
+    def __init__(self, channel: Channel, limit: int) -> None:
+        self.channel: Channel = channel
+        self.limit: int = limit
+        self.literal_bytes: int = 0
+        self.wire_bytes: int = 0
+        self.run_start: int = -1
+        self.run_count: int = 0
+
+    def _send(self, data: bytes):
+        self.channel.sendall(data)
+        self.wire_bytes += len(data)
+
+    def copy(self, index: int):
+        if self.run_count > 0 and self.run_start + self.run_count == index:
+            self.run_count += 1
+            return
+        self.flush_copy()
+        self.run_start = index
+        self.run_count = 1
+
+    def flush_copy(self):
+        if self.run_count > 0:
+            self._send(b"C" + COPY_RECORD.pack(self.run_start, self.run_count))
+            self.run_count = 0
+
+    def literal(self, data):
+        if len(data) == 0:
+            return
+        self.flush_copy()
+        self.literal_bytes += len(data)
+        if self.literal_bytes > self.limit:
+            raise DeltaAborted("Too much of the file has changed")
+        for start in range(0, len(data), LITERAL_CHUNK):
+            chunk = data[start : start + LITERAL_CHUNK]
+            self._send(b"L" + LITERAL_HEADER.pack(len(chunk)) + chunk)
+
+    def end(self, digest: str):
+        self.flush_copy()
+        self._send(b"E" + bytes.fromhex(digest))
+
+
+def build_delta(
+    data, signature: list[tuple[int, bytes]], block_size: int, writer: DeltaWriter
+):
+    table: dict[int, list[int]] = {}
+    for index, (weak, _) in enumerate(signature):
+        table.setdefault(weak, []).append(index)
+
+    size: int = len(data)
+    pos: int = 0
+    literal_start: int = 0
+    a, b = 0, 0
+    # Unmatched bytes still affordable, checked while rolling so a heavily
+    # changed file gives up early instead of after scanning all of it
+    budget: int = writer.limit - writer.literal_bytes
+    if size >= block_size:
+        a, b = weak_checksum(data[0:block_size])
+
+    while pos + block_size <= size:
+        candidates = table.get((b << 16) | a)
+        match: int = -1
+        if candidates is not None:
+            strong = hashlib.md5(data[pos : pos + block_size]).digest()
+            for index in candidates:
+                if signature[index][1] == strong:
+                    match = index
+                    break
+
+        if match >= 0:
+            writer.literal(data[literal_start:pos])
+            writer.copy(match)
+            budget = writer.limit - writer.literal_bytes
+            pos += block_size
+            literal_start = pos
+            if pos + block_size <= size:
+                a, b = weak_checksum(data[pos : pos + block_size])
+            continue
+
+        # Roll the window forward by one byte
+        if pos + block_size < size:
+            out_byte = data[pos]
+            in_byte = data[pos + block_size]
+            a = (a - out_byte + in_byte) % WEAK_MODULUS
+            b = (b - block_size * out_byte + a) % WEAK_MODULUS
+        pos += 1
+        if pos - literal_start > budget:
+            raise DeltaAborted("Too much of the file has changed")
+
+    # The remote's short trailing block can only match the same short tail
+    tail = data[literal_start:size]
+    if (
+        len(signature) > 0
+        and 0 < len(tail) < block_size
+        and hashlib.md5(tail).digest() == signature[-1][1]
+    ):
+        writer.copy(len(signature) - 1)
+    else:
+        writer.literal(tail)
+
+
+def transfer(
+    ssh: Connection | Transport,
+    source: str,
+    destination: str,
+    digest: str,
+    mtime: int | None = None,
+) -> int | None:
+    size: int = os.stat(source).st_size
+    if size == 0:
+        return None
+    block_size: int = block_size_for(size)
+    try:
+        signature = remote_signature(ssh, destination, block_size)
+        tmp: str = "{}.disser-delta".format(destination)
+        channel = remote_exec.open_command(
+            ssh,
+            python_command(
+                REMOTE_APPLY,
+                destination,
+                tmp,
+                str(block_size),
+                "-" if mtime is None else str(mtime),
+            ),
+        )
+        writer = DeltaWriter(channel, int(size * MAX_LITERAL_RATIO))
+        try:
+            with open(source, "rb") as file:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    build_delta(data, signature, block_size, writer)
+            writer.end(digest)
+        except DeltaAborted:
+            channel.close()
+            raise
+        result = remote_exec.finish_command(channel)
+        if result.exit_status != 0:
+            raise DeltaAborted(result.stderr.decode("utf-8", "replace").strip())
+    except DeltaAborted as e:
+        log.warn(
+            "Delta transfer of ({}) not used, falling back to full upload. {}".format(
+                destination, e
+            )
+        )
+        return None
+
+    files_log.info(
+        "Delta transferred (%s) to (%s): %s of %s bytes sent, %s literal",
+        source,
+        destination,
+        writer.wire_bytes,
+        size,
+        writer.literal_bytes,
+    )
+    return writer.wire_bytes
@@ -1,31 +1,131 @@
+from __future__ import annotations
+import compression
+import connection_pool
+import dedupe
+import delta_transfer
+import incremental
+import journal
 import log_config
 import logging
+import metrics
 import os
-from stat import S_IMODE
+import pipeline
+import posixpath
+import preflight
+import relay
+import remote_dirs
+import remote_exec
+import remote_script
+import scheduler
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from stat import S_ISDIR
+from tar_stream import TarStream
+from typing import Callable, Iterable, Iterator, TYPE_CHECKING
+from compression import Compression
+from connection_pool import ConnectionPool
+from dedupe import DedupeIndex, RemoteCopies
+from hash_cache import HashCache, hash_file
+from incremental import TransferStats
+from journal import Journal
+from metrics import FileMetric, Metrics
+from remote_script import ScriptResult
+from remote_metadata import MetadataBatch
 from server_data import Server
-from source_data import SourceData
-from sftpretty import CnOpts, Connection
-import sftpretty
+from source_data import FilePlan, SourceData, TransferItem
+from source_scanner import ScannedDirectory, SourceFilter, SourceScanner
+from target_session import TargetSession
+
+if TYPE_CHECKING:
+    from paramiko import SFTPAttributes, SFTPClient, Transport
+    from sftpretty import Connection
 
 log: logging.Logger = log_config.get_logger("Disser")
+files_log: logging.Logger = log_config.get_file_logger()
+
+# (local path, remote path, local stat, remote attributes if it exists)
+Candidate = tuple[str, str, os.stat_result, "SFTPAttributes | None"]
 
 
 class Disser:
-    def __init__(self):
+    def __init__(self, max_workers: int = 1):
         self.targets: list[Server] = []
         self.source_data: list[SourceData] = []
+        # Local walks and stats shared by every target
+        self.scanner: SourceScanner = SourceScanner()
+        # Number of targets worked on at the same time
+        self.max_workers: int = max(1, max_workers)
+        # Timings, bytes and retries of the run for every phase and target
+        self.metrics: Metrics = Metrics()
+        # Sessions are shared by the file and script phases
+        self.pool: ConnectionPool = ConnectionPool(self.metrics)
+        # One of incremental.SYNC_MODES
+        self.sync_mode: str = incremental.SYNC_OFF
+        self.transfer_stats: dict[str, TransferStats] = {}
+        self.hash_cache: HashCache | None = None
+        # Files at least this large are sent as rsync style deltas, 0 disables
+        self.delta_min_size: int = 0
+        # Send all files through one tar stream per target instead of SFTP
+        self.tar_mode: bool = False
+        # Used by sources that do not set their own compression
+        self.compression: Compression | None = None
+        # Uploads kept in flight per target over its one SSH session
+        self.window: int = 1
+        # Give files the local numeric owner and group, needs root remotely
+        self.preserve_owner: bool = False
+        # Targets we send to directly when relaying, 0 sends to every target
+        self.relay_fanout: int = 0
+        # Seconds a script may run before it is stopped, None waits forever
+        self.script_timeout: float | None = None
+        # Targets not started yet are skipped once this many failed scripts,
+        # 0 never stops early
+        self.max_failures: int = 0
+        # Skip the scripts after one that failed on the same target
+        self.stop_on_script_failure: bool = False
+        # Files finished on each target, so an interrupted run can resume
+        self.journal: Journal | None = None
+        # Skip what the journal says an earlier run already sent
+        self.resume: bool = False
+        # One of dedupe.DEDUPE_MODES, how files with the same contents as one
+        # already sent are made on the target
+        self.dedupe_mode: str = dedupe.DEDUPE_OFF
+        # Send the largest files first instead of in config order
+        self.schedule: bool = False
+        # MiB/s one upload channel is assumed to reach for the estimate
+        self.schedule_rate: float = scheduler.DEFAULT_RATE_MB
 
-    def add_file_source(self, input: str, destination: str = ""):
-        self.source_data.append(SourceData(input, destination))
+    def add_file_source(
+        self,
+        input: str,
+        destination: str = "",
+        compression: Compression | None = None,
+        include: list[str] | None = None,
+        exclude: list[str] | None = None,
+    ):
+        source_filter: SourceFilter | None = None
+        if include or exclude:
+            source_filter = SourceFilter(tuple(include or ()), tuple(exclude or ()))
+        self.source_data.append(
+            SourceData(
+                input,
+                destination,
+                compression=compression,
+                source_filter=source_filter,
+                scanner=self.scanner,
+            )
+        )
 
     def add_script_source(self, input: str, destination: str = ""):
-        self.source_data.append(SourceData(input, destination, True))
+        self.source_data.append(
+            SourceData(input, destination, True, scanner=self.scanner)
+        )
 
     def add_server(self, server: Server):
         self.targets.append(server)
 
-    def get_file_list(self) -> list[tuple[str, str, bool]]:
-        files: list[tuple[str, str, bool]] = []
+    def get_file_list(self) -> list[TransferItem]:
+        files: list[TransferItem] = []
         for sources in self.source_data:
             files.extend(sources.get_source_list())
 
@@ -34,6 +134,38 @@ class Disser:
             log.info(file)
         return files
 
+    def get_file_plan(self) -> FilePlan:
+        log.info("Sources to be copied: ")
+        for sources in self.source_data:
+            if sources.is_valid:
+                log.info(
+                    "{} to {}".format(
+                        sources.absolute or sources.input, sources.destination
+                    )
+                )
+        return FilePlan(self.source_data)
+
+    def schedule_files(self, files: FilePlan) -> Iterable[TransferItem]:
+        if not self.schedule:
+            return files
+        schedule = scheduler.TransferSchedule(files, self.scanner)
+        channels: int = 1 if self.tar_mode else self.window
+        targets: int = len(self.targets)
+        if 0 < self.relay_fanout < targets:
+            targets = self.relay_fanout
+        rounds: int = max(1, -(-targets // self.max_workers))
+        log.info(
+            "Transfer estimate: {}".format(
+                schedule.estimate(channels, rounds, self.schedule_rate)
+            )
+        )
+        return schedule
+
+    def order(self, candidates: list[Candidate]) -> list[Candidate]:
+        if self.schedule:
+            candidates.sort(key=lambda c: c[2].st_size, reverse=True)
+        return candidates
+
     def get_script_list(self) -> list[str]:
         files: list[str] = []
         for sources in self.source_data:
@@ -45,139 +177,805 @@ class Disser:
             log.info(file)
         return files
 
-    def transfer_files(self):
-        files: list[tuple[str, str, bool]] = self.get_file_list()
-        for target in self.targets:
-            self.transfer_to_target(target, files)
+    def run_on_targets(
+        self,
+        phase: str,
+        action: Callable[[Server, list], bool],
+        items: list,
+        max_failures: int = 0,
+    ) -> dict[str, bool]:
+        results: dict[str, bool] = {}
+        if len(self.targets) == 0:
+            log.warn("No targets for {} phase".format(phase))
+            return results
+
+        results = self.run_jobs(
+            phase,
+            [
+                (target, lambda target=target: action(target, items))
+                for target in self.targets
+            ],
+            max_failures,
+        )
+        self.log_summary(phase, results)
+        return results
+
+    def run_jobs(
+        self,
+        phase: str,
+        jobs: list[tuple[Server, Callable[[], bool]]],
+        max_failures: int = 0,
+        workers: int | None = None,
+    ) -> dict[str, bool]:
+        results: dict[str, bool] = {}
+        if len(jobs) == 0:
+            return results
+        workers = min(workers or self.max_workers, len(jobs))
+        log.info(
+            "Starting {} phase on {} targets with {} workers".format(
+                phase, len(jobs), workers
+            )
+        )
+        failures: list[int] = [0]
+        lock: threading.Lock = threading.Lock()
+
+        # Counted on the worker so a target queued behind a failure already
+        # sees it when it starts
+        def guarded(target: Server, job: Callable[[], bool]) -> bool:
+            if self.pool.health.is_quarantined(target.name):
+                log.warn(
+                    "Server ({}) is quarantined, skipped during {} phase".format(
+                        target.name, phase
+                    )
+                )
+                return False
+            with lock:
+                if 0 < max_failures <= failures[0]:
+                    log.warn(
+                        "Server ({}) skipped during {} phase".format(target.name, phase)
+                    )
+                    return False
+            started: float = time.monotonic()
+            try:
+                result: bool = job()
+            except Exception as e:
+                # Never let one host take down the rest of the run
+                log.error(
+                    "Server ({}) failed during {} phase".format(target.name, phase)
+                )
+                log.exception(e)
+                result = False
+            self.metrics.target(target.name).phase(
+                phase, time.monotonic() - started, result
+            )
+            if not result:
+                with lock:
+                    failures[0] += 1
+                    if failures[0] == max_failures:
+                        log.error(
+                            "{} targets failed during {} phase, not starting the rest".format(
+                                failures[0], phase
+                            )
+                        )
+            return result
+
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=phase
+        ) as executor:
+            futures = {
+                executor.submit(guarded, target, job): target for target, job in jobs
+            }
+            for future in as_completed(futures):
+                results[futures[future].name] = future.result()
+        return results
+
+    def log_summary(self, phase: str, results: dict[str, bool]):
+        succeeded: list[str] = sorted(k for k, v in results.items() if v)
+        failed: list[str] = sorted(k for k, v in results.items() if not v)
+        log.info(
+            "Summary of {} phase: {} succeeded, {} failed".format(
+                phase, len(succeeded), len(failed)
+            )
+        )
+        if len(succeeded) > 0:
+            log.info("Succeeded: {}".format(", ".join(succeeded)))
+        if len(failed) > 0:
+            log.error("Failed: {}".format(", ".join(failed)))
+
+    def probe_targets(
+        self, timeout: float = preflight.PROBE_TIMEOUT
+    ) -> dict[str, bool]:
+        # Every target at once with a short timeout, so dead or misconfigured
+        # ones are quarantined before any data moves
+        started: float = time.monotonic()
+        results: dict[str, bool] = self.run_jobs(
+            "preflight",
+            [
+                (target, lambda target=target: self.probe_target(target, timeout))
+                for target in self.targets
+            ],
+            workers=preflight.PROBE_WORKERS,
+        )
+        self.metrics.phase("preflight", time.monotonic() - started)
+        self.log_summary("preflight", results)
+        return results
+
+    def probe_target(self, server: Server, timeout: float) -> bool:
+        error: str | None = preflight.probe_tcp(server, timeout)
+        if error is not None:
+            self.pool.health.quarantine(server, "unreachable, {}".format(error))
+            return False
+        try:
+            # Logging in opens the connection the transfer goes on to use,
+            # within the same timeout as reaching the target
+            self.pool.get(server, timeout)
+        except Exception as e:
+            self.pool.health.quarantine(server, "connect failed, {}".format(e))
+            return False
+        return True
+
+    def transfer_files(self) -> dict[str, bool]:
+        started: float = time.monotonic()
+        if self.tar_mode and self.dedupe_mode != dedupe.DEDUPE_OFF:
+            log.warn("Tar streams send every file, duplicates are not copied remotely")
+        if self.tar_mode and self.resume:
+            # Files in a stream are not journaled, it lands whole or not at all
+            log.warn("Tar streams cannot resume, every file is sent again")
+        files = self.schedule_files(self.get_file_plan())
+        if 0 < self.relay_fanout < len(self.targets):
+            results = self.transfer_relay(files)
+        else:
+            results = self.run_on_targets("transfer", self.transfer_to_target, files)
+        self.metrics.phase("transfer", time.monotonic() - started)
+        self.log_sync_totals()
+        return results
+
+    def log_sync_totals(self):
+        if self.sync_mode != incremental.SYNC_OFF:
+            total = TransferStats()
+            for stats in self.transfer_stats.values():
+                total.merge(stats)
+            log.info("Incremental sync totals: {}".format(total._to_string()))
+
+    def transfer_relay(self, files: Iterable[TransferItem]) -> dict[str, bool]:
+        tiers = relay.build_tiers(self.targets, self.relay_fanout)
+        results: dict[str, bool] = {}
+        relayed: list[Server] = []
+        for depth, tier in enumerate(tiers):
+            jobs: list[tuple[Server, Callable[[], bool]]] = []
+            for parent, child in tier:
+                if parent is None or not results.get(parent.name, False):
+                    jobs.append(
+                        (child, lambda c=child: self.transfer_to_target(c, files))
+                    )
+                else:
+                    relayed.append(child)
+                    jobs.append(
+                        (
+                            child,
+                            lambda p=parent, c=child: self.relay_to_target(p, c, files),
+                        )
+                    )
+            results.update(self.run_jobs("relay-{}".format(depth), jobs))
+
+        # Anything that arrived through another target is checked against a
+        # seed we sent to directly
+        seeds: list[Server] = [
+            child
+            for _, child in tiers[0]
+            if results.get(child.name, False) and child not in relayed
+        ]
+        relayed = [target for target in relayed if results.get(target.name, False)]
+        if len(seeds) > 0 and len(relayed) > 0:
+            expected: str | None = self.remote_manifest(seeds[0], files)
+            manifests = self.run_jobs(
+                "verify",
+                [
+                    (
+                        target,
+                        lambda t=target: expected is not None
+                        and self.remote_manifest(t, files) == expected,
+                    )
+                    for target in relayed
+                ],
+            )
+            retry: list[Server] = [t for t in relayed if not manifests[t.name]]
+            for target in retry:
+                log.warn(
+                    "Server ({}) does not match seed ({}), sending directly".format(
+                        target.name, seeds[0].name
+                    )
+                )
+            results.update(
+                self.run_jobs(
+                    "transfer",
+                    [(t, lambda t=t: self.transfer_to_target(t, files)) for t in retry],
+                )
+            )
+
+        self.log_summary("transfer", results)
+        return results
+
+    def relay_to_target(
+        self,
+        parent: Server,
+        child: Server,
+        files: Iterable[TransferItem],
+    ) -> bool:
+        log.info("Relaying files from ({}) to ({})".format(parent.name, child.name))
+        try:
+            self.pool.get(parent)
+            # The transport is safe to share between threads, the SFTP channel
+            # is not
+            result = remote_exec.run_streaming(
+                self.pool.transports[parent.name],
+                relay.forward_command(child),
+                relay.path_list(relay.planned_paths(files, self.scanner), True),
+            )
+            if result.exit_status == 0:
+                return True
+            log.warn(
+                "Relay from ({}) to ({}) failed with {}, sending directly. {}".format(
+                    parent.name,
+                    child.name,
+                    result.exit_status,
+                    result.stderr.decode("utf-8", "replace").strip(),
+                )
+            )
+        except Exception as e:
+            log.warn(
+                "Relay from ({}) to ({}) failed, sending directly.".format(
+                    parent.name, child.name
+                )
+            )
+            log.exception(e)
+        return self.transfer_to_target(child, files)
+
+    def remote_manifest(
+        self, server: Server, files: Iterable[TransferItem]
+    ) -> str | None:
+        self.pool.get(server)
+        result = remote_exec.run_streaming(
+            self.pool.transports[server.name],
+            relay.manifest_command(),
+            relay.path_list(relay.planned_paths(files, self.scanner)),
+        )
+        if result.exit_status != 0:
+            log.error(
+                "Unable to read manifest on server ({}): {}".format(
+                    server.name, result.stderr.decode("utf-8", "replace").strip()
+                )
+            )
+            return None
+        return result.stdout.decode("utf-8", "replace").split(" ")[0].strip()
 
-    def transfer_to_target(self, server: Server, files: list[tuple[str, str, bool]]):
-        port: int = 22
-        if server.port is not None:
-            port = int(server.port)
+    def transfer_to_target(self, server: Server, files: Iterable[TransferItem]) -> bool:
+        session = TargetSession(server, self.pool, self.window, self.preserve_owner)
+        self.transfer_stats[server.name] = session.stats
+        self.metrics.target(server.name).stats = session.stats
+        if self.journal is not None:
+            self.journal.start(server.name, self.resume)
+        if self.dedupe_mode != dedupe.DEDUPE_OFF and not self.tar_mode:
+            session.dedupe = DedupeIndex(self.local_digest)
+            session.copies = RemoteCopies(
+                self.dedupe_mode, session.metadata, session.stats
+            )
         try:
-            with Connection(
-                host=str(server.hostname),
-                username=server.username,
-                password=server.password,
-                port=port,
-                private_key=server.identity_file,
-            ) as sftp:
-                for file in files:
-                    try:
-                        if file[2]:
-                            self.transfer_directory(file[0], file[1], sftp)
-                        else:
-                            self.transfer_file(file[0], file[1], sftp)
-                    except (OSError, IOError) as ose:
-                        log.error("Failed to transfer file {}".format(file))
-                        log.exception(ose)
-
-        except sftpretty.ConnectionException as conne:
+            if self.tar_mode:
+                if not self.with_reconnect(
+                    session,
+                    lambda: self.transfer_tar(files, session),
+                    "files as tar stream",
+                ):
+                    session.success = False
+            else:
+                for batch in remote_dirs.batched(files):
+                    if not self.with_reconnect(
+                        session,
+                        lambda: self.create_parents(batch, session),
+                        "directories for {} items".format(len(batch)),
+                    ):
+                        session.success = False
+                    for file in batch:
+                        if not self.with_reconnect(
+                            session,
+                            lambda: self.transfer_item(file, session),
+                            "file {}".format(file),
+                        ):
+                            session.success = False
+                    self.apply_metadata(session)
+            session.close()
+            self.apply_metadata(session, True)
+
+        except connection_pool.connection_errors() as conne:
             log.error("Server ({}) unable to connect".format(server._to_string()))
             log.exception(conne)
-        except (
-            sftpretty.CredentialException,
-            sftpretty.HostKeysException,
-            sftpretty.SSHException,
-            sftpretty.PasswordRequiredException,
-            sftpretty.LoggingException,
-            sftpretty.SSHException,
-        ) as authe:
+            session.close()
+            return False
+        except connection_pool.auth_errors() as authe:
             log.error(
                 "Server ({}) is unable to authenticate or ssh.".format(
                     server._to_string()
                 )
             )
             log.exception(authe)
+            session.close()
+            self.pool.discard(server)
+            return False
+        if self.sync_mode != incremental.SYNC_OFF:
+            log.info(
+                "Server ({}) incremental sync: {}".format(
+                    server.name, session.stats._to_string()
+                )
+            )
+        if session.success and self.journal is not None:
+            # Nothing left to resume on this target
+            self.journal.finish(server.name)
+        return session.success
 
-    def transfer_directory(self, source: str, destination: str, sftp: Connection):
-        directory_structure = os.path.dirname(destination)
-        statmod = os.stat(source)
-        chmod_val = int(oct(statmod.st_mode)[-3:])
-        sftp.mkdir_p(directory_structure)
-        sftp.put_r(
-            localdir=source,
-            remotedir=destination,
-            logger=log,
-            confirm=True,
-            tries=5,
-        )
+    def with_reconnect(
+        self, session: TargetSession, action: Callable[[], None], description: str
+    ) -> bool:
+        for attempt in range(2):
+            session.connect()
+            try:
+                action()
+                return True
+            except (OSError, IOError) as ose:
+                if attempt == 0 and not session.is_alive():
+                    # The session dropped underneath us, retry once on a new one
+                    continue
+                log.error("Failed to transfer {}".format(description))
+                log.exception(ose)
+                break
+        return False
+
+    def local_digest(self, path: str, status: os.stat_result | None = None) -> str:
+        if self.hash_cache is None:
+            return hash_file(path)
+        return self.hash_cache.digest(path, status)
+
+    def apply_metadata(self, session: TargetSession, final: bool = False):
+        # Copies first, so they get their modes and times in the same pass
+        if session.copies is not None and not self.with_reconnect(
+            session,
+            lambda: session.copies.flush(session.transport, final),
+            "duplicate files",
+        ):
+            session.success = False
+        if not self.with_reconnect(
+            session,
+            lambda: session.metadata.flush(session.transport, final),
+            "file modes and times",
+        ):
+            session.success = False
+
+    def create_parents(self, files: list[TransferItem], session: TargetSession):
+        for file in files:
+            session.directories.ensure(posixpath.dirname(file.destination))
+        session.directories.flush(session.transport)
+
+    def transfer_item(self, file: TransferItem, session: TargetSession):
+        compress: Compression | None = file.compression or self.compression
+        if compress is not None and not compress.enabled():
+            compress = None
+        if file[2]:
+            self.transfer_directory(
+                file[0], file[1], session, compress, file.source_filter
+            )
+        else:
+            self.transfer_file(file[0], file[1], session, compress)
+
+    def select_changed(
+        self, candidates: list[Candidate], session: TargetSession
+    ) -> list[Candidate]:
+        if self.resume and self.journal is not None:
+            candidates = self.drop_completed(candidates, session)
+        if self.sync_mode == incremental.SYNC_OFF:
+            return candidates
+
+        changed, to_hash = self.split_changed(candidates, session)
+        # Only files that already match in size are worth hashing
+        digests = incremental.remote_digests(session.sftp, [c[1] for c in to_hash])
+        return changed + self.match_digests(to_hash, digests, session)
+
+    def drop_completed(
+        self, candidates: list[Candidate], session: TargetSession
+    ) -> list[Candidate]:
+        remaining: list[Candidate] = []
+        for candidate in candidates:
+            if self.journal.is_complete(
+                session.server.name,
+                candidate[1],
+                candidate[2],
+                lambda: self.local_digest(candidate[0], candidate[2]),
+            ):
+                files_log.info("Skipping file sent before resume (%s)", candidate[1])
+                session.stats.skipped(candidate[2].st_size)
+                self.note_present(candidate, session)
+                # The earlier run may have died before applying these
+                session.metadata.record(candidate[1], candidate[2])
+            else:
+                remaining.append(candidate)
+        return remaining
+
+    def split_changed(
+        self, candidates: list[Candidate], session: TargetSession
+    ) -> tuple[list[Candidate], list[Candidate]]:
+        changed: list[Candidate] = []
+        to_hash: list[Candidate] = []
+        for candidate in candidates:
+            local, remote = candidate[2], candidate[3]
+            if self.sync_mode == incremental.SYNC_HASH:
+                if incremental.same_size(local, remote):
+                    to_hash.append(candidate)
+                else:
+                    changed.append(candidate)
+            elif incremental.same_size_and_mtime(local, remote):
+                self.skip(candidate, session)
+            else:
+                changed.append(candidate)
+        return changed, to_hash
+
+    def match_digests(
+        self,
+        candidates: list[Candidate],
+        digests: dict[str, str],
+        session: TargetSession,
+    ) -> list[Candidate]:
+        changed: list[Candidate] = []
+        for candidate in candidates:
+            if digests.get(candidate[1]) == self.local_digest(
+                candidate[0], candidate[2]
+            ):
+                self.skip(candidate, session)
+            else:
+                changed.append(candidate)
+        return changed
+
+    def skip(self, candidate: Candidate, session: TargetSession):
+        files_log.info("Skipping unchanged file (%s)", candidate[1])
+        session.stats.skipped(candidate[2].st_size)
+        self.note_present(candidate, session)
+        # Same contents can still need the mode or time brought up to date
+        if session.metadata.differs(candidate[2], candidate[3]):
+            session.metadata.record(candidate[1], candidate[2])
+
+    def note_present(self, candidate: Candidate, session: TargetSession):
+        # Contents already on the target can be copied from like sent ones
+        if session.dedupe is not None:
+            session.dedupe.primary(candidate[0], candidate[1], candidate[2])
+            session.copies.landed(candidate[1])
+
+    def transfer_directory(
+        self,
+        source: str,
+        destination: str,
+        session: TargetSession,
+        compress: Compression | None = None,
+        source_filter: SourceFilter | None = None,
+    ):
+        self.sync_directory(source, destination, session, compress, source_filter)
         log.info(
             "Successfully transferred directory ({}) to ({})".format(
                 source, destination
             )
         )
-        log.info("Setting chmod to {} for {}".format(chmod_val, destination))
-        sftp.chmod(destination, chmod_val)
-
-    def transfer_file(self, source: str, destination: str, sftp: Connection):
-        directory_structure = os.path.dirname(destination)
-        statmod = os.stat(source)
-        chmod_val = int(oct(statmod.st_mode)[-3:])
-        sftp.mkdir_p(directory_structure)
-        sftp.put(
-            localfile=source,
-            remotepath=destination,
-            logger=log,
-            confirm=True,
-            tries=5,
+        # The put_r style parent takes the mode of the source as well
+        session.metadata.record(destination, self.scanner.stat(source), True)
+
+    def sync_directory(
+        self,
+        source: str,
+        destination: str,
+        session: TargetSession,
+        compress: Compression | None = None,
+        source_filter: SourceFilter | None = None,
+    ):
+        for candidate in self.walk_directory(
+            source, destination, session, True, source_filter
+        ):
+            if S_ISDIR(candidate[2].st_mode):
+                session.metadata.record(candidate[1], candidate[2], True)
+            else:
+                self.upload(candidate, session, compress)
+
+    def walk_directory(
+        self,
+        source: str,
+        destination: str,
+        session: TargetSession,
+        create_dirs: bool,
+        source_filter: SourceFilter | None = None,
+    ) -> Iterator[Candidate]:
+        sftp: Connection = session.sftp
+        # Same layout as put_r, which copies into destination/<source name>
+        remote_root: str = posixpath.join(destination, os.path.basename(source))
+        for batch in remote_dirs.batched(self.scanner.walk(source, source_filter)):
+            prepared: list[tuple[ScannedDirectory, str, dict]] = []
+            for directory in batch:
+                remote_dir: str = remote_dirs.remote_directory(
+                    remote_root, source, directory.path
+                )
+
+                # One listing per directory instead of one stat per file
+                listing: dict[str, SFTPAttributes] | None = None
+                if self.sync_mode != incremental.SYNC_OFF:
+                    listing = incremental.remote_listing(sftp, remote_dir)
+                if listing is None:
+                    if create_dirs:
+                        session.directories.ensure(remote_dir)
+                    listing = {}
+                else:
+                    session.directories.exists(remote_dir)
+                prepared.append((directory, remote_dir, listing))
+            if create_dirs:
+                session.directories.flush(session.transport)
+
+            for directory, remote_dir, listing in prepared:
+                yield (directory.path, remote_dir, directory.status, None)
+                candidates: list[Candidate] = []
+                for entry in directory.files:
+                    name: str = os.path.basename(entry.path)
+                    path: str = posixpath.join(remote_dir, name)
+                    remote: SFTPAttributes | None = listing.get(name)
+                    if (
+                        self.sync_mode == incremental.SYNC_OFF
+                        and not self.tar_mode
+                        and self.delta_eligible(entry.status)
+                    ):
+                        # No listing without sync, only delta candidates are
+                        # worth a stat of their own
+                        remote = incremental.remote_attributes(sftp, path)
+                    candidates.append((entry.path, path, entry.status, remote))
+                yield from self.order(self.select_changed(candidates, session))
+            self.apply_metadata(session)
+
+    def transfer_tar(self, files: Iterable[TransferItem], session: TargetSession):
+        sftp: Connection = session.sftp
+        compress: Compression | None = self.compression
+        if compress is not None and not compress.enabled():
+            compress = None
+        stream = TarStream(sftp, compress)
+        try:
+            for file in files:
+                if file[2]:
+                    candidates = self.walk_directory(
+                        file[0], file[1], session, False, file.source_filter
+                    )
+                else:
+                    status = self.scanner.stat(file[0])
+                    remote: SFTPAttributes | None = None
+                    if self.sync_mode != incremental.SYNC_OFF:
+                        remote = incremental.remote_attributes(sftp, file[1])
+                    candidates = self.select_changed(
+                        [(file[0], file[1], status, remote)], session
+                    )
+                for candidate in candidates:
+                    stream.add(candidate[0], candidate[1])
+                    if not S_ISDIR(candidate[2].st_mode):
+                        session.stats.sent(candidate[2].st_size)
+        except BaseException:
+            stream.abort()
+            raise
+        stream.close()
+
+        # Modes and times travel inside the archive, only the put_r style
+        # parent is left
+        for file in files:
+            if file[2]:
+                session.metadata.record(file[1], self.scanner.stat(file[0]), True)
+
+    def transfer_file(
+        self,
+        source: str,
+        destination: str,
+        session: TargetSession,
+        compress: Compression | None = None,
+    ):
+        statmod = self.scanner.stat(source)
+        remote: SFTPAttributes | None = None
+        if self.sync_mode != incremental.SYNC_OFF or self.delta_eligible(statmod):
+            remote = incremental.remote_attributes(session.sftp, destination)
+        candidate: Candidate = (source, destination, statmod, remote)
+        if len(self.select_changed([candidate], session)) > 0:
+            self.upload(candidate, session, compress)
+
+    def may_be_link(self, remote: SFTPAttributes | None) -> bool:
+        # Only dedupe makes links of its own, any other link on a target is
+        # written through like put always did. Without a listing the
+        # destination may exist even when no attributes were fetched.
+        return self.dedupe_mode != dedupe.DEDUPE_OFF and (
+            remote is not None or self.sync_mode == incremental.SYNC_OFF
+        )
+
+    def delta_eligible(self, local: os.stat_result) -> bool:
+        return self.delta_min_size > 0 and local.st_size >= self.delta_min_size
+
+    def upload(
+        self,
+        candidate: Candidate,
+        session: TargetSession,
+        compress: Compression | None = None,
+    ):
+        if session.dedupe is not None:
+            primary: str | None = session.dedupe.primary(
+                candidate[0], candidate[1], candidate[2]
+            )
+            if primary is not None:
+                files_log.info(
+                    "Copying duplicate file (%s) from (%s) on the target",
+                    candidate[1],
+                    primary,
+                )
+                session.copies.add(primary, candidate[1], candidate[2])
+                return
+        transport: Transport = session.transport
+        stats: TransferStats = session.stats
+        metadata: MetadataBatch = session.metadata
+        target: str = session.server.name
+        copies: RemoteCopies | None = session.copies
+        session.upload(
+            "file ({})".format(candidate[1]),
+            lambda client: self.send_file(
+                candidate, client, transport, stats, metadata, target, compress, copies
+            ),
+        )
+
+    # Runs on an upload worker when pipelining, so it only touches its own
+    # client and opens exec channels on the transport
+    def send_file(
+        self,
+        candidate: Candidate,
+        client: SFTPClient,
+        transport: Transport,
+        stats: TransferStats,
+        metadata: MetadataBatch,
+        target: str,
+        compress: Compression | None = None,
+        copies: RemoteCopies | None = None,
+    ):
+        source, destination, local, remote = candidate
+        started: float = time.monotonic()
+        method: str = metrics.METHOD_DELTA
+        retries: int = 0
+        sent: int | None = None
+        if (
+            self.delta_eligible(local)
+            and remote is not None
+            and incremental.is_regular(remote)
+            and remote.st_size > 0
+        ):
+            sent = delta_transfer.transfer(
+                transport,
+                source,
+                destination,
+                self.local_digest(source, local),
+            )
+
+        if (
+            sent is None
+            and compress is not None
+            and compression.is_compressible(source, local)
+        ):
+            method = metrics.METHOD_COMPRESSED
+            sent = compression.upload(transport, source, destination, compress)
+
+        if sent is None:
+            method = metrics.METHOD_SFTP
+            replace: bool = self.may_be_link(remote)
+            if self.journal is not None and local.st_size >= journal.RESUME_MIN_SIZE:
+                retries, offset = self.put_resumable(client, candidate, target, replace)
+                sent = local.st_size - offset
+            else:
+                if replace:
+                    pipeline.break_link(client, destination)
+                retries = pipeline.put_file(client, source, destination)
+                sent = local.st_size
+        if self.journal is not None:
+            self.journal.complete(
+                target, destination, local, self.local_digest(source, local)
+            )
+        stats.sent(sent)
+        self.metrics.file(
+            FileMetric(
+                target, destination, method, sent, time.monotonic() - started, retries
+            )
+        )
+        files_log.info(
+            "Successfully transferred file (%s) to (%s)", source, destination
         )
-        log.info(
-            "Successfully transferred file ({}) to ({})".format(source, destination)
+        # Only complete uploads get their mode and time applied
+        metadata.record(destination, local)
+        if copies is not None:
+            copies.landed(destination)
+
+    def put_resumable(
+        self, client: SFTPClient, candidate: Candidate, target: str, replace: bool
+    ) -> tuple[int, int]:
+        source, destination, local, _ = candidate
+        offset: int = 0
+        if self.resume:
+            offset = pipeline.remote_size(
+                client, destination, self.journal.offset(target, destination, local)
+            )
+            if offset > 0:
+                log.info(
+                    "Resuming file ({}) on server ({}) at {} of {} bytes".format(
+                        destination, target, offset, local.st_size
+                    )
+                )
+        if offset == 0 and replace:
+            # A partial file to resume was written by us, it is never a link
+            pipeline.break_link(client, destination)
+        retries: int = pipeline.put_resumable(
+            client,
+            source,
+            destination,
+            offset,
+            lambda done: self.journal.checkpoint(target, destination, local, done),
+            journal.CHECKPOINT_BYTES,
         )
-        log.info("Setting chmod to {} for {}".format(chmod_val, destination))
-        sftp.chmod(destination, chmod_val)
+        return retries, offset
 
-    def run_scripts(self):
+    def run_scripts(self) -> dict[str, bool]:
+        started: float = time.monotonic()
         scripts: list[str] = self.get_script_list()
-        for target in self.targets:
-            self.execute_on_target(target, scripts)
+        results = self.run_on_targets(
+            "script", self.execute_on_target, scripts, self.max_failures
+        )
+        self.metrics.phase("script", time.monotonic() - started)
+        return results
 
-    def execute_on_target(self, server: Server, scripts: list[str]):
-        port: int = 22
-        if server.port is not None:
-            port = int(server.port)
+    def execute_on_target(self, server: Server, scripts: list[str]) -> bool:
+        success: bool = True
         try:
-            with Connection(
-                host=str(server.hostname),
-                username=server.username,
-                password=server.password,
-                port=port,
-                private_key=server.identity_file,
-            ) as sftp:
-                for script in scripts:
-                    try:
-                        self.execute_script(script, sftp)
-                    except (ValueError, IOError) as ose:
-                        log.error("Failed to execute script {}".format(script))
-                        log.exception(ose)
-
-        except sftpretty.ConnectionException as conne:
+            sftp: Connection = self.pool.get(server)
+            for index, script in enumerate(scripts):
+                try:
+                    result = self.execute_script(script, sftp, server)
+                    remote_script.log_result(server.name, result)
+                    succeeded: bool = result.succeeded()
+                except (ValueError, IOError) as ose:
+                    log.error("Failed to execute script {}".format(script))
+                    log.exception(ose)
+                    succeeded = False
+                if not succeeded:
+                    success = False
+                    # Opt in, later scripts may build on this one or not need it
+                    if self.stop_on_script_failure and index + 1 < len(scripts):
+                        log.error(
+                            "Server ({}) skipping {} scripts after ({})".format(
+                                server.name, len(scripts) - index - 1, script
+                            )
+                        )
+                        break
+
+        except connection_pool.connection_errors() as conne:
             log.error("Server ({}) unable to connect".format(server._to_string()))
             log.exception(conne)
-        except (
-            sftpretty.CredentialException,
-            sftpretty.HostKeysException,
-            sftpretty.SSHException,
-            sftpretty.PasswordRequiredException,
-            sftpretty.LoggingException,
-            sftpretty.SSHException,
-        ) as authe:
+            return False
+        except connection_pool.auth_errors() as authe:
             log.error(
                 "Server ({}) is unable to authenticate or ssh.".format(
                     server._to_string()
                 )
             )
             log.exception(authe)
+            self.pool.discard(server)
+            return False
+        return success
 
-    def execute_script(self, script: str, sftp: Connection):
-        log.info("Running script ({})".format(script))
-        cd_to: str = os.path.dirname(script)
-        command: str = "(cd " + cd_to + " && " + script + ")"
-        results: list[str] = sftp.execute(
-            command=command,
-            logger=log,
-        )
-        log.info("Script {} results: ".format(command))
-        for result in results:
-            log.info(result)
+    def execute_script(
+        self, script: str, sftp: Connection, server: Server
+    ) -> ScriptResult:
+        log.info("Running script ({}) on server ({})".format(script, server.name))
+        # The output is logged as it arrives on its own exec channel
+        return remote_script.run_script(sftp, server.name, script, self.script_timeout)
+
+    def close(self):
+        self.pool.close_all()
+        if self.hash_cache is not None:
+            self.hash_cache.close()
+        if self.journal is not None:
+            self.journal.close()
@@ -0,0 +1,135 @@
+import hashlib
+import log_config
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log: logging.Logger = log_config.get_logger("HashCache")
+
+DEFAULT_CACHE_PATH: str = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "disser",
+    "hashes.sqlite",
+)
+HASH_CHUNK_SIZE: int = 1024 * 1024
+COMMIT_INTERVAL: int = 1000
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HashCache:
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_PATH,
+        max_entries: int = 1000000,
+        max_age_days: int = 30,
+    ) -> None:
+        self.path: str = path
+        self.max_entries: int = max_entries
+        self.max_age_days: int = max_age_days
+        self.db: sqlite3.Connection | None = None
+        self.lock: threading.Lock = threading.Lock()
+        self.pending_writes: int = 0
+        # Hits only refresh last_used, so they are written once at close
+        self.touched: set[str] = set()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def _open(self) -> sqlite3.Connection:
+        if self.db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS digests ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                "inode INTEGER, digest TEXT, last_used REAL)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS digests_last_used ON digests(last_used)"
+            )
+            log.info("Opened hash cache {}".format(self.path))
+        return self.db
+
+    def digest(self, path: str, status: os.stat_result | None = None) -> str:
+        path = os.path.abspath(path)
+        if status is None:
+            status = os.stat(path)
+        key = (status.st_size, status.st_mtime_ns, status.st_ino)
+
+        with self.lock:
+            db = self._open()
+            row = db.execute(
+                "SELECT size, mtime_ns, inode, digest FROM digests WHERE path = ?",
+                (path,),
+            ).fetchone()
+        if row is not None and tuple(row[:3]) == key:
+            with self.lock:
+                self.hits += 1
+                self.touched.add(path)
+            return row[3]
+
+        # Missing or stale, hash outside the lock so other files can proceed
+        digest: str = hash_file(path)
+        with self.lock:
+            self.misses += 1
+            self.touched.discard(path)
+            self.db.execute(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)",
+                (path, key[0], key[1], key[2], digest, time.time()),
+            )
+            self.pending_writes += 1
+            if self.pending_writes >= COMMIT_INTERVAL:
+                self.db.commit()
+                self.pending_writes = 0
+        return digest
+
+    def evict(self):
+        if self.db is None:
+            return
+        with self.lock:
+            cutoff: float = time.time() - self.max_age_days * 86400
+            expired = self.db.execute(
+                "DELETE FROM digests WHERE last_used < ?", (cutoff,)
+            ).rowcount
+            count: int = self.db.execute("SELECT COUNT(*) FROM digests").fetchone()[0]
+            overflow: int = 0
+            if count > self.max_entries:
+                overflow = self.db.execute(
+                    "DELETE FROM digests WHERE path IN "
+                    "(SELECT path FROM digests ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,),
+                ).rowcount
+            self.db.commit()
+        if expired > 0 or overflow > 0:
+            log.info(
+                "Evicted {} expired and {} overflow entries from hash cache".format(
+                    expired, overflow
+                )
+            )
+
+    def close(self):
+        if self.db is None:
+            return
+        with self.lock:
+            now: float = time.time()
+            self.db.executemany(
+                "UPDATE digests SET last_used = ? WHERE path = ?",
+                [(now, path) for path in self.touched],
+            )
+            self.touched.clear()
+            self.db.commit()
+        self.evict()
+        with self.lock:
+            self.db.close()
+            self.db = None
+        log.info("Hash cache {} hits, {} files hashed".format(self.hits, self.misses))
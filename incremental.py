@@ -0,0 +1,139 @@
+from __future__ import annotations
+import log_config
+import logging
+import os
+import remote_dirs
+import shlex
+import stat
+import threading
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from paramiko import SFTPAttributes
+    from sftpretty import Connection
+
+log: logging.Logger = log_config.get_logger("Incremental")
+
+SYNC_OFF = "off"
+SYNC_SIZE_MTIME = "size-mtime"
+SYNC_HASH = "hash"
+SYNC_MODES: list[str] = [SYNC_OFF, SYNC_SIZE_MTIME, SYNC_HASH]
+DIGEST_COMMAND: str = "sha256sum --"
+
+
+class TransferStats:
+    def __init__(self) -> None:
+        self.lock: threading.Lock = threading.Lock()
+        self.files_sent: int = 0
+        self.bytes_sent: int = 0
+        self.files_skipped: int = 0
+        self.bytes_skipped: int = 0
+        # Duplicates made on the target from contents sent once
+        self.files_copied: int = 0
+        self.bytes_copied: int = 0
+
+    def sent(self, size: int):
+        with self.lock:
+            self.files_sent += 1
+            self.bytes_sent += size
+
+    def skipped(self, size: int):
+        with self.lock:
+            self.files_skipped += 1
+            self.bytes_skipped += size
+
+    def copied(self, size: int):
+        with self.lock:
+            self.files_copied += 1
+            self.bytes_copied += size
+
+    def merge(self, other: "TransferStats"):
+        with self.lock:
+            self.files_sent += other.files_sent
+            self.bytes_sent += other.bytes_sent
+            self.files_skipped += other.files_skipped
+            self.bytes_skipped += other.bytes_skipped
+            self.files_copied += other.files_copied
+            self.bytes_copied += other.bytes_copied
+
+    def _to_string(self) -> str:
+        text: str = (
+            "sent {} files ({} bytes), skipped {} unchanged files ({} bytes)".format(
+                self.files_sent, self.bytes_sent, self.files_skipped, self.bytes_skipped
+            )
+        )
+        if self.files_copied > 0:
+            text += ", copied {} duplicate files ({} bytes) remotely".format(
+                self.files_copied, self.bytes_copied
+            )
+        return text
+
+
+# The raw client is used so a missing path is not logged as a channel error
+def remote_attributes(sftp: Connection, path: str) -> SFTPAttributes | None:
+    try:
+        return sftp.sftp_client.stat(path)
+    except IOError:
+        return None
+
+
+def remote_listing(
+    sftp: Connection, directory: str
+) -> dict[str, SFTPAttributes] | None:
+    try:
+        return {
+            attr.filename: attr for attr in sftp.sftp_client.listdir_attr(directory)
+        }
+    except IOError:
+        return None
+
+
+def remote_digests(sftp: Connection, paths: list[str]) -> dict[str, str]:
+    digests: dict[str, str] = {}
+    if len(paths) == 0:
+        return digests
+    for command in digest_commands(paths):
+        for line in sftp.execute(command=command, logger=log, silent=True):
+            parse_digest(line, digests)
+    return digests
+
+
+def digest_commands(paths: list[str]) -> list[str]:
+    # Split like mkdir so a directory of many same size files stays under
+    # the remote ARG_MAX
+    commands: list[str] = []
+    command: str = DIGEST_COMMAND
+    for path in paths:
+        argument: str = shlex.quote(path)
+        if (
+            command != DIGEST_COMMAND
+            and len(command) + len(argument) + 1 > remote_dirs.MAX_COMMAND_LENGTH
+        ):
+            commands.append(command)
+            command = DIGEST_COMMAND
+        command += " " + argument
+    if command != DIGEST_COMMAND:
+        commands.append(command)
+    return commands
+
+
+def parse_digest(line: str | bytes, digests: dict[str, str]):
+    if type(line) is bytes:
+        line = line.decode("utf-8", "replace")
+    # "<64 hex digits>  <path>", anything else is an error line
+    digest, _, path = line.rstrip("\n").partition("  ")
+    if len(digest) == 64 and len(path) > 0:
+        digests[path] = digest
+
+
+def is_regular(remote: SFTPAttributes) -> bool:
+    return remote.st_mode is not None and stat.S_ISREG(remote.st_mode)
+
+
+def same_size(local: os.stat_result, remote: SFTPAttributes | None) -> bool:
+    return remote is not None and is_regular(remote) and remote.st_size == local.st_size
+
+
+def same_size_and_mtime(local: os.stat_result, remote: SFTPAttributes | None) -> bool:
+    # SFTP v3 only carries whole seconds
+    return same_size(local, remote) and remote.st_mtime == int(local.st_mtime)
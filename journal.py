@@ -0,0 +1,161 @@
+import log_config
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable
+
+log: logging.Logger = log_config.get_logger("Journal")
+
+DEFAULT_JOURNAL_PATH: str = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "disser",
+    "journal.sqlite",
+)
+# Files at least this large are sent so an interrupted upload can continue
+RESUME_MIN_SIZE: int = 64 * 1024 * 1024
+# Bytes written between two recorded offsets of a large file
+CHECKPOINT_BYTES: int = 16 * 1024 * 1024
+# Completed files are committed at least this often, a crash loses at most
+# this much of the record
+COMMIT_SECONDS: float = 1.0
+
+
+class Journal:
+    # Files completed on each target and how far large uploads got, so a run
+    # that died can be started again with resume and pick up where it was.
+    # Entries of a target are dropped once a transfer to it succeeds.
+    def __init__(self, path: str = DEFAULT_JOURNAL_PATH) -> None:
+        self.path: str = path
+        self.db: sqlite3.Connection | None = None
+        self.lock: threading.Lock = threading.Lock()
+        self.last_commit: float = time.monotonic()
+        self.resumed: int = 0
+
+    def _open(self) -> sqlite3.Connection:
+        if self.db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS completed ("
+                "target TEXT, path TEXT, size INTEGER, mtime_ns INTEGER, "
+                "digest TEXT, PRIMARY KEY (target, path))"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS partial ("
+                "target TEXT, path TEXT, size INTEGER, mtime_ns INTEGER, "
+                "offset INTEGER, PRIMARY KEY (target, path))"
+            )
+            log.info("Opened transfer journal {}".format(self.path))
+        return self.db
+
+    def _commit(self, force: bool = False):
+        # Called with the lock held
+        now: float = time.monotonic()
+        if force or now - self.last_commit >= COMMIT_SECONDS:
+            self.db.commit()
+            self.last_commit = now
+
+    def start(self, target: str, resume: bool):
+        with self.lock:
+            db = self._open()
+            if resume:
+                count: int = db.execute(
+                    "SELECT COUNT(*) FROM completed WHERE target = ?", (target,)
+                ).fetchone()[0]
+                if count > 0:
+                    log.info(
+                        "Server ({}) resuming with {} files already sent".format(
+                            target, count
+                        )
+                    )
+                return
+            # A fresh run must not trust what an earlier one left behind
+            db.execute("DELETE FROM completed WHERE target = ?", (target,))
+            db.execute("DELETE FROM partial WHERE target = ?", (target,))
+            self._commit(True)
+
+    def finish(self, target: str):
+        with self.lock:
+            db = self._open()
+            db.execute("DELETE FROM completed WHERE target = ?", (target,))
+            db.execute("DELETE FROM partial WHERE target = ?", (target,))
+            self._commit(True)
+
+    def is_complete(
+        self, target: str, path: str, local: os.stat_result, digest: Callable[[], str]
+    ) -> bool:
+        # Only hashed when size and mtime still match what was sent
+        sent: str | None = self.completed_digest(target, path, local)
+        if sent is None or sent != digest():
+            return False
+        with self.lock:
+            self.resumed += 1
+        return True
+
+    def completed_digest(
+        self, target: str, path: str, local: os.stat_result
+    ) -> str | None:
+        with self.lock:
+            row = (
+                self._open()
+                .execute(
+                    "SELECT size, mtime_ns, digest FROM completed "
+                    "WHERE target = ? AND path = ?",
+                    (target, path),
+                )
+                .fetchone()
+            )
+        if row is None or (row[0], row[1]) != (local.st_size, local.st_mtime_ns):
+            return None
+        return row[2]
+
+    def complete(self, target: str, path: str, local: os.stat_result, digest: str):
+        with self.lock:
+            db = self._open()
+            db.execute(
+                "INSERT OR REPLACE INTO completed VALUES (?, ?, ?, ?, ?)",
+                (target, path, local.st_size, local.st_mtime_ns, digest),
+            )
+            db.execute(
+                "DELETE FROM partial WHERE target = ? AND path = ?", (target, path)
+            )
+            self._commit()
+
+    def offset(self, target: str, path: str, local: os.stat_result) -> int:
+        with self.lock:
+            row = (
+                self._open()
+                .execute(
+                    "SELECT size, mtime_ns, offset FROM partial "
+                    "WHERE target = ? AND path = ?",
+                    (target, path),
+                )
+                .fetchone()
+            )
+        if row is None or (row[0], row[1]) != (local.st_size, local.st_mtime_ns):
+            return 0
+        return row[2]
+
+    def checkpoint(self, target: str, path: str, local: os.stat_result, offset: int):
+        with self.lock:
+            self._open().execute(
+                "INSERT OR REPLACE INTO partial VALUES (?, ?, ?, ?, ?)",
+                (target, path, local.st_size, local.st_mtime_ns, offset),
+            )
+            self._commit(True)
+
+    def close(self):
+        if self.db is None:
+            return
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+        if self.resumed > 0:
+            log.info(
+                "Journal skipped {} files sent by an earlier run".format(self.resumed)
+            )
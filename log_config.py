@@ -1,14 +1,42 @@
+import atexit
 import logging
+import queue
 import sys
+from logging.handlers import QueueHandler, QueueListener
 
 FORMATTER = logging.Formatter("%(asctime)s — %(name)s — %(levelname)s — %(message)s")
 Log_Only = False
 Log_File = ""
+# One line per transferred or skipped file goes here, its level is set on its
+# own so big runs can leave it out without losing the rest of the log
+FILE_LOGGER = "Files"
+
+
+class BelowWarning(logging.Filter):
+    # Warnings and errors go to stderr only, not to both streams
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno < logging.WARNING
+
+
+class LazyQueueHandler(QueueHandler):
+    # The record is formatted by the listener thread, the caller only pays for
+    # putting it on the queue
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+# Every logger shares the one queue handler, the listener thread owns the
+# console or file handlers and does all the writing
+Log_Queue: queue.SimpleQueue = queue.SimpleQueue()
+Queue_Handler: LazyQueueHandler = LazyQueueHandler(Log_Queue)
+Listener: QueueListener | None = None
+
 
 def get_stdout_handler() -> logging.StreamHandler:
     stdout_console = logging.StreamHandler(sys.stdout)
     stdout_console.setFormatter(FORMATTER)
     stdout_console.setLevel(logging.DEBUG)
+    stdout_console.addFilter(BelowWarning())
     return stdout_console
 
 
@@ -25,29 +53,59 @@ def get_file_handler(filename: str) -> logging.FileHandler:
     return file_handler
 
 
+def start_listener(*handlers: logging.Handler):
+    global Listener
+    stop_listener()
+    Listener = QueueListener(Log_Queue, *handlers, respect_handler_level=True)
+    Listener.start()
+
+
+def stop_listener():
+    # Writes out whatever is still queued
+    global Listener
+    if Listener is None:
+        return
+    Listener.stop()
+    for handler in Listener.handlers:
+        handler.close()
+    Listener = None
+
+
+atexit.register(stop_listener)
+
+
+def attach(logger_name: str) -> logging.Logger:
+    logger = logging.getLogger(logger_name)
+    if logger_name != FILE_LOGGER:
+        logger.setLevel(logging.DEBUG)
+    elif logger.level == logging.NOTSET:
+        logger.setLevel(logging.INFO)
+    if Queue_Handler not in logger.handlers:
+        logger.addHandler(Queue_Handler)
+    logger.propagate = False
+    return logger
+
+
+# The destination is shared by every logger, including the ones modules made
+# on import before main picked it
 def get_logger_console_only(logger_name: str) -> logging.Logger:
     global Log_Only
     global Log_File
-    logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(get_stdout_handler())
-    logger.addHandler(get_stderr_handler())
-    logger.propagate = False
+    if Listener is None or Log_Only:
+        start_listener(get_stdout_handler(), get_stderr_handler())
     Log_Only = False
     Log_File = ""
-    return logger
+    return attach(logger_name)
 
 
 def get_logger_file_only(logger_name: str, filename: str) -> logging.Logger:
     global Log_Only
     global Log_File
-    logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.DEBUG)
-    logger.addHandler(get_file_handler(filename))
-    logger.propagate = False
+    if Listener is None or not Log_Only or Log_File != filename:
+        start_listener(get_file_handler(filename))
     Log_Only = True
     Log_File = filename
-    return logger
+    return attach(logger_name)
 
 
 def get_logger(logger_name: str) -> logging.Logger:
@@ -57,3 +115,13 @@ def get_logger(logger_name: str) -> logging.Logger:
         return get_logger_file_only(logger_name, Log_File)
     else:
         return get_logger_console_only(logger_name)
+
+
+def get_file_logger() -> logging.Logger:
+    return get_logger(FILE_LOGGER)
+
+
+def set_file_level(level: int | str):
+    if isinstance(level, str):
+        level = level.upper()
+    get_file_logger().setLevel(level)
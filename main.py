@@ -1,30 +1,139 @@
 import argparse
+import compression
+import dedupe
+import hash_cache
+import incremental
+import journal
 import log_config
+import preflight
+import read_config
+import scheduler
+import sys
 
+BACKEND_THREAD = "thread"
+BACKEND_ASYNCIO = "asyncio"
+BACKENDS: list[str] = [BACKEND_THREAD, BACKEND_ASYNCIO]
 
-def main(input_file: str, log_file):
+
+def main(
+    input_file: str,
+    log_file,
+    workers: int = 1,
+    sync_mode: str = incremental.SYNC_OFF,
+    hash_cache_path: str | None = hash_cache.DEFAULT_CACHE_PATH,
+    delta_min_mb: int = 0,
+    tar_mode: bool = False,
+    compress: str | None = None,
+    window: int = 1,
+    relay_fanout: int = 0,
+    preserve_owner: bool = False,
+    backend: str = BACKEND_THREAD,
+    script_timeout: float = 0,
+    max_failures: int = 0,
+    schedule: bool = False,
+    rate_mb: float = scheduler.DEFAULT_RATE_MB,
+    metrics_json: str | None = None,
+    metrics_prom: str | None = None,
+    check: bool = False,
+    file_log_level: str = "info",
+    journal_path: str | None = None,
+    resume: bool = False,
+    probe: bool = True,
+    probe_timeout: float = preflight.PROBE_TIMEOUT,
+    dedupe_mode: str = dedupe.DEDUPE_OFF,
+    stop_on_script_failure: bool = False,
+) -> bool:
     if log_file is None or len(log_file) == 0:
         main_logger = log_config.get_logger_console_only("main")
         main_logger.info("Log to console only")
     else:
         main_logger = log_config.get_logger_file_only("main", log_file)
         main_logger.info("Logging to file")
-
-    # Now start the import
-    import read_config
+    log_config.set_file_level(file_log_level)
 
     if input_file is None:
         main_logger.error("Input File is None")
+        return False
+    elif check:
+        return check_config(input_file, main_logger)
     else:
-        config = read_config.DisserImport(args.input_file)
+        disser = None
+        if backend == BACKEND_ASYNCIO:
+            import async_disser
+
+            if not async_disser.available():
+                main_logger.error(
+                    "The asyncio backend needs asyncssh, install it with 'pip install asyncssh'."
+                )
+                return False
+            disser = async_disser.AsyncDisser()
+        config = read_config.DisserImport(input_file, disser)
         import_ok = config.import_config()
+        succeeded: bool = False
+        config.disser.max_workers = max(1, workers)
+        config.disser.sync_mode = sync_mode
+        config.disser.delta_min_size = max(0, delta_min_mb) * 1024 * 1024
+        config.disser.tar_mode = tar_mode
+        config.disser.window = max(1, window)
+        config.disser.relay_fanout = max(0, relay_fanout)
+        config.disser.preserve_owner = preserve_owner
+        if script_timeout > 0:
+            config.disser.script_timeout = script_timeout
+        config.disser.max_failures = max(0, max_failures)
+        config.disser.stop_on_script_failure = stop_on_script_failure
+        config.disser.schedule = schedule
+        config.disser.dedupe_mode = dedupe_mode
+        config.disser.schedule_rate = max(0, rate_mb)
+        if compress is not None:
+            config.disser.compression = compression.parse_compression(compress)
+        if hash_cache_path is not None and len(hash_cache_path) > 0:
+            config.disser.hash_cache = hash_cache.HashCache(hash_cache_path)
+        # The journal hashes every file it records, only runs that may be
+        # resumed pay for it
+        if resume and (journal_path is None or len(journal_path) == 0):
+            journal_path = journal.DEFAULT_JOURNAL_PATH
+        if journal_path is not None and len(journal_path) > 0:
+            config.disser.journal = journal.Journal(journal_path)
+            config.disser.resume = resume
 
         if import_ok:
             main_logger.info("Successfully loaded configuration.")
-            config.disser.transfer_files()
-            config.disser.run_scripts()
+            try:
+                if probe:
+                    config.disser.probe_targets(probe_timeout)
+                transferred = config.disser.transfer_files()
+                ran = config.disser.run_scripts()
+                # A target that failed fails the run, so callers can tell
+                succeeded = all(transferred.values()) and all(ran.values())
+            finally:
+                config.disser.close()
+                if metrics_json is not None and len(metrics_json) > 0:
+                    config.disser.metrics.write_json(metrics_json)
+                if metrics_prom is not None and len(metrics_prom) > 0:
+                    config.disser.metrics.write_prometheus(metrics_prom)
         else:
             main_logger.error("Failed to import configuration.")
+        return succeeded
+
+
+def check_config(input_file: str, main_logger) -> bool:
+    # Parses and validates like a real run, but never connects to a target
+    config = read_config.DisserImport(input_file)
+    import_ok: bool = config.import_config()
+    invalid: list[str] = [
+        source.input for source in config.disser.source_data if not source.is_valid
+    ]
+    if len(invalid) > 0:
+        main_logger.error("Invalid sources: {}".format(", ".join(invalid)))
+    if import_ok and len(invalid) == 0:
+        main_logger.info(
+            "Configuration is valid: {} sources, {} targets.".format(
+                len(config.disser.source_data), len(config.disser.targets)
+            )
+        )
+        return True
+    main_logger.error("Configuration is invalid.")
+    return False
 
 
 if __name__ == "__main__":
@@ -42,5 +151,215 @@ if __name__ == "__main__":
     parser.add_argument(
         "-l", "--log", dest="log_file", required=False, help="Log output of disser"
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        dest="workers",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of targets to transfer to and run scripts on concurrently.",
+    )
+    parser.add_argument(
+        "-s",
+        "--sync",
+        dest="sync_mode",
+        choices=incremental.SYNC_MODES,
+        default=incremental.SYNC_OFF,
+        required=False,
+        help="Skip files whose remote copy already matches by size and mtime, or by hash.",
+    )
+    parser.add_argument(
+        "--hash-cache",
+        dest="hash_cache_path",
+        default=hash_cache.DEFAULT_CACHE_PATH,
+        required=False,
+        help="Cache of local file digests reused between runs. Empty to disable.",
+    )
+    parser.add_argument(
+        "--delta-min-mb",
+        dest="delta_min_mb",
+        type=int,
+        default=0,
+        required=False,
+        help="Send only changed blocks of files at least this many MiB that already exist on the target. Requires python3 on the target. 0 disables.",
+    )
+    parser.add_argument(
+        "--tar",
+        dest="tar_mode",
+        action="store_true",
+        required=False,
+        help="Stream files and directories to each target through a single remote tar process. Requires tar on the target.",
+    )
+    parser.add_argument(
+        "-z",
+        "--compression",
+        dest="compression",
+        required=False,
+        help="Default on the wire compression for files, e.g. gzip, gzip:9 or zstd:3. Per file 'compression' in the config overrides it. Requires gzip or zstd on the target.",
+    )
+    parser.add_argument(
+        "--window",
+        dest="window",
+        type=int,
+        default=1,
+        required=False,
+        help="Number of file uploads kept in flight to each target over its one SSH session. Raise it for high latency targets.",
+    )
+    parser.add_argument(
+        "--relay",
+        dest="relay_fanout",
+        type=int,
+        default=0,
+        required=False,
+        help="Send files directly to only this many targets and let each target forward them to this many more over ssh and tar. Targets must reach each other with ssh keys. 0 sends to every target directly.",
+    )
+    parser.add_argument(
+        "--preserve-owner",
+        dest="preserve_owner",
+        action="store_true",
+        required=False,
+        help="Give transferred files the same numeric owner and group they have locally. Usually needs root on the target.",
+    )
+    parser.add_argument(
+        "--backend",
+        dest="backend",
+        choices=BACKENDS,
+        default=BACKEND_THREAD,
+        required=False,
+        help="Work on targets with a thread each, or with asyncssh on one event loop for hundreds of targets. The asyncio backend sends plain SFTP without tar, delta, compression or relays.",
+    )
+    parser.add_argument(
+        "--script-timeout",
+        dest="script_timeout",
+        type=float,
+        default=0,
+        required=False,
+        help="Seconds each script may run before it is stopped and counted as failed. Requires coreutils timeout on the target. 0 waits forever.",
+    )
+    parser.add_argument(
+        "--max-failures",
+        dest="max_failures",
+        type=int,
+        default=0,
+        required=False,
+        help="Stop starting scripts on more targets once this many targets had a script fail. 0 runs on every target.",
+    )
+    parser.add_argument(
+        "--stop-on-script-failure",
+        dest="stop_on_script_failure",
+        action="store_true",
+        required=False,
+        help="Skip the remaining scripts on a target once one of them fails or times out. By default every script runs.",
+    )
+    parser.add_argument(
+        "--schedule",
+        dest="schedule",
+        action="store_true",
+        required=False,
+        help="Size every source before sending and send the largest files first so no upload channel sits idle behind one big file. Logs an estimate of the bytes and time up front.",
+    )
+    parser.add_argument(
+        "--rate-mb",
+        dest="rate_mb",
+        type=float,
+        default=scheduler.DEFAULT_RATE_MB,
+        required=False,
+        help="MiB/s one upload channel is expected to reach, only used for the --schedule estimate.",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        dest="metrics_json",
+        required=False,
+        help="Write connect times, bytes, durations, throughput and retries of every phase and target, and the slowest files, to this JSON file.",
+    )
+    parser.add_argument(
+        "--metrics-prom",
+        dest="metrics_prom",
+        required=False,
+        help="Write the phase and target metrics as a Prometheus textfile, e.g. for the node exporter textfile collector.",
+    )
+    parser.add_argument(
+        "--check",
+        dest="check",
+        action="store_true",
+        required=False,
+        help="Only parse and validate the configuration and its sources, without connecting to any target. Exits with 1 when it is invalid.",
+    )
+    parser.add_argument(
+        "--file-log-level",
+        dest="file_log_level",
+        choices=["debug", "info", "warning"],
+        default="info",
+        required=False,
+        help="Level of the one line per file messages. warning leaves them out of the log on big runs.",
+    )
+    parser.add_argument(
+        "--journal",
+        dest="journal_path",
+        default=None,
+        required=False,
+        help="Record the files sent to each target and how far large uploads got in this file, so a later run can resume. Off unless given or --resume is used.",
+    )
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        required=False,
+        help="Record progress in the journal, by default {}, and skip files an interrupted earlier run with --resume or --journal already sent, continuing its large uploads where they stopped. Tar streams are always sent whole.".format(
+            journal.DEFAULT_JOURNAL_PATH
+        ),
+    )
+    parser.add_argument(
+        "--no-preflight",
+        dest="probe",
+        action="store_false",
+        required=False,
+        help="Do not probe every target for reachability and login before the transfer. Unreachable targets then cost a full connect timeout each.",
+    )
+    parser.add_argument(
+        "--probe-timeout",
+        dest="probe_timeout",
+        type=float,
+        default=preflight.PROBE_TIMEOUT,
+        required=False,
+        help="Seconds the preflight waits for each target to accept a connection. Targets that do not are skipped for the run.",
+    )
+    parser.add_argument(
+        "--dedupe",
+        dest="dedupe_mode",
+        choices=dedupe.DEDUPE_MODES,
+        default=dedupe.DEDUPE_OFF,
+        required=False,
+        help="Send files with the same contents once per target and make the other paths from it remotely, as a copy (cp --reflink=auto), a hardlink or a symlink. Links share the mode and time of the file sent.",
+    )
     args = parser.parse_args()
-    main(args.input_file, args.log_file)
+    ok = main(
+        args.input_file,
+        args.log_file,
+        args.workers,
+        args.sync_mode,
+        args.hash_cache_path,
+        args.delta_min_mb,
+        args.tar_mode,
+        args.compression,
+        args.window,
+        args.relay_fanout,
+        args.preserve_owner,
+        args.backend,
+        args.script_timeout,
+        args.max_failures,
+        args.schedule,
+        args.rate_mb,
+        args.metrics_json,
+        args.metrics_prom,
+        args.check,
+        args.file_log_level,
+        args.journal_path,
+        args.resume,
+        args.probe,
+        args.probe_timeout,
+        args.dedupe_mode,
+        args.stop_on_script_failure,
+    )
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,229 @@
+import heapq
+import json
+import log_config
+import logging
+import os
+import threading
+from incremental import TransferStats
+from typing import NamedTuple
+
+log: logging.Logger = log_config.get_logger("Metrics")
+
+# Per file records kept for the JSON export, the slowest ones win so memory
+# stays flat on sources with millions of files
+FILE_RECORDS: int = 1000
+
+METHOD_SFTP = "sftp"
+METHOD_DELTA = "delta"
+METHOD_COMPRESSED = "compressed"
+
+
+class FileMetric(NamedTuple):
+    target: str
+    path: str
+    method: str
+    bytes: int
+    seconds: float
+    retries: int
+
+
+class PhaseMetric(NamedTuple):
+    seconds: float
+    success: bool
+
+
+class TargetMetrics:
+    def __init__(self, name: str) -> None:
+        self.name: str = name
+        self.lock: threading.Lock = threading.Lock()
+        self.connects: int = 0
+        self.connect_seconds: float = 0.0
+        self.upload_seconds: float = 0.0
+        self.retries: int = 0
+        self.phases: dict[str, PhaseMetric] = {}
+        # Sent and skipped counts of the last transfer to this target
+        self.stats: TransferStats | None = None
+
+    def connected(self, seconds: float):
+        with self.lock:
+            self.connects += 1
+            self.connect_seconds += seconds
+
+    def uploaded(self, seconds: float, retries: int):
+        with self.lock:
+            self.upload_seconds += seconds
+            self.retries += retries
+
+    def phase(self, phase: str, seconds: float, success: bool):
+        with self.lock:
+            self.phases[phase] = PhaseMetric(seconds, success)
+
+    def throughput(self) -> float:
+        transfer: PhaseMetric | None = self.phases.get("transfer")
+        if self.stats is None or transfer is None or transfer.seconds <= 0:
+            return 0.0
+        return self.stats.bytes_sent / transfer.seconds
+
+    def _to_dict(self) -> dict:
+        result: dict = {
+            "connects": self.connects,
+            "connect_seconds": self.connect_seconds,
+            "upload_seconds": self.upload_seconds,
+            "retries": self.retries,
+            "throughput_bytes_per_second": self.throughput(),
+            "phases": {
+                phase: {"seconds": metric.seconds, "success": metric.success}
+                for phase, metric in self.phases.items()
+            },
+        }
+        if self.stats is not None:
+            result.update(
+                files_sent=self.stats.files_sent,
+                bytes_sent=self.stats.bytes_sent,
+                files_skipped=self.stats.files_skipped,
+                bytes_skipped=self.stats.bytes_skipped,
+                files_copied=self.stats.files_copied,
+                bytes_copied=self.stats.bytes_copied,
+            )
+        return result
+
+
+class Metrics:
+    # Timings, byte counts and retries of one run, for every phase, every
+    # target and the slowest files, exported as JSON or a Prometheus textfile
+    def __init__(self, file_records: int = FILE_RECORDS) -> None:
+        self.lock: threading.Lock = threading.Lock()
+        self.file_records: int = file_records
+        self.phases: dict[str, float] = {}
+        self.targets: dict[str, TargetMetrics] = {}
+        self.slowest: list[tuple[float, int, FileMetric]] = []
+        self.files: int = 0
+
+    def target(self, name: str) -> TargetMetrics:
+        with self.lock:
+            if name not in self.targets:
+                self.targets[name] = TargetMetrics(name)
+            return self.targets[name]
+
+    def phase(self, phase: str, seconds: float):
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def file(self, metric: FileMetric):
+        self.target(metric.target).uploaded(metric.seconds, metric.retries)
+        with self.lock:
+            self.files += 1
+            # The counter breaks ties so file records are never compared
+            entry = (metric.seconds, self.files, metric)
+            if len(self.slowest) < self.file_records:
+                heapq.heappush(self.slowest, entry)
+            elif self.file_records > 0:
+                heapq.heappushpop(self.slowest, entry)
+
+    def _to_dict(self) -> dict:
+        with self.lock:
+            targets: list[TargetMetrics] = list(self.targets.values())
+            slowest: list[FileMetric] = [
+                entry[2] for entry in sorted(self.slowest, reverse=True)
+            ]
+            phases: dict[str, float] = dict(self.phases)
+        return {
+            "phases": phases,
+            "targets": {target.name: target._to_dict() for target in targets},
+            "files_recorded": self.files,
+            "slowest_files": [
+                dict(metric._asdict(), bytes_per_second=rate(metric))
+                for metric in slowest
+            ],
+        }
+
+    def write_json(self, path: str):
+        write_atomic(path, json.dumps(self._to_dict(), indent=2) + "\n")
+        log.info("Wrote metrics to {}".format(path))
+
+    def write_prometheus(self, path: str):
+        # Per file series would have unbounded labels, those stay in the JSON
+        data: dict = self._to_dict()
+        lines: list[str] = []
+        gauge(
+            lines,
+            "disser_phase_seconds",
+            "Wall time of each phase.",
+            [({"phase": phase}, seconds) for phase, seconds in data["phases"].items()],
+        )
+        targets: dict[str, dict] = data["targets"]
+        for key, help in (
+            ("connects", "Connections opened to the target."),
+            ("connect_seconds", "Time spent opening connections to the target."),
+            ("upload_seconds", "Time spent in SFTP, delta and compressed uploads."),
+            ("retries", "Upload retries to the target."),
+            ("files_sent", "Files sent to the target."),
+            ("bytes_sent", "Bytes sent to the target."),
+            ("files_skipped", "Unchanged files skipped on the target."),
+            ("bytes_skipped", "Bytes of unchanged files skipped on the target."),
+            ("files_copied", "Duplicate files made on the target instead of sent."),
+            ("bytes_copied", "Bytes of duplicate files made on the target."),
+            ("throughput_bytes_per_second", "Bytes sent over transfer phase time."),
+        ):
+            gauge(
+                lines,
+                "disser_target_" + key,
+                help,
+                [
+                    ({"target": name}, values[key])
+                    for name, values in targets.items()
+                    if key in values
+                ],
+            )
+        for key, help in (
+            ("seconds", "Time each phase took on the target."),
+            ("success", "1 when the phase succeeded on the target."),
+        ):
+            gauge(
+                lines,
+                "disser_target_phase_" + key,
+                help,
+                [
+                    ({"target": name, "phase": phase}, float(metric[key]))
+                    for name, values in targets.items()
+                    for phase, metric in values["phases"].items()
+                ],
+            )
+        write_atomic(path, "\n".join(lines) + "\n")
+        log.info("Wrote Prometheus metrics to {}".format(path))
+
+
+def rate(metric: FileMetric) -> float:
+    return metric.bytes / metric.seconds if metric.seconds > 0 else 0.0
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def gauge(
+    lines: list[str], name: str, help: str, samples: list[tuple[dict[str, str], float]]
+):
+    if len(samples) == 0:
+        return
+    lines.append("# HELP {} {}".format(name, help))
+    lines.append("# TYPE {} gauge".format(name))
+    for labels, value in samples:
+        lines.append(
+            "{}{{{}}} {}".format(
+                name,
+                ",".join(
+                    '{}="{}"'.format(key, escape_label(label))
+                    for key, label in labels.items()
+                ),
+                repr(float(value)),
+            )
+        )
+
+
+def write_atomic(path: str, text: str):
+    # The node exporter textfile collector must never see half a file
+    temporary: str = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "w") as output:
+        output.write(text)
+    os.replace(temporary, path)
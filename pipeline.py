@@ -0,0 +1,220 @@
+from __future__ import annotations
+import errno
+import log_config
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from paramiko import SFTPClient, Transport
+
+log: logging.Logger = log_config.get_logger("Pipeline")
+
+PUT_TRIES: int = 5
+RETRY_DELAY: float = 1.0
+# Uploads queued per channel before submit blocks, keeps memory flat
+QUEUE_DEPTH: int = 2
+# errno values and SFTP status codes a retry will not fix: no such file,
+# permission denied, write protect, no space and quota exceeded
+PERMANENT_ERRNOS: frozenset[int] = frozenset(
+    (errno.ENOENT, errno.EACCES, errno.EPERM, errno.EROFS, errno.ENOSPC, errno.EDQUOT)
+)
+PERMANENT_SFTP_CODES: frozenset[int] = frozenset((2, 3, 12, 14, 15))
+# Same read size paramiko uses for put
+READ_SIZE: int = 32768
+
+
+def retryable(error: Exception) -> bool:
+    # paramiko raises errno values, asyncssh keeps the SFTP status code
+    if getattr(error, "errno", None) in PERMANENT_ERRNOS:
+        return False
+    return getattr(error, "code", None) not in PERMANENT_SFTP_CODES
+
+
+def break_link(client: SFTPClient, path: str):
+    # Writing in place follows a symlink and writes through a hardlink into
+    # every other name of the file, like duplicates made by an earlier run.
+    # Removing it first makes the upload a new file under this name only.
+    try:
+        client.remove(path)
+    except IOError:
+        # Missing, or a directory that only allows writing the file, the
+        # upload itself reports anything that matters
+        pass
+
+
+def put_file(
+    client: SFTPClient, source: str, destination: str, tries: int = PUT_TRIES
+) -> int:
+    # Returns how many retries the upload needed
+    delay: float = RETRY_DELAY
+    for attempt in range(1, tries + 1):
+        try:
+            client.put(source, destination, confirm=True)
+            return attempt - 1
+        except IOError as e:
+            if (
+                attempt == tries
+                or not retryable(e)
+                or not client.get_channel().get_transport().is_active()
+            ):
+                raise
+            log.warn(
+                "Upload of ({}) failed, retry {} of {}. {}".format(
+                    destination, attempt, tries - 1, e
+                )
+            )
+            time.sleep(delay)
+            delay *= 2
+
+
+def put_resumable(
+    client: SFTPClient,
+    source: str,
+    destination: str,
+    offset: int,
+    checkpoint: Callable[[int], None],
+    every: int,
+    tries: int = PUT_TRIES,
+) -> int:
+    # Like put_file, but starts at offset and reports how far it got every
+    # so many bytes. A failed attempt continues from what the target has.
+    size: int = os.stat(source).st_size
+    delay: float = RETRY_DELAY
+    # Furthest checkpoint of any attempt, everything before it has landed
+    reached: list[int] = [offset]
+
+    def record(position: int):
+        reached[0] = position
+        checkpoint(position)
+
+    for attempt in range(1, tries + 1):
+        try:
+            send_from(client, source, destination, offset, record, every)
+            remote: int = client.stat(destination).st_size
+            if remote != size:
+                raise IOError("size mismatch in put!  {} != {}".format(remote, size))
+            return attempt - 1
+        except IOError as e:
+            if (
+                attempt == tries
+                or not retryable(e)
+                or not client.get_channel().get_transport().is_active()
+            ):
+                raise
+            log.warn(
+                "Upload of ({}) failed, retry {} of {}. {}".format(
+                    destination, attempt, tries - 1, e
+                )
+            )
+            time.sleep(delay)
+            delay *= 2
+            offset = remote_size(client, destination, reached[0])
+
+
+def remote_size(client: SFTPClient, path: str, limit: int) -> int:
+    # Bytes past the last checkpoint may not have landed, never go beyond it
+    try:
+        return min(limit, client.stat(path).st_size)
+    except IOError:
+        return 0
+
+
+def send_from(
+    client: SFTPClient,
+    source: str,
+    destination: str,
+    offset: int,
+    checkpoint: Callable[[int], None],
+    every: int,
+):
+    with open(source, "rb") as local, client.open(
+        destination, "r+b" if offset > 0 else "wb"
+    ) as remote:
+        remote.set_pipelined(True)
+        local.seek(offset)
+        remote.seek(offset)
+        next_checkpoint: int = offset + every
+        for chunk in iter(lambda: local.read(READ_SIZE), b""):
+            remote.write(chunk)
+            offset += len(chunk)
+            if offset >= next_checkpoint:
+                # Only sent, not acknowledged. Resuming caps the offset with
+                # the remote size, so bytes that never landed are sent again.
+                remote.flush()
+                checkpoint(offset)
+                next_checkpoint = offset + every
+
+
+class PipelinedUploader:
+    # Several uploads in flight over one transport, each worker thread owns
+    # its own SFTP channel because a paramiko SFTPClient is not thread safe.
+    def __init__(self, transport: Transport, window: int) -> None:
+        self.transport: Transport = transport
+        self.window: int = max(1, window)
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=self.window, thread_name_prefix="upload"
+        )
+        self.capacity: int = self.window * QUEUE_DEPTH
+        self.slots: threading.BoundedSemaphore = threading.BoundedSemaphore(
+            self.capacity
+        )
+        self.local: threading.local = threading.local()
+        self.lock: threading.Lock = threading.Lock()
+        self.clients: list[SFTPClient] = []
+        self.failed: bool = False
+
+    def client(self) -> SFTPClient:
+        client: SFTPClient | None = getattr(self.local, "client", None)
+        if client is None:
+            from paramiko import SFTPClient
+
+            client = SFTPClient.from_transport(self.transport)
+            self.local.client = client
+            with self.lock:
+                self.clients.append(client)
+        return client
+
+    def _run(self, description: str, job: Callable[[SFTPClient], None]):
+        try:
+            job(self.client())
+        except Exception as e:
+            log.error("Failed to transfer {}".format(description))
+            log.exception(e)
+            with self.lock:
+                self.failed = True
+        finally:
+            self.slots.release()
+
+    def submit(self, description: str, job: Callable[[SFTPClient], None]):
+        self.slots.acquire()
+        try:
+            self.executor.submit(self._run, description, job)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def wait(self) -> bool:
+        # Every slot free means nothing is queued or in flight
+        for _ in range(self.capacity):
+            self.slots.acquire()
+        for _ in range(self.capacity):
+            self.slots.release()
+        with self.lock:
+            success: bool = not self.failed
+            self.failed = False
+        return success
+
+    def close(self) -> bool:
+        success: bool = self.wait()
+        self.executor.shutdown(wait=True)
+        for client in self.clients:
+            try:
+                client.close()
+            except Exception as e:
+                log.exception(e)
+        self.clients = []
+        return success
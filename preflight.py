@@ -0,0 +1,100 @@
+import log_config
+import logging
+import socket
+import threading
+import time
+from server_data import Server
+
+log: logging.Logger = log_config.get_logger("Preflight")
+
+# Seconds a probe waits for a target to accept a TCP connection
+PROBE_TIMEOUT: float = 5.0
+# Probes mostly wait on the network, so far more run at once than transfers
+PROBE_WORKERS: int = 64
+# Failed connects in a row after which a target is left alone for the run
+MAX_CONNECT_FAILURES: int = 3
+# Wait before connecting again after a failure, doubled on each one
+BACKOFF_SECONDS: float = 2.0
+BACKOFF_MAX: float = 60.0
+
+
+class HostUnavailable(Exception):
+    # Raised instead of connecting to a quarantined target
+    pass
+
+
+def probe_tcp(server: Server, timeout: float = PROBE_TIMEOUT) -> str | None:
+    # Returns why the target cannot be reached, None when it accepts
+    port: int = 22
+    if server.port is not None:
+        port = int(server.port)
+    try:
+        with socket.create_connection((str(server.hostname), port), timeout):
+            return None
+    except socket.timeout:
+        return "no answer on port {} within {}s".format(port, timeout)
+    except OSError as e:
+        return "{} on port {}".format(e.strerror or e, port)
+
+
+class HostHealth:
+    # Connect failures of every target. A target that failed is only connected
+    # to again once its backoff ran out, and after MAX_CONNECT_FAILURES in a
+    # row, or a failed preflight, it is quarantined for the rest of the run.
+    def __init__(
+        self,
+        max_failures: int = MAX_CONNECT_FAILURES,
+        backoff: float = BACKOFF_SECONDS,
+    ) -> None:
+        self.lock: threading.Lock = threading.Lock()
+        self.max_failures: int = max(1, max_failures)
+        self.backoff: float = backoff
+        self.failures: dict[str, int] = {}
+        self.retry_at: dict[str, float] = {}
+        # Target name to the reason it was quarantined
+        self.quarantined: dict[str, str] = {}
+
+    def is_quarantined(self, name: str) -> bool:
+        with self.lock:
+            return name in self.quarantined
+
+    def check(self, server: Server):
+        # Called before connecting, waits out the backoff of this target only
+        with self.lock:
+            reason: str | None = self.quarantined.get(server.name)
+            wait: float = self.retry_at.get(server.name, 0.0) - time.monotonic()
+        if reason is not None:
+            raise HostUnavailable(
+                "Server ({}) is quarantined: {}".format(server.name, reason)
+            )
+        if wait > 0:
+            log.info(
+                "Server ({}) backing off {:.1f}s before reconnecting".format(
+                    server.name, wait
+                )
+            )
+            time.sleep(wait)
+
+    def succeeded(self, server: Server):
+        with self.lock:
+            self.failures.pop(server.name, None)
+            self.retry_at.pop(server.name, None)
+
+    def failed(self, server: Server, error: Exception):
+        with self.lock:
+            count: int = self.failures.get(server.name, 0) + 1
+            self.failures[server.name] = count
+            self.retry_at[server.name] = time.monotonic() + min(
+                BACKOFF_MAX, self.backoff * 2 ** (count - 1)
+            )
+        if count >= self.max_failures:
+            self.quarantine(
+                server, "{} connects failed in a row, last: {}".format(count, error)
+            )
+
+    def quarantine(self, server: Server, reason: str):
+        with self.lock:
+            if server.name in self.quarantined:
+                return
+            self.quarantined[server.name] = reason
+        log.error("Server ({}) quarantined: {}".format(server.name, reason))
@@ -1,5 +1,6 @@
 import yaml
 import os
+import compression
 import log_config
 import logging
 import server_data
@@ -8,11 +9,29 @@ from source_data import SourceData
 
 log: logging.Logger = log_config.get_logger("DisserImport")
 
+# Keys allowed next to the filename in a file entry
+FILE_OPTION_KEYS: list[str] = ["destination", "compression", "include", "exclude"]
+
+
+def parse_patterns(value) -> list[str] | None:
+    if type(value) is str:
+        value = [value]
+    if type(value) is not list or len(value) == 0:
+        log.error("Patterns ({}) are not a str or a non empty list.".format(value))
+        return None
+    for pattern in value:
+        if type(pattern) is not str or len(pattern) == 0:
+            log.error("Pattern ({}) is not a non empty str.".format(pattern))
+            return None
+    return value
+
 
 class DisserImport:
-    def __init__(self, filename: str) -> None:
+    def __init__(self, filename: str, disser: Disser | None = None) -> None:
         self.filename = filename
-        self.disser: Disser = Disser()
+        self.disser: Disser = disser or Disser()
+        # Groups can name a host that is also listed on its own
+        self.target_names: set[str] = set()
 
     def import_config(self) -> bool:
         if self.filename is None:
@@ -111,11 +130,11 @@ class DisserImport:
                     log.error("Unable to parse file {} with desination.".format(file))
                 else:
                     log.info(
-                        "Adding source item {} with destination {}.".format(
-                            parse[0], parse[1]
+                        "Adding source item {} with destination {} and options {}.".format(
+                            parse[0], parse[1], parse[2]
                         )
                     )
-                    self.disser.add_file_source(parse[0], parse[1])
+                    self.disser.add_file_source(parse[0], parse[1], **parse[2])
                     tags_parsed += 1
             else:
                 log.error(
@@ -129,41 +148,59 @@ class DisserImport:
     def parse_file_with_destination(self, file: dict):
         filename: str = ""
         destination: str = ""
-        if len(file) != 2:
+        options: dict = {}
+        filenames: list = [fd for fd in file if fd not in FILE_OPTION_KEYS]
+        if len(filenames) != 1:
             log.error(
-                "Invalid file '{}' from dict item. Requires 2 items, but has {}.".format(
-                    file, len(file)
+                "Invalid file '{}' from dict item. Requires exactly 1 filename, but has {}.".format(
+                    file, len(filenames)
                 )
             )
             return None
-        if file.get("destination") is None:
-            log.error(
-                "Missing destination key. Keys present are '{}'".format(file.keys())
-            )
-            return None
-        if type(file["destination"]) is not str:
+        if len(file) < 2:
             log.error(
-                "Destination is not str type. Type is {}".format(
-                    type(file["destination"])
+                "Missing destination or option keys. Keys present are '{}'".format(
+                    file.keys()
                 )
             )
             return None
 
-        destination = file["destination"]
-        # Not sure we need this
-        if len(destination) == 0:
-            log.error("Destination empty for {}".format(file))
-            return None
+        if "destination" in file:
+            if type(file["destination"]) is not str:
+                log.error(
+                    "Destination is not str type. Type is {}".format(
+                        type(file["destination"])
+                    )
+                )
+                return None
 
-        for fd in file:
-            if fd != "destination":
-                if len(fd) == 0:
-                    log.error("Filename must not be blank")
+            destination = file["destination"]
+            # Not sure we need this
+            if len(destination) == 0:
+                log.error("Destination empty for {}".format(file))
+                return None
+
+        if "compression" in file:
+            compress = compression.parse_compression(file["compression"])
+            if compress is None:
+                log.error("Invalid compression for {}".format(file))
+                return None
+            options["compression"] = compress
+
+        for key in ["include", "exclude"]:
+            if key in file:
+                patterns = parse_patterns(file[key])
+                if patterns is None:
+                    log.error("Invalid {} patterns for {}".format(key, file))
                     return None
-                else:
-                    filename = fd
+                options[key] = patterns
 
-        return (filename, destination)
+        filename = filenames[0]
+        if type(filename) is not str or len(filename) == 0:
+            log.error("Filename must not be blank")
+            return None
+
+        return (filename, destination, options)
 
     def parse_scripts_tag(self, scripts: list) -> bool:
         tags_parsed: int = 0
@@ -182,7 +219,13 @@ class DisserImport:
                             parse[0], parse[1]
                         )
                     )
-                    self.disser.add_file_source(parse[0], parse[1])
+                    if len(parse[2]) > 0:
+                        log.warn(
+                            "Options {} do not apply to script {}. Ignoring.".format(
+                                ", ".join(parse[2]), parse[0]
+                            )
+                        )
+                    self.disser.add_script_source(parse[0], parse[1])
                     tags_parsed += 1
             else:
                 log.error(
@@ -202,6 +245,8 @@ class DisserImport:
                         keys, type(targets[keys])
                     )
                 )
+            elif "hosts" in targets[keys]:
+                self.parse_group_tag(keys, targets[keys])
             else:
                 s = server_data.parse_server_tag(keys, targets[keys])
                 if s is None:
@@ -211,6 +256,31 @@ class DisserImport:
                         )
                     )
                 else:
-                    self.disser.add_server(s)
+                    self.add_server(s)
 
         return len(self.disser.targets) > 0
+
+    def parse_group_tag(self, name: str, group: dict):
+        parsed = server_data.parse_group_tag(name, group)
+        if parsed is None:
+            log.error("Group ({}) has an invalid configuration. Ignoring.".format(name))
+            return
+        count, servers = parsed
+        log.info("Expanding group ({}) of {} hosts".format(name, count))
+        added: int = 0
+        for server in servers:
+            if self.add_server(server):
+                added += 1
+        log.info("Group ({}) added {} of {} hosts".format(name, added, count))
+
+    def add_server(self, server: server_data.Server) -> bool:
+        if server.name in self.target_names:
+            log.error(
+                "Server ({}) is listed more than once. Ignoring the repeat.".format(
+                    server.name
+                )
+            )
+            return False
+        self.target_names.add(server.name)
+        self.disser.add_server(server)
+        return True
@@ -0,0 +1,117 @@
+import log_config
+import logging
+import os
+import posixpath
+import remote_dirs
+import shlex
+from server_data import Server
+from source_data import TransferItem
+from source_scanner import SourceScanner
+from tar_stream import TAR_EXTRACT_COMMAND
+from typing import Iterable, Iterator
+
+log: logging.Logger = log_config.get_logger("Relay")
+
+# Targets reach each other with their own keys, we cannot answer a prompt
+SSH_COMMAND: str = "ssh -o BatchMode=yes"
+# Bytes of the path list sent to a command at a time
+LIST_CHUNK_SIZE: int = 65536
+
+
+def build_tiers(
+    targets: list[Server], fanout: int
+) -> list[list[tuple[Server | None, Server]]]:
+    # Breadth first k-ary tree, the first fanout targets are fed by us (None)
+    # and target i >= fanout is fed by target i // fanout - 1
+    tiers: list[list[tuple[Server | None, Server]]] = []
+    depth_start: int = 0
+    width: int = fanout
+    while depth_start < len(targets):
+        tier: list[tuple[Server | None, Server]] = []
+        for index in range(depth_start, min(depth_start + width, len(targets))):
+            parent: Server | None = None
+            if index >= fanout:
+                parent = targets[index // fanout - 1]
+            tier.append((parent, targets[index]))
+        tiers.append(tier)
+        depth_start += width
+        width *= fanout
+    return tiers
+
+
+def planned_paths(
+    files: Iterable[TransferItem], scanner: SourceScanner
+) -> Iterator[str]:
+    # Remote path of every directory and file the plan uploads, read from the
+    # sources as it goes. Only these are relayed and compared, anything else
+    # on a target is left alone.
+    for file in files:
+        yield file.destination
+        if not file.is_directory:
+            continue
+        # put_r layout, the source lands in destination/<source name>
+        remote_root: str = posixpath.join(
+            file.destination, os.path.basename(file.source)
+        )
+        for directory in scanner.walk(file.source, file.source_filter):
+            remote_dir: str = remote_dirs.remote_directory(
+                remote_root, file.source, directory.path
+            )
+            yield remote_dir
+            for entry in directory.files:
+                yield posixpath.join(remote_dir, os.path.basename(entry.path))
+
+
+def path_list(paths: Iterable[str], relative: bool = False) -> Iterator[bytes]:
+    # NUL separated so any name gets through, in chunks so neither side holds
+    # the whole list and the command line length never matters
+    chunk: bytearray = bytearray()
+    for path in paths:
+        if relative:
+            path = path.lstrip("/") or "."
+        chunk += path.encode("utf-8", "surrogateescape") + b"\0"
+        if len(chunk) >= LIST_CHUNK_SIZE:
+            yield bytes(chunk)
+            chunk = bytearray()
+    if len(chunk) > 0:
+        yield bytes(chunk)
+
+
+def forward_command(child: Server) -> str:
+    # Takes path_list(planned_paths(...), True) on its stdin. Every directory
+    # is listed on its own, so nothing outside the plan is picked up.
+    create: str = "tar -c -p -f - -C / --null --no-recursion -T -"
+
+    ssh: str = SSH_COMMAND
+    if child.port is not None:
+        ssh += " -p {}".format(int(child.port))
+    if child.username is not None:
+        ssh += " -l {}".format(shlex.quote(child.username))
+    # A short stream makes the remote tar fail, the manifest check catches
+    # anything else
+    return "{} | {} {} {}".format(
+        create,
+        ssh,
+        shlex.quote(str(child.hostname)),
+        shlex.quote(TAR_EXTRACT_COMMAND),
+    )
+
+
+def _find_each(expression: str) -> str:
+    # find on every saved path alone, as many per find as fit on its command
+    # line
+    return 'xargs -0 -r sh -c \'find "$@" -maxdepth 0 {}\' sh < "$list"'.format(
+        expression
+    )
+
+
+def manifest_command() -> str:
+    # Takes path_list(planned_paths(...)) on its stdin. Digest of every path,
+    # its mode and its contents, equal on every host that holds the same
+    # payload. The list is read twice, so it is kept in a temporary file for
+    # the length of the command.
+    return (
+        'list=$(mktemp) || exit 1; trap \'rm -f "$list"\' EXIT; cat > "$list"; '
+        "{{ {} | LC_ALL=C sort; {} | LC_ALL=C sort -z "
+        "| xargs -0 -r sha256sum; }} | sha256sum"
+    ).format(_find_each('-printf "%m %p\\n"'), _find_each("-type f -print0"))
@@ -0,0 +1,98 @@
+from __future__ import annotations
+import log_config
+import logging
+import os
+import posixpath
+import remote_exec
+import shlex
+from itertools import islice
+from typing import Iterable, Iterator, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from paramiko import Transport
+    from sftpretty import Connection
+
+log: logging.Logger = log_config.get_logger("RemoteDirs")
+
+# Items or directories prepared together before their uploads start
+BATCH_SIZE: int = 256
+# Keep each mkdir well under the remote ARG_MAX
+MAX_COMMAND_LENGTH: int = 65536
+# Same 700 mode that sftpretty's mkdir_p gives new directories
+MKDIR_COMMAND: str = "umask 077 && mkdir -p --"
+
+
+def batched(items: Iterable, size: int = BATCH_SIZE) -> Iterator[list]:
+    iterator = iter(items)
+    while True:
+        batch: list = list(islice(iterator, size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def remote_directory(remote_root: str, source: str, directory: str) -> str:
+    # Where a directory under a put_r style source lands on the target
+    relative: str = os.path.relpath(directory, source)
+    if relative == ".":
+        return remote_root
+    return posixpath.join(remote_root, *relative.split(os.sep))
+
+
+class RemoteDirectories:
+    # Directories known to exist on one target, missing ones are queued and
+    # created with one mkdir -p instead of a stat and mkdir per level
+    def __init__(self) -> None:
+        self.known: set[str] = set()
+        self.pending: dict[str, None] = {}
+        self.created: int = 0
+
+    def exists(self, path: str):
+        while len(path) > 0 and path != "/" and path not in self.known:
+            self.known.add(path)
+            path = posixpath.dirname(path)
+
+    def ensure(self, path: str):
+        path = posixpath.normpath(path) if len(path) > 0 else path
+        if len(path) > 0 and path != "/" and path not in self.known:
+            self.pending[path] = None
+
+    def commands(self) -> list[str]:
+        # mkdir -p makes the parents, so only the deepest paths are needed
+        missing: list[str] = sorted(self.pending)
+        leaves: list[str] = [
+            path
+            for index, path in enumerate(missing)
+            if index + 1 == len(missing)
+            or not missing[index + 1].startswith(path + "/")
+        ]
+
+        commands: list[str] = []
+        command: str = MKDIR_COMMAND
+        for path in leaves:
+            argument: str = shlex.quote(path)
+            if len(command) + len(argument) + 1 > MAX_COMMAND_LENGTH:
+                commands.append(command)
+                command = MKDIR_COMMAND
+            command += " " + argument
+        if command != MKDIR_COMMAND:
+            commands.append(command)
+        return commands
+
+    def done(self):
+        for path in self.pending:
+            self.exists(path)
+        self.created += len(self.pending)
+        log.debug("Created {} remote directories".format(len(self.pending)))
+        self.pending = {}
+
+    def flush(self, ssh: Connection | Transport):
+        for command in self.commands():
+            result = remote_exec.run_command(ssh, command)
+            if result.exit_status != 0:
+                raise IOError(
+                    "Unable to create remote directories: {}".format(
+                        result.stderr.decode("utf-8", "replace").strip()
+                    )
+                )
+        self.done()
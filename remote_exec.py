@@ -0,0 +1,102 @@
+from __future__ import annotations
+import log_config
+import logging
+import select
+import time
+from typing import Callable, Iterable, NamedTuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from paramiko import Channel, Transport
+    from sftpretty import Connection
+
+log: logging.Logger = log_config.get_logger("RemoteExec")
+
+RECV_SIZE: int = 32768
+
+
+class CommandResult(NamedTuple):
+    exit_status: int
+    stdout: bytes
+    stderr: bytes
+
+
+def get_transport(ssh: Connection | Transport) -> Transport:
+    from paramiko import Transport
+
+    if isinstance(ssh, Transport):
+        return ssh
+    return ssh.sftp_client.get_channel().get_transport()
+
+
+def open_command(
+    ssh: Connection | Transport, command: str, timeout: float | None = None
+) -> Channel:
+    channel: Channel = get_transport(ssh).open_session(timeout=timeout)
+    channel.settimeout(timeout)
+    channel.exec_command(command)
+    return channel
+
+
+def drain(
+    channel: Channel,
+    on_stdout: Callable[[bytes], None],
+    on_stderr: Callable[[bytes], None],
+    timeout: float | None = None,
+):
+    deadline: float | None = None
+    if timeout is not None:
+        deadline = time.monotonic() + timeout
+    while True:
+        if channel.recv_ready():
+            on_stdout(channel.recv(RECV_SIZE))
+        elif channel.recv_stderr_ready():
+            on_stderr(channel.recv_stderr(RECV_SIZE))
+        elif channel.eof_received or channel.closed:
+            return
+        else:
+            wait: float = 1.0
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    raise TimeoutError(
+                        "Remote command timed out after {} seconds".format(timeout)
+                    )
+            select.select([channel], [], [], wait)
+
+
+def finish_command(channel: Channel, timeout: float | None = None) -> CommandResult:
+    stdout: bytearray = bytearray()
+    stderr: bytearray = bytearray()
+    try:
+        channel.shutdown_write()
+        drain(channel, stdout.extend, stderr.extend, timeout)
+        return CommandResult(channel.recv_exit_status(), bytes(stdout), bytes(stderr))
+    finally:
+        channel.close()
+
+
+def run_command(
+    ssh: Connection | Transport,
+    command: str,
+    stdin: bytes | None = None,
+    timeout: float | None = None,
+) -> CommandResult:
+    return run_streaming(ssh, command, [] if stdin is None else [stdin], timeout)
+
+
+def run_streaming(
+    ssh: Connection | Transport,
+    command: str,
+    stdin: Iterable[bytes],
+    timeout: float | None = None,
+) -> CommandResult:
+    # Like run_command with stdin sent as it is produced, never held whole
+    channel: Channel = open_command(ssh, command, timeout)
+    try:
+        for chunk in stdin:
+            if len(chunk) > 0:
+                channel.sendall(chunk)
+    except Exception:
+        channel.close()
+        raise
+    return finish_command(channel, timeout)
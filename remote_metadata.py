@@ -0,0 +1,146 @@
+from __future__ import annotations
+import log_config
+import logging
+import os
+import remote_dirs
+import remote_exec
+import shlex
+import threading
+from stat import S_IMODE
+from typing import NamedTuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from paramiko import SFTPAttributes, Transport
+    from sftpretty import Connection
+
+log: logging.Logger = log_config.get_logger("RemoteMetadata")
+
+# Files applied per remote script, directories wait for the end of the target
+METADATA_BATCH: int = 1000
+
+
+class Metadata(NamedTuple):
+    path: str
+    mode: int
+    mtime_ns: int
+    uid: int
+    gid: int
+
+
+def format_mode(mode: int) -> str:
+    # Five digits so GNU chmod also clears setgid on directories
+    return "0{:04o}".format(mode)
+
+
+def format_mtime(mtime_ns: int) -> str:
+    return "@{}.{:09d}".format(mtime_ns // 1000000000, mtime_ns % 1000000000)
+
+
+def metadata_script(entries: list[Metadata], preserve_owner: bool) -> str:
+    # chown clears setuid and setgid, so it goes before chmod
+    groups: list[tuple[str, dict[str, list[str]]]] = []
+    if preserve_owner:
+        groups.append(("chown", {}))
+    groups.append(("chmod", {}))
+    groups.append(("touch -c -m -d", {}))
+    for entry in entries:
+        path: str = shlex.quote(entry.path)
+        keys: list[str] = [format_mode(entry.mode), format_mtime(entry.mtime_ns)]
+        if preserve_owner:
+            keys.insert(0, "{}:{}".format(entry.uid, entry.gid))
+        for (_, group), key in zip(groups, keys):
+            group.setdefault(key, []).append(path)
+
+    lines: list[str] = ["status=0"]
+    for command, group in groups:
+        for key, paths in group.items():
+            # Split like mkdir, a large batch sharing one mode or time would
+            # go past the remote ARG_MAX
+            prefix: str = "{} {} --".format(command, key)
+            line: str = prefix
+            for path in paths:
+                if (
+                    line != prefix
+                    and len(line) + len(path) + 1 > remote_dirs.MAX_COMMAND_LENGTH
+                ):
+                    lines.append(line + " || status=1")
+                    line = prefix
+                line += " " + path
+            lines.append(line + " || status=1")
+    lines.append("exit $status")
+    return "\n".join(lines) + "\n"
+
+
+class MetadataBatch:
+    # Attributes for every path sent to one target, applied in bulk after the
+    # uploads instead of a chmod round trip per file
+    def __init__(self, preserve_owner: bool = False) -> None:
+        self.preserve_owner: bool = preserve_owner
+        self.lock: threading.Lock = threading.Lock()
+        self.files: list[Metadata] = []
+        self.directories: list[Metadata] = []
+        self.applied: int = 0
+
+    def record(self, path: str, local: os.stat_result, is_directory: bool = False):
+        entry = Metadata(
+            path, S_IMODE(local.st_mode), local.st_mtime_ns, local.st_uid, local.st_gid
+        )
+        with self.lock:
+            if is_directory:
+                self.directories.append(entry)
+            else:
+                self.files.append(entry)
+
+    def differs(self, local: os.stat_result, remote: SFTPAttributes) -> bool:
+        if S_IMODE(local.st_mode) != S_IMODE(remote.st_mode):
+            return True
+        if int(local.st_mtime) != remote.st_mtime:
+            return True
+        return self.preserve_owner and (
+            local.st_uid != remote.st_uid or local.st_gid != remote.st_gid
+        )
+
+    def take(self, final: bool = False) -> list[Metadata]:
+        with self.lock:
+            if not final and len(self.files) < METADATA_BATCH:
+                return []
+            entries: list[Metadata] = self.files
+            self.files = []
+            if final:
+                # Deepest first so a parent never locks out its children
+                entries += sorted(
+                    self.directories, key=lambda e: e.path.count("/"), reverse=True
+                )
+                self.directories = []
+        return entries
+
+    def restore(self, entries: list[Metadata]):
+        # Kept so a retry on a new connection can apply them
+        with self.lock:
+            self.files = entries + self.files
+
+    def script(self, entries: list[Metadata]) -> str:
+        return metadata_script(entries, self.preserve_owner)
+
+    def applied_to(self, entries: list[Metadata]):
+        self.applied += len(entries)
+        log.debug("Applied metadata to {} paths".format(len(entries)))
+
+    def flush(self, ssh: Connection | Transport, final: bool = False):
+        entries: list[Metadata] = self.take(final)
+        if len(entries) == 0:
+            return
+        try:
+            result = remote_exec.run_command(
+                ssh, "sh -s", self.script(entries).encode("utf-8")
+            )
+        except BaseException:
+            self.restore(entries)
+            raise
+        if result.exit_status != 0:
+            raise IOError(
+                "Unable to apply metadata to {} paths: {}".format(
+                    len(entries), result.stderr.decode("utf-8", "replace").strip()
+                )
+            )
+        self.applied_to(entries)
@@ -0,0 +1,133 @@
+from __future__ import annotations
+import log_config
+import logging
+import os
+import remote_exec
+import shlex
+import time
+from typing import NamedTuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from paramiko import Channel, Transport
+    from sftpretty import Connection
+
+log: logging.Logger = log_config.get_logger("RemoteScript")
+
+# Exit status of coreutils timeout when it had to stop the script
+TIMEOUT_STATUS: int = 124
+# Time after the timeout before the remote script is killed
+KILL_GRACE: float = 10.0
+# Further wait past the kill for its status to arrive, before we give up on a
+# target that stopped answering
+STATUS_MARGIN: float = 10.0
+# Output without a newline is logged in pieces this large
+MAX_LINE: int = 65536
+
+
+class ScriptResult(NamedTuple):
+    script: str
+    # None when the target never reported one
+    exit_status: int | None
+    duration: float
+    timed_out: bool
+
+    def succeeded(self) -> bool:
+        return self.exit_status == 0 and not self.timed_out
+
+
+def local_deadline(timeout: float | None) -> float | None:
+    # Later than the remote kill, so a killed script still reports the
+    # timeout status instead of looking like a hung target
+    if timeout is None:
+        return None
+    return timeout + KILL_GRACE + STATUS_MARGIN
+
+
+def script_command(script: str, timeout: float | None = None) -> str:
+    command: str = "(cd " + os.path.dirname(script) + " && " + script + ")"
+    if timeout is None:
+        return command
+    # The remote side enforces the timeout so a hung script does not keep
+    # running after we stop waiting for it
+    return "timeout -k {:g} {:g} sh -c {}".format(
+        KILL_GRACE, timeout, shlex.quote(command)
+    )
+
+
+class ScriptOutput:
+    # Logs one output stream of a script line by line as it arrives
+    def __init__(self, name: str, is_stderr: bool = False) -> None:
+        self.name: str = name
+        self.is_stderr: bool = is_stderr
+        self.partial: bytes = b""
+
+    def line(self, text: str):
+        if self.is_stderr:
+            log.warn("({}) {}".format(self.name, text))
+        else:
+            log.info("({}) {}".format(self.name, text))
+
+    def write(self, data: bytes):
+        lines: list[bytes] = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.line(line.decode("utf-8", "replace").rstrip("\r"))
+        if len(self.partial) >= MAX_LINE:
+            self.close()
+
+    def close(self):
+        if len(self.partial) > 0:
+            self.line(self.partial.decode("utf-8", "replace").rstrip("\r"))
+            self.partial = b""
+
+
+def log_result(name: str, result: ScriptResult):
+    if result.timed_out:
+        log.error(
+            "Script ({}) on server ({}) timed out after {:.1f} seconds".format(
+                result.script, name, result.duration
+            )
+        )
+    elif result.exit_status != 0:
+        log.error(
+            "Script ({}) on server ({}) exited with {} after {:.1f} seconds".format(
+                result.script, name, result.exit_status, result.duration
+            )
+        )
+    else:
+        log.info(
+            "Script ({}) on server ({}) finished in {:.1f} seconds".format(
+                result.script, name, result.duration
+            )
+        )
+
+
+def run_script(
+    ssh: Connection | Transport,
+    name: str,
+    script: str,
+    timeout: float | None = None,
+) -> ScriptResult:
+    started: float = time.monotonic()
+    stdout = ScriptOutput(name)
+    stderr = ScriptOutput(name, True)
+    deadline: float | None = local_deadline(timeout)
+    channel: Channel = remote_exec.open_command(ssh, script_command(script, timeout))
+    try:
+        channel.shutdown_write()
+        try:
+            remote_exec.drain(channel, stdout.write, stderr.write, deadline)
+        except TimeoutError:
+            return ScriptResult(script, None, time.monotonic() - started, True)
+        finally:
+            stdout.close()
+            stderr.close()
+        status: int = channel.recv_exit_status()
+    finally:
+        channel.close()
+    return ScriptResult(
+        script,
+        status,
+        time.monotonic() - started,
+        timeout is not None and status == TIMEOUT_STATUS,
+    )
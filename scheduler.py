@@ -0,0 +1,144 @@
+import heapq
+import log_config
+import logging
+import math
+from remote_dirs import batched
+from source_data import TransferItem
+from source_scanner import SourceScanner
+from typing import Iterable, Iterator
+
+log: logging.Logger = log_config.get_logger("Scheduler")
+
+# Largest items sent ahead of everything else, the rest keep their order
+LEAD_ITEMS: int = 256
+# Assumed speed of one upload channel, only used for the estimate
+DEFAULT_RATE_MB: float = 10.0
+
+
+def item_size(item: TransferItem, scanner: SourceScanner) -> int:
+    if not item.is_directory:
+        return scanner.stat(item.source).st_size
+    # Walked through the scanner so a small tree is not read again to send it
+    return sum(
+        entry.status.st_size
+        for directory in scanner.walk(item.source, item.source_filter)
+        for entry in directory.files
+    )
+
+
+def balance(sizes: Iterable[int], channels: int, divisible: int = 0) -> list[int]:
+    # Longest first onto the least loaded channel, then the bytes that can be
+    # split between channels, such as the files of a directory, fill the gaps
+    loads: list[int] = [0] * max(1, channels)
+    for size in sorted(sizes, reverse=True):
+        heapq.heapreplace(loads, loads[0] + size)
+    loads.sort()
+    for index in range(len(loads)):
+        # Level the lightest channels up to the next one before moving on
+        ceiling: int = loads[index + 1] if index + 1 < len(loads) else 0
+        gap: int = (ceiling - loads[index]) * (index + 1)
+        if index + 1 == len(loads) or divisible <= gap:
+            share, extra = divmod(divisible, index + 1)
+            for lower in range(index + 1):
+                loads[lower] = loads[index] + share + (1 if lower < extra else 0)
+            break
+        divisible -= gap
+    return sorted(loads, reverse=True)
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024
+    return "{:.1f} TiB".format(size)
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(math.ceil(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+
+class TransferSchedule:
+    # Sizes every item of the plan once before anything is sent. The largest
+    # lead_items go out first, so a big file at the end of the config does
+    # not leave the other channels idle while it finishes. Everything else is
+    # streamed again in config order, each batch sorted largest first, so
+    # memory stays flat no matter how many items the sources match.
+    def __init__(
+        self,
+        plan: Iterable[TransferItem],
+        scanner: SourceScanner,
+        lead_items: int = LEAD_ITEMS,
+    ) -> None:
+        self.plan: Iterable[TransferItem] = plan
+        self.scanner: SourceScanner = scanner
+        self.total_items: int = 0
+        self.total_bytes: int = 0
+        self.largest_file: int = 0
+        # Sizes of files that have to go over a single channel
+        self.lead_files: list[int] = []
+        # Only directories are kept, files are cheap to stat again
+        self.directory_sizes: dict[tuple[str, str], int] = {}
+        self.lead: list[tuple[int, int, TransferItem]] = []
+        self.scan(lead_items)
+
+    def scan(self, lead_items: int):
+        heap: list[tuple[int, int, TransferItem]] = []
+        for index, item in enumerate(self.plan):
+            size: int = item_size(item, self.scanner)
+            self.total_items += 1
+            self.total_bytes += size
+            if item.is_directory:
+                self.directory_sizes[(item.source, item.destination)] = size
+            else:
+                self.largest_file = max(self.largest_file, size)
+            # Earlier items win ties, the index keeps items from being compared
+            entry = (size, -index, item)
+            if len(heap) < lead_items:
+                heapq.heappush(heap, entry)
+            elif lead_items > 0:
+                heapq.heappushpop(heap, entry)
+        self.lead = sorted(heap, reverse=True)
+        self.lead_files = [size for size, _, item in self.lead if not item.is_directory]
+
+    def size(self, item: TransferItem) -> int:
+        if item.is_directory:
+            size: int | None = self.directory_sizes.get((item.source, item.destination))
+            if size is not None:
+                return size
+        return item_size(item, self.scanner)
+
+    def __iter__(self) -> Iterator[TransferItem]:
+        # Safe to iterate from several targets at once, nothing here is shared
+        sent: set[tuple[str, str]] = set()
+        for _, _, item in self.lead:
+            sent.add((item.source, item.destination))
+            yield item
+        rest = (
+            item for item in self.plan if (item.source, item.destination) not in sent
+        )
+        for batch in batched(rest):
+            batch.sort(key=self.size, reverse=True)
+            yield from batch
+
+    def estimate(self, channels: int, rounds: int, rate_mb: float) -> str:
+        # Lead files cannot be split, everything else is spread over channels
+        loads: list[int] = balance(
+            self.lead_files, channels, self.total_bytes - sum(self.lead_files)
+        )
+        # Files past the lead are all smaller than the last lead file
+        busiest: int = max(loads[0], self.largest_file)
+        seconds: float = 0
+        if rate_mb > 0:
+            seconds = busiest * rounds / (rate_mb * 1024 * 1024)
+        return "{} items, {} per target, busiest of {} channels {}, about {} for {} rounds of targets at {} MiB/s per channel".format(
+            self.total_items,
+            format_size(self.total_bytes),
+            len(loads),
+            format_size(busiest),
+            format_duration(seconds),
+            rounds,
+            rate_mb,
+        )
@@ -1,14 +1,74 @@
 import log_config
 import logging
 import os
-from paramiko import SSHConfig
-from paramiko import SSHConfigDict
+import re
+import threading
 from enum import Enum
+from itertools import chain
+from typing import Iterator, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from paramiko import SSHConfig, SSHConfigDict
 
 log: logging.Logger = log_config.get_logger("Server")
 
+# Parsed sshconfig files shared by every server that names them, with the
+# lookups already done in each, keyed by path and dropped when the file changes
+SSH_CONFIGS: dict[str, tuple[int, "SSHConfig", dict[str, "SSHConfigDict"]]] = {}
+SSH_CONFIGS_LOCK: threading.Lock = threading.Lock()
+
+# node[0001-5000] or rack[1-4]-node[01,05,10-12]. Numbers are padded to the
+# width of the start of their range, like slurm and pdsh do.
+HOST_RANGE: re.Pattern = re.compile(r"\[([0-9,-]*)\]")
+# Keys of a target group that are not defaults for its hosts
+GROUP_ONLY_KEYS: list[str] = ["hosts"]
+
+
+def load_sshconfig(path: str) -> tuple["SSHConfig", dict[str, "SSHConfigDict"]]:
+    path = os.path.abspath(path)
+    mtime: int = os.stat(path).st_mtime_ns
+    with SSH_CONFIGS_LOCK:
+        cached = SSH_CONFIGS.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1], cached[2]
+
+    # Only configs that use an sshconfig pay for importing paramiko
+    from paramiko import SSHConfig
+
+    config = SSHConfig.from_path(path)
+    lookups: dict[str, SSHConfigDict] = {}
+    with SSH_CONFIGS_LOCK:
+        SSH_CONFIGS[path] = (mtime, config, lookups)
+    log.debug("Parsed sshconfig ({})".format(path))
+    return config, lookups
+
+
+def lookup_sshconfig(path: str, hostkey: str) -> "SSHConfigDict":
+    config, lookups = load_sshconfig(path)
+    with SSH_CONFIGS_LOCK:
+        host_config = lookups.get(hostkey)
+    if host_config is None:
+        host_config = config.lookup(hostkey)
+        with SSH_CONFIGS_LOCK:
+            lookups[hostkey] = host_config
+    return host_config
+
 
 class Server:
+    # Slots instead of a dict per instance, an inventory can hold thousands
+    # and the strings shared by a group are only referenced
+    __slots__ = (
+        "name",
+        "hostname",
+        "username",
+        "password",
+        "port",
+        "sshconfig",
+        "hostkey",
+        "identity_file",
+        "is_valid",
+    )
+
     def __init__(
         self,
         name: str,
@@ -61,47 +121,42 @@ class Server:
             log.error("sshconfig ({}) does not exist.".format(self.sshconfig))
             return
 
-        with open(self.sshconfig) as config_file:
-            hostname: str = ""
-            config = SSHConfig()
-            config.parse(config_file)
-            host_config: SSHConfigDict = config.lookup(self.hostkey)
-
-            for field in host_config.keys():
-                match field:
-                    case "hostname":
-                        hostname = host_config[field]
-                        if self.hostname is not None and self.hostname == hostname:
-                            log.warn(
-                                "Config file specified hostname ({}) when using sshconfig, but they match. If using sshconfig, hostname is unnecessary.".format(
-                                    self.hostname
-                                )
-                            )
-                        elif self.hostname is not None and self.hostname != hostname:
-                            log.error(
-                                "Config file specified hostname ({}) when sshconfig specified ({}). sshconfig takes precendence".format(
-                                    self.hostname, hostname
-                                )
+        hostname: str = ""
+        host_config: SSHConfigDict = lookup_sshconfig(self.sshconfig, self.hostkey)
+
+        for field in host_config.keys():
+            match field:
+                case "hostname":
+                    hostname = host_config[field]
+                    if self.hostname is not None and self.hostname == hostname:
+                        log.warn(
+                            "Config file specified hostname ({}) when using sshconfig, but they match. If using sshconfig, hostname is unnecessary.".format(
+                                self.hostname
                             )
-                        self.hostname = hostname
-                    case "port":
-                        self.port = host_config.as_int(field)
-                    case "identityfile":
-                        if len(host_config[field]) > 1:
-                            log.warn(
-                                "Multiple identity files not supported. First identity ({}) will be used.".format(
-                                    host_config[field][0]
-                                )
+                        )
+                    elif self.hostname is not None and self.hostname != hostname:
+                        log.error(
+                            "Config file specified hostname ({}) when sshconfig specified ({}). sshconfig takes precendence".format(
+                                self.hostname, hostname
                             )
-                        self.identity_file = host_config[field][0]
-                    case "user":
-                        self.username = host_config[field]
-                    case _:
+                        )
+                    self.hostname = hostname
+                case "port":
+                    self.port = host_config.as_int(field)
+                case "identityfile":
+                    if len(host_config[field]) > 1:
                         log.warn(
-                            "Unknown field ({}) in hostkey ({})".format(
-                                field, self.hostkey
+                            "Multiple identity files not supported. First identity ({}) will be used.".format(
+                                host_config[field][0]
                             )
                         )
+                    self.identity_file = host_config[field][0]
+                case "user":
+                    self.username = host_config[field]
+                case _:
+                    log.warn(
+                        "Unknown field ({}) in hostkey ({})".format(field, self.hostkey)
+                    )
 
     def config_is_valid(self) -> bool:
         if self.hostname is None:
@@ -135,48 +190,146 @@ def parse_port_tag(port) -> int:
         return port
 
 
-@staticmethod
-def parse_server_tag(name: str, server: dict) -> Server | None:
-    hostname = None
-    username = None
-    password = None
-    sshconfig = None
-    hostkey = None
-    identity = None
-    port: int = 22
-
+def parse_server_options(name: str, server: dict) -> dict:
+    options: dict = {}
     for keys in server:
         match keys:
-            case "hostname":
-                hostname = parse_string_tag(keys, server[keys])
-            case "username":
-                username = parse_string_tag(keys, server[keys])
-            case "password":
-                password = parse_string_tag(keys, server[keys])
+            case (
+                "hostname"
+                | "username"
+                | "password"
+                | "sshconfig"
+                | "hostkey"
+                | "identity"
+            ):
+                options[keys] = parse_string_tag(keys, server[keys])
             case "port":
-                port = parse_port_tag(server[keys])
-            case "sshconfig":
-                sshconfig = parse_string_tag(keys, server[keys])
-            case "hostkey":
-                hostkey = parse_string_tag(keys, server[keys])
-            case "identity":
-                identity = parse_string_tag(keys, server[keys])
+                options[keys] = parse_port_tag(server[keys])
             case _:
-                log.error("Unknown tag ({}) under Source. Ignoring.".format(keys))
-
-    server_class = Server(
-        name,
-        hostname=hostname,
-        username=username,
-        password=password,
-        port=port,
-        sshconfig=sshconfig,
-        hostkey=hostkey,
-        identity=identity,
-    )
+                log.error("Unknown tag ({}) under ({}). Ignoring.".format(keys, name))
+    return options
+
+
+@staticmethod
+def parse_server_tag(name: str, server: dict) -> Server | None:
+    server_class = Server(name, **parse_server_options(name, server))
 
     if server_class.is_valid:
         log.info("Successfully Parsed: {}".format(server_class._to_string()))
         return server_class
     else:
         return None
+
+
+def parse_range(spec: str) -> list[tuple[int, int, int]] | None:
+    # (start, end, width) for each comma separated number or range
+    bounds: list[tuple[int, int, int]] = []
+    for part in spec.split(","):
+        start, _, end = part.partition("-")
+        if len(end) == 0:
+            end = start
+        if not start.isdigit() or not end.isdigit() or int(end) < int(start):
+            return None
+        bounds.append((int(start), int(end), len(start)))
+    return bounds
+
+
+def range_values(bounds: list[tuple[int, int, int]]) -> Iterator[str]:
+    for start, end, width in bounds:
+        for number in range(start, end + 1):
+            yield str(number).zfill(width)
+
+
+def range_count(bounds: list[tuple[int, int, int]]) -> int:
+    return sum(end - start + 1 for start, end, _ in bounds)
+
+
+def expand_pieces(
+    literals: list[str], ranges: list[list[tuple[int, int, int]]]
+) -> Iterator[str]:
+    if len(ranges) == 0:
+        yield literals[0]
+        return
+    for value in range_values(ranges[0]):
+        for rest in expand_pieces(literals[1:], ranges[1:]):
+            yield literals[0] + value + rest
+
+
+def expand_hosts(pattern: str) -> tuple[int, Iterator[str]] | None:
+    # How many hosts the pattern names and a generator over them, nothing is
+    # expanded until it is iterated. None when a range is malformed.
+    pieces: list[str] = HOST_RANGE.split(pattern)
+    literals: list[str] = pieces[0::2]
+    ranges: list[list[tuple[int, int, int]] | None] = [
+        parse_range(spec) for spec in pieces[1::2]
+    ]
+    if any(bounds is None for bounds in ranges) or any(
+        "[" in literal or "]" in literal for literal in literals
+    ):
+        log.error(
+            "Host range ({}) is invalid. Use numbers like node[1-10] or node[01,07-09].".format(
+                pattern
+            )
+        )
+        return None
+    count: int = 1
+    for bounds in ranges:
+        count *= range_count(bounds)
+    return count, expand_pieces(literals, ranges)
+
+
+def parse_group_tag(name: str, group: dict) -> tuple[int, Iterator[Server]] | None:
+    # A target with hosts instead of a hostname. Everything else under it is
+    # shared by the hosts, each host is also its name and sshconfig hostkey.
+    patterns = group["hosts"]
+    if type(patterns) is str:
+        patterns = [patterns]
+    if (
+        type(patterns) is not list
+        or len(patterns) == 0
+        or any(type(p) is not str or len(p) == 0 for p in patterns)
+    ):
+        log.error(
+            "Hosts ({}) of group ({}) are not a str or list.".format(patterns, name)
+        )
+        return None
+    expanded: list[tuple[int, Iterator[str]] | None] = [
+        expand_hosts(pattern) for pattern in patterns
+    ]
+    if any(hosts is None for hosts in expanded):
+        return None
+
+    options: dict = parse_server_options(
+        name, {k: v for k, v in group.items() if k not in GROUP_ONLY_KEYS}
+    )
+    for key in ["hostname", "hostkey"]:
+        if options.pop(key, None) is not None:
+            log.error(
+                "Group ({}) takes each {} from its hosts. Ignoring {}.".format(
+                    name, key, key
+                )
+            )
+    count: int = sum(hosts[0] for hosts in expanded)
+    return count, group_servers(
+        name, chain.from_iterable(hosts[1] for hosts in expanded), options
+    )
+
+
+def group_servers(group: str, hosts: Iterator[str], options: dict) -> Iterator[Server]:
+    for host in hosts:
+        if options.get("sshconfig") is not None:
+            server = Server(host, hostkey=host, **options)
+        else:
+            server = Server(host, hostname=host, **options)
+        if server.is_valid:
+            yield server
+            continue
+        log.error(
+            "Server ({}) of group ({}) has an invalid configuration. Ignoring.".format(
+                host, group
+            )
+        )
+        if options.get("sshconfig") is None:
+            # Every host of the group would fail the same way
+            log.error("Ignoring the rest of group ({}).".format(group))
+            return
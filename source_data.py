@@ -3,13 +3,31 @@ import stat
 import glob
 import log_config
 import logging
+from compression import Compression
+from source_scanner import SourceFilter, SourceScanner
+from typing import Iterator, NamedTuple
 
 log: logging.Logger = log_config.get_logger("SourceData")
 
 
+class TransferItem(NamedTuple):
+    source: str
+    destination: str
+    is_directory: bool
+    # None uses the run wide default
+    compression: Compression | None = None
+    source_filter: SourceFilter | None = None
+
+
 class SourceData:
     def __init__(
-        self, input: str, destination: str = "", is_script: bool = False
+        self,
+        input: str,
+        destination: str = "",
+        is_script: bool = False,
+        compression: Compression | None = None,
+        source_filter: SourceFilter | None = None,
+        scanner: SourceScanner | None = None,
     ) -> None:
         self.input: str = input
         self.absolute: str = ""
@@ -21,7 +39,10 @@ class SourceData:
         self.is_directory: bool = False
         self.is_valid: bool = True
         self.is_script: bool = is_script
-        
+        self.compression: Compression | None = compression
+        self.source_filter: SourceFilter | None = source_filter
+        self.scanner: SourceScanner = scanner or SourceScanner()
+
         self.parse_input()
 
     def parse_input(self) -> bool:
@@ -62,12 +83,13 @@ class SourceData:
         if not self.is_glob:
             return False
 
-        matching = glob.glob(self.input, include_hidden=True, recursive=True)
-        if len(matching) == 0:
+        # Only look for the first match, the rest are streamed when transferred
+        first = next(self.scanner.iglob(self.input, self.source_filter), None)
+        if first is None:
             log.warn("Glob {} does not match any files or folders.".format(self.input))
             self.glob_warn = True
         else:
-            log.info("Glob {} will match {} items.".format(self.input, len(matching)))
+            log.info("Glob {} matches files or folders.".format(self.input))
 
         return True
 
@@ -154,18 +176,42 @@ class SourceData:
             )
             return False
 
-    def get_source_list(self) -> list[tuple[str, str, bool]]:
+    def get_source_list(self) -> list[TransferItem]:
+        return list(self.iter_source_list())
+
+    def iter_source_list(self) -> Iterator[TransferItem]:
         if not self.is_valid:
-            return []
+            return
         elif not self.is_glob:
-            return [(self.absolute, self.destination, self.is_directory)]
-        globbys: list[tuple[str, str, bool]] = []
-        for g in glob.glob(pathname=self.input, recursive=True, include_hidden=True):
-            gpath : str = ""
+            yield TransferItem(
+                self.absolute,
+                self.destination,
+                self.is_directory,
+                self.compression,
+                self.source_filter,
+            )
+            return
+        for g in self.scanner.iglob(self.input, self.source_filter):
+            gpath: str = ""
             if os.path.isabs(g):
                 gpath = g
             else:
                 gpath = os.path.abspath(g)
-            globbys.append((gpath,gpath,os.path.isdir(g)))
-            
-        return globbys
+            yield TransferItem(
+                gpath,
+                gpath,
+                stat.S_ISDIR(self.scanner.stat(g).st_mode),
+                self.compression,
+                self.source_filter,
+            )
+
+
+class FilePlan:
+    # Every pass reads the sources again instead of holding all items, so the
+    # first file goes out right away and memory does not grow with the sources
+    def __init__(self, sources: list[SourceData]) -> None:
+        self.sources: list[SourceData] = sources
+
+    def __iter__(self) -> Iterator[TransferItem]:
+        for source in self.sources:
+            yield from source.iter_source_list()
@@ -0,0 +1,193 @@
+import glob
+import log_config
+import logging
+import os
+import threading
+from fnmatch import fnmatch
+from stat import S_ISDIR
+from typing import Iterator, NamedTuple
+
+log: logging.Logger = log_config.get_logger("SourceScanner")
+
+# Directory and file entries kept between targets before sources are streamed
+SCAN_CACHE_LIMIT: int = 200000
+
+
+class SourceFilter(NamedTuple):
+    # Patterns without a / match any single path component, like .gitignore,
+    # the rest match the path relative to the source
+    include: tuple[str, ...] = ()
+    exclude: tuple[str, ...] = ()
+
+    def excluded(self, relative: str) -> bool:
+        parts: list[str] = relative.split(os.sep)
+        for pattern in self.exclude:
+            if "/" in pattern:
+                if fnmatch(relative, pattern):
+                    return True
+            elif any(fnmatch(part, pattern) for part in parts):
+                return True
+        return False
+
+    def included(self, relative: str) -> bool:
+        # Include only narrows down files, directories are always walked
+        if len(self.include) == 0:
+            return True
+        name: str = os.path.basename(relative)
+        return any(
+            fnmatch(relative if "/" in pattern else name, pattern)
+            for pattern in self.include
+        )
+
+
+def glob_base(pattern: str) -> str:
+    # Leading directories of a pattern without wildcards, glob matches are
+    # filtered relative to it like a walk is relative to its source
+    parts: list[str] = pattern.split(os.sep)
+    literal: int = 0
+    while literal < len(parts) - 1 and not glob.has_magic(parts[literal]):
+        literal += 1
+    return os.path.abspath(
+        os.sep.join(parts[:literal]) or (os.sep if pattern.startswith(os.sep) else ".")
+    )
+
+
+class ScanEntry(NamedTuple):
+    path: str
+    status: os.stat_result
+
+
+class ScannedDirectory(NamedTuple):
+    path: str
+    status: os.stat_result
+    files: list[ScanEntry]
+
+
+class SourceScanner:
+    # Sources are read from disk as they are transferred. Small ones are kept
+    # so the next target reuses the walk and its stat results, anything past
+    # cache_limit entries is streamed again so memory stays flat.
+    def __init__(self, cache_limit: int = SCAN_CACHE_LIMIT) -> None:
+        self.lock: threading.Lock = threading.Lock()
+        self.cache_limit: int = cache_limit
+        self.cached_entries: int = 0
+        self.stats: dict[str, os.stat_result] = {}
+        self.globs: dict[str, list[str]] = {}
+        self.trees: dict[tuple[str, SourceFilter | None], list[ScannedDirectory]] = {}
+
+    def _store(self, cache: dict, key, value, count: int) -> bool:
+        with self.lock:
+            if key in cache:
+                return True
+            if self.cached_entries + count > self.cache_limit:
+                return False
+            cache[key] = value
+            self.cached_entries += count
+            return True
+
+    def stat(self, path: str) -> os.stat_result:
+        status: os.stat_result | None = self.stats.get(path)
+        if status is None:
+            status = os.stat(path)
+            self._store(self.stats, path, status, 1)
+        return status
+
+    def iglob(
+        self, pattern: str, source_filter: SourceFilter | None = None
+    ) -> Iterator[str]:
+        matches: list[str] | None = self.globs.get(pattern)
+        if matches is None:
+            matches = self._iglob(pattern)
+        base: str = glob_base(pattern)
+        for match in matches:
+            if source_filter is None:
+                yield match
+                continue
+            relative: str = os.path.relpath(match, base)
+            if not source_filter.excluded(relative) and (
+                S_ISDIR(self.stat(match).st_mode) or source_filter.included(relative)
+            ):
+                yield match
+
+    def _iglob(self, pattern: str) -> Iterator[str]:
+        matches: list[str] | None = []
+        for match in glob.iglob(pattern, recursive=True, include_hidden=True):
+            match = os.path.abspath(match)
+            if matches is not None:
+                matches.append(match)
+                if len(matches) > self.cache_limit:
+                    matches = None
+            yield match
+        if matches is not None:
+            self._store(self.globs, pattern, matches, len(matches))
+
+    def walk(
+        self, root: str, source_filter: SourceFilter | None = None
+    ) -> Iterator[ScannedDirectory]:
+        key = (root, source_filter)
+        tree: list[ScannedDirectory] | None = self.trees.get(key)
+        if tree is not None:
+            yield from tree
+            return
+
+        tree = []
+        directories: int = 0
+        files: int = 0
+        for directory in self._scan(root, source_filter):
+            directories += 1
+            files += len(directory.files)
+            if tree is not None:
+                tree.append(directory)
+                if directories + files > self.cache_limit:
+                    tree = None
+            yield directory
+        cached: bool = tree is not None and self._store(
+            self.trees, key, tree, directories + files
+        )
+        log.info(
+            "Scanned {} directories and {} files in {}{}".format(
+                directories, files, root, "" if cached else ", too many to keep"
+            )
+        )
+
+    def _scan(
+        self, root: str, source_filter: SourceFilter | None
+    ) -> Iterator[ScannedDirectory]:
+        # Top down in name order like os.walk, without its recursion limit
+        pending: list[str] = [root]
+        while len(pending) > 0:
+            directory: str = pending.pop()
+            try:
+                entries: list[os.DirEntry] = sorted(
+                    os.scandir(directory), key=lambda e: e.name
+                )
+            except OSError as e:
+                # Same as os.walk, an unreadable directory is skipped
+                log.warn("Unable to scan directory {}. {}".format(directory, e))
+                continue
+            files: list[ScanEntry] = []
+            subdirectories: list[str] = []
+
+            for entry in entries:
+                relative: str = os.path.relpath(entry.path, root)
+                try:
+                    is_dir: bool = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if source_filter is not None and source_filter.excluded(relative):
+                    continue
+                if is_dir:
+                    # Symlinked directories are not followed, like os.walk
+                    if not entry.is_symlink():
+                        subdirectories.append(entry.path)
+                    continue
+                if source_filter is not None and not source_filter.included(relative):
+                    continue
+                try:
+                    status: os.stat_result = entry.stat()
+                except OSError as e:
+                    log.warn("Unable to stat {}. {}".format(entry.path, e))
+                    continue
+                files.append(ScanEntry(entry.path, status))
+            yield ScannedDirectory(directory, os.stat(directory), files)
+            pending.extend(reversed(subdirectories))
@@ -0,0 +1,110 @@
+from __future__ import annotations
+import log_config
+import logging
+import posixpath
+import remote_exec
+import tarfile
+from compression import Compression, CompressingWriter, decompress_command
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from paramiko import Channel
+    from sftpretty import Connection
+
+log: logging.Logger = log_config.get_logger("TarStream")
+
+# Entries are stored relative to / so every destination can share one stream.
+# Ownership is left to the remote user, the same as an SFTP upload.
+TAR_EXTRACT_COMMAND: str = "tar -x -p --no-same-owner -f - -C /"
+STREAM_BUFFER_SIZE: int = 65536
+
+
+def extract_command(compress: Compression | None = None) -> str:
+    if compress is None:
+        return TAR_EXTRACT_COMMAND
+    # A pipeline exits with the status of tar alone and sh has no pipefail,
+    # so the status of the decompressor comes back through fd 3
+    return (
+        "decompressed=$( {{ {{ {}; echo $? >&3; }} | {} >&2; }} 3>&1 ); "
+        'extracted=$?; [ "$decompressed" = 0 ] || exit "${{decompressed:-1}}"; '
+        'exit "$extracted"'
+    ).format(decompress_command(compress), TAR_EXTRACT_COMMAND)
+
+
+class ChannelWriter:
+    def __init__(self, channel: Channel) -> None:
+        self.channel: Channel = channel
+        self.wire_bytes: int = 0
+
+    def write(self, data: bytes) -> int:
+        self.channel.sendall(data)
+        self.wire_bytes += len(data)
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class TarStream:
+    def __init__(self, sftp: Connection, compress: Compression | None = None) -> None:
+        self.sftp: Connection = sftp
+        # Login directory of the target, relative destinations go below it
+        self.home: str | None = None
+        self.channel: Channel = remote_exec.open_command(
+            sftp, extract_command(compress)
+        )
+        self.writer: ChannelWriter | CompressingWriter = ChannelWriter(self.channel)
+        if compress is not None:
+            self.writer = CompressingWriter(self.channel, compress)
+        self.tar: tarfile.TarFile = tarfile.open(
+            fileobj=self.writer,
+            mode="w|",
+            format=tarfile.PAX_FORMAT,
+            bufsize=STREAM_BUFFER_SIZE,
+        )
+        self.files: int = 0
+        self.bytes: int = 0
+
+    def add(self, source: str, destination: str):
+        if not posixpath.isabs(destination):
+            # The stream extracts under /, SFTP puts relative paths below the
+            # login directory
+            if self.home is None:
+                self.home = self.sftp.pwd
+            destination = posixpath.join(self.home, destination)
+        info: tarfile.TarInfo = self.tar.gettarinfo(
+            name=source, arcname=destination.lstrip("/")
+        )
+        info.uname = ""
+        info.gname = ""
+        if info.isreg():
+            with open(source, "rb") as file:
+                self.tar.addfile(info, file)
+            self.files += 1
+            self.bytes += info.size
+        else:
+            self.tar.addfile(info)
+
+    def close(self):
+        try:
+            self.tar.close()
+            self.writer.close()
+        except Exception:
+            self.channel.close()
+            raise
+        result = remote_exec.finish_command(self.channel)
+        if result.exit_status != 0:
+            raise IOError(
+                "Remote tar exited with {}: {}".format(
+                    result.exit_status,
+                    result.stderr.decode("utf-8", "replace").strip(),
+                )
+            )
+        log.info(
+            "Streamed {} files ({} bytes) through tar, {} bytes sent".format(
+                self.files, self.bytes, self.writer.wire_bytes
+            )
+        )
+
+    def abort(self):
+        self.channel.close()
@@ -0,0 +1,70 @@
+from __future__ import annotations
+import log_config
+import logging
+from connection_pool import ConnectionPool
+from dedupe import DedupeIndex, RemoteCopies
+from incremental import TransferStats
+from pipeline import PipelinedUploader
+from remote_dirs import RemoteDirectories
+from remote_metadata import MetadataBatch
+from server_data import Server
+from typing import Callable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from paramiko import SFTPClient, Transport
+    from sftpretty import Connection
+
+log: logging.Logger = log_config.get_logger("TargetSession")
+
+
+class TargetSession:
+    # State for one target during the transfer phase
+    def __init__(
+        self,
+        server: Server,
+        pool: ConnectionPool,
+        window: int = 1,
+        preserve_owner: bool = False,
+    ) -> None:
+        self.server: Server = server
+        self.pool: ConnectionPool = pool
+        # Uploads kept in flight at once, 1 sends files one after another
+        self.window: int = max(1, window)
+        self.stats: TransferStats = TransferStats()
+        # Directories outlive the connection, so this survives reconnects
+        self.directories: RemoteDirectories = RemoteDirectories()
+        self.metadata: MetadataBatch = MetadataBatch(preserve_owner)
+        self.sftp: Connection | None = None
+        self.transport: Transport | None = None
+        self.uploader: PipelinedUploader | None = None
+        self.success: bool = True
+        # Set when duplicate contents are copied remotely instead of sent
+        self.dedupe: DedupeIndex | None = None
+        self.copies: RemoteCopies | None = None
+
+    def connect(self) -> Connection:
+        sftp: Connection = self.pool.get(self.server)
+        if sftp is not self.sftp:
+            # Anything bound to the old transport is gone with it
+            self.close()
+            self.sftp = sftp
+            self.transport = self.pool.transports[self.server.name]
+        return sftp
+
+    def is_alive(self) -> bool:
+        return self.pool.is_alive(self.server)
+
+    def upload(self, description: str, job: Callable[[SFTPClient], None]):
+        if self.window == 1:
+            job(self.sftp.sftp_client)
+            return
+        if self.uploader is None:
+            self.uploader = PipelinedUploader(self.transport, self.window)
+        self.uploader.submit(description, job)
+
+    def close(self) -> bool:
+        if self.uploader is not None:
+            if not self.uploader.close():
+                self.success = False
+            self.uploader = None
+        return self.success
@@ -0,0 +1,156 @@
+import bench_server
+import benchmark
+import dedupe
+import os
+import pytest
+from async_session import AsyncSession
+from dedupe import Copy, DedupeIndex, RemoteCopies
+from disser import Disser
+from incremental import TransferStats
+from remote_metadata import MetadataBatch
+from server_data import Server
+
+SIZE: int = dedupe.DEDUPE_MIN_SIZE
+
+
+def status(size: int) -> os.stat_result:
+    return os.stat_result((0o100644, 0, 0, 1, 0, 0, size, 0, 0, 0))
+
+
+def test_copy_script_quotes_paths():
+    script: str = dedupe.copy_script(
+        dedupe.DEDUPE_HARDLINK, [Copy("/a b", "/c'd", status(SIZE))]
+    )
+    assert "ln -f -- '/a b' '/c'\"'\"'d' || status=1" in script
+    assert script.endswith("exit $status\n")
+
+
+def test_index_hashes_only_sizes_seen_twice():
+    hashed: list[str] = []
+
+    def digest(source: str, local: os.stat_result) -> str:
+        hashed.append(source)
+        return source[0]
+
+    index = DedupeIndex(digest)
+    assert index.primary("x1", "/r/x1", status(SIZE)) is None
+    assert index.primary("y1", "/r/y1", status(SIZE + 1)) is None
+    assert hashed == []
+    # Same size and contents as the first, copied from it
+    assert index.primary("x2", "/r/x2", status(SIZE)) == "/r/x1"
+    assert index.primary("z1", "/r/z1", status(SIZE)) is None
+    assert index.primary("x3", "/r/x3", status(SIZE)) == "/r/x1"
+    assert sorted(hashed) == ["x1", "x2", "x3", "z1"]
+    # The same path again is not its own duplicate
+    assert index.primary("x1", "/r/x1", status(SIZE)) is None
+
+
+def test_index_ignores_small_files():
+    index = DedupeIndex(lambda source, local: "same")
+    assert index.primary("a", "/r/a", status(10)) is None
+    assert index.primary("b", "/r/b", status(10)) is None
+
+
+def test_copies_wait_for_their_source():
+    copies = RemoteCopies(dedupe.DEDUPE_COPY, MetadataBatch(), TransferStats())
+    copies.add("/r/a", "/r/b", status(SIZE))
+    copies.add("/r/c", "/r/d", status(SIZE))
+    copies.landed("/r/a")
+    # Not enough for a batch before the end
+    assert copies.take() == ([], [])
+    ready, lost = copies.take(True)
+    assert [c.destination for c in ready] == ["/r/b"]
+    assert [c.destination for c in lost] == ["/r/d"]
+
+
+def test_note_present_only_touches_sessions_with_dedupe(tmp_path):
+    source = tmp_path / "file"
+    source.write_bytes(b"x")
+    candidate = (str(source), "/r/file", os.stat(source), None)
+    disser = Disser()
+    disser.dedupe_mode = dedupe.DEDUPE_HARDLINK
+
+    # The asyncio backend never copies duplicates, its session has no index
+    session = AsyncSession(Server("t", hostname="h", password="p"), None)
+    disser.note_present(candidate, session)
+    assert session.dedupe is None and session.copies is None
+
+    session.dedupe = DedupeIndex(lambda source, local: "digest", 1)
+    session.copies = RemoteCopies(disser.dedupe_mode, MetadataBatch(), TransferStats())
+    disser.note_present(candidate, session)
+    assert session.copies.ready == {"/r/file"}
+
+
+@pytest.fixture
+def fleet(tmp_path):
+    benchmark.quiet_loggers()
+    fleet = bench_server.StandInFleet(str(tmp_path / "remote"), 1)
+    yield fleet
+    fleet.close()
+
+
+def transfer(fleet, source: str, mode: str = dedupe.DEDUPE_OFF) -> bool:
+    disser = Disser()
+    disser.pool = benchmark.BenchPool(fleet, disser.metrics)
+    disser.dedupe_mode = mode
+    disser.add_file_source(source, bench_server.REMOTE_PREFIX)
+    target = fleet.targets[0]
+    disser.add_server(
+        Server(
+            target.name,
+            hostname="127.0.0.1",
+            username="bench",
+            password="bench",
+            port=target.port,
+        )
+    )
+    try:
+        return disser.transfer_files()[target.name]
+    finally:
+        disser.close()
+
+
+@pytest.mark.parametrize(
+    "mode", [dedupe.DEDUPE_COPY, dedupe.DEDUPE_HARDLINK, dedupe.DEDUPE_SYMLINK]
+)
+def test_changed_duplicate_does_not_overwrite_its_source(tmp_path, fleet, mode):
+    source = tmp_path / "files"
+    source.mkdir()
+    contents: bytes = os.urandom(SIZE)
+    for name in ["a", "b"]:
+        (source / name).write_bytes(contents)
+    remote: str = fleet.targets[0].root + bench_server.REMOTE_PREFIX + "/files"
+
+    assert transfer(fleet, str(source), mode)
+    if mode == dedupe.DEDUPE_HARDLINK:
+        assert os.stat(os.path.join(remote, "b")).st_nlink == 2
+    elif mode == dedupe.DEDUPE_SYMLINK:
+        assert os.path.islink(os.path.join(remote, "b"))
+
+    # The next run sends both, the first no longer shares its contents
+    changed: bytes = os.urandom(SIZE)
+    (source / "b").write_bytes(changed)
+    assert transfer(fleet, str(source), mode)
+    with open(os.path.join(remote, "a"), "rb") as first:
+        assert first.read() == contents
+    with open(os.path.join(remote, "b"), "rb") as second:
+        assert second.read() == changed
+    assert not os.path.islink(os.path.join(remote, "b"))
+
+
+def test_links_on_the_target_are_written_through_without_dedupe(tmp_path, fleet):
+    # Like put always did, a link the target owns itself stays a link
+    source = tmp_path / "files"
+    source.mkdir()
+    (source / "link").write_bytes(b"new")
+    remote: str = fleet.targets[0].root + bench_server.REMOTE_PREFIX + "/files"
+    os.makedirs(remote)
+    real: str = os.path.join(fleet.targets[0].root, "real")
+    with open(real, "wb") as file:
+        file.write(b"old")
+    os.symlink(real, os.path.join(remote, "link"))
+
+    assert transfer(fleet, str(source))
+    assert os.path.islink(os.path.join(remote, "link"))
+    with open(real, "rb") as file:
+        assert file.read() == b"new"
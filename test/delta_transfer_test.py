@@ -0,0 +1,97 @@
+import delta_transfer
+import os
+import pytest
+import subprocess
+import sys
+from delta_transfer import DeltaAborted, DeltaWriter
+
+
+class RecordingChannel:
+    def __init__(self) -> None:
+        self.data: bytearray = bytearray()
+
+    def sendall(self, data: bytes):
+        self.data.extend(data)
+
+
+def signature_of(path: str, block_size: int) -> list[tuple[int, bytes]]:
+    # The same helper the target runs, with the local python
+    output: bytes = subprocess.run(
+        [sys.executable, "-c", delta_transfer.REMOTE_SIGNATURE, path, str(block_size)],
+        check=True,
+        capture_output=True,
+    ).stdout
+    record = delta_transfer.SIGNATURE_RECORD
+    return [
+        record.unpack_from(output, offset)
+        for offset in range(0, len(output), record.size)
+    ]
+
+
+def apply_delta(destination: str, delta: bytes, block_size: int):
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            delta_transfer.REMOTE_APPLY,
+            destination,
+            destination + ".tmp",
+            str(block_size),
+            "-",
+        ],
+        input=delta,
+        check=True,
+    )
+
+
+def test_block_size_bounds():
+    assert delta_transfer.block_size_for(1) == delta_transfer.MIN_BLOCK_SIZE
+    assert delta_transfer.block_size_for(1 << 40) == delta_transfer.MAX_BLOCK_SIZE
+    assert delta_transfer.block_size_for(64 * 1024 * 1024) == 8192
+
+
+def test_weak_checksum_matches_remote_signature(tmp_path):
+    block: bytes = os.urandom(4096)
+    path = tmp_path / "block"
+    path.write_bytes(block)
+    a, b = delta_transfer.weak_checksum(block)
+    assert signature_of(str(path), 4096)[0][0] == (b << 16) | a
+
+
+@pytest.mark.parametrize("size", [300 * 1024, 300 * 1024 + 777])
+def test_small_change_round_trips(tmp_path, size):
+    old: bytes = os.urandom(size)
+    new: bytearray = bytearray(old)
+    new[5000:5010] = b"0123456789"
+    new[-3:] = b"end"
+    new[100000:100000] = b"inserted"
+    destination = tmp_path / "file"
+    destination.write_bytes(old)
+    block_size: int = delta_transfer.block_size_for(len(new))
+
+    channel = RecordingChannel()
+    writer = DeltaWriter(channel, len(new))
+    delta_transfer.build_delta(
+        bytes(new), signature_of(str(destination), block_size), block_size, writer
+    )
+    import hashlib
+
+    writer.end(hashlib.sha256(new).hexdigest())
+    assert writer.literal_bytes < len(new) // 10
+    apply_delta(str(destination), bytes(channel.data), block_size)
+    assert destination.read_bytes() == bytes(new)
+
+
+def test_rewritten_file_gives_up_early(tmp_path):
+    destination = tmp_path / "file"
+    destination.write_bytes(os.urandom(256 * 1024))
+    new: bytes = os.urandom(256 * 1024)
+    block_size: int = delta_transfer.block_size_for(len(new))
+    channel = RecordingChannel()
+    writer = DeltaWriter(channel, len(new) // 2)
+    with pytest.raises(DeltaAborted):
+        delta_transfer.build_delta(
+            new, signature_of(str(destination), block_size), block_size, writer
+        )
+    # Nothing was worth sending before giving up
+    assert writer.wire_bytes == 0
@@ -1 +1,30 @@
+import logging
+import os
 import pytest
+from read_config import DisserImport
+
+
+@pytest.fixture
+def script(tmp_path) -> str:
+    path = tmp_path / "setup.sh"
+    path.write_text("#!/bin/sh\ntrue\n")
+    os.chmod(path, 0o755)
+    return str(path)
+
+
+def test_script_with_destination_is_a_script(script):
+    config = DisserImport("unused.yml")
+    assert config.parse_scripts_tag([{script: None, "destination": "/opt/setup.sh"}])
+    source = config.disser.source_data[0]
+    assert source.is_script
+    assert source.destination == "/opt/setup.sh"
+    assert config.disser.get_script_list() == ["/opt/setup.sh"]
+
+
+def test_script_options_are_reported_as_ignored(script, caplog):
+    config = DisserImport("unused.yml")
+    caplog.set_level(logging.WARNING)
+    assert config.parse_scripts_tag(
+        [{script: None, "destination": "/opt/setup.sh", "compression": "gzip"}]
+    )
+    assert "do not apply to script" in caplog.text
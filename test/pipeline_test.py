@@ -0,0 +1,108 @@
+import io
+import os
+import pipeline
+
+
+class FakeTransport:
+    def is_active(self) -> bool:
+        return True
+
+
+class FakeChannel:
+    def get_transport(self) -> FakeTransport:
+        return FakeTransport()
+
+
+class FakeStat:
+    def __init__(self, size: int) -> None:
+        self.st_size: int = size
+
+
+class FakeRemoteFile(io.BytesIO):
+    def __init__(self, client, path: str) -> None:
+        super().__init__(bytes(client.files.get(path, b"")))
+        self.client = client
+        self.path: str = path
+
+    def set_pipelined(self, pipelined: bool):
+        pass
+
+    def write(self, data) -> int:
+        if self.client.fail_after is not None and self.tell() >= self.client.fail_after:
+            self.client.fail_after = None
+            self.close()
+            raise IOError("connection dropped")
+        written: int = super().write(data)
+        self.client.files[self.path] = self.getvalue()
+        return written
+
+
+class FakeClient:
+    # In memory SFTP client whose first upload fails once past fail_after bytes
+    def __init__(self, fail_after: int | None = None) -> None:
+        self.files: dict[str, bytes] = {}
+        self.fail_after: int | None = fail_after
+        self.opened: list[tuple[str, int]] = []
+
+    def open(self, path: str, mode: str) -> FakeRemoteFile:
+        if mode == "wb":
+            self.files[path] = b""
+        remote = FakeRemoteFile(self, path)
+        original_seek = remote.seek
+
+        def seek(offset: int, whence: int = 0) -> int:
+            self.opened.append((mode, offset))
+            return original_seek(offset, whence)
+
+        remote.seek = seek
+        return remote
+
+    def stat(self, path: str) -> FakeStat:
+        if path not in self.files:
+            raise IOError("no such file")
+        return FakeStat(len(self.files[path]))
+
+    def get_channel(self) -> FakeChannel:
+        return FakeChannel()
+
+
+def test_retry_continues_from_last_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline.time, "sleep", lambda seconds: None)
+    data: bytes = os.urandom(pipeline.READ_SIZE * 8)
+    source = tmp_path / "source"
+    source.write_bytes(data)
+    every: int = pipeline.READ_SIZE * 2
+    client = FakeClient(fail_after=pipeline.READ_SIZE * 5)
+    checkpoints: list[int] = []
+
+    retries: int = pipeline.put_resumable(
+        client, str(source), "/remote", 0, checkpoints.append, every
+    )
+
+    assert retries == 1
+    assert client.files["/remote"] == data
+    # The retry starts at the checkpoint of the failed attempt, not at 0
+    assert client.opened == [("wb", 0), ("r+b", every * 2)]
+    assert checkpoints[-1] == len(data)
+
+
+def test_resume_never_starts_past_the_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline.time, "sleep", lambda seconds: None)
+    data: bytes = os.urandom(pipeline.READ_SIZE * 4)
+    source = tmp_path / "source"
+    source.write_bytes(data)
+    client = FakeClient()
+    # More landed remotely than was checkpointed, and it may be garbage
+    client.files["/remote"] = data[: pipeline.READ_SIZE] + bytes(pipeline.READ_SIZE)
+    offset: int = pipeline.remote_size(client, "/remote", pipeline.READ_SIZE)
+    assert offset == pipeline.READ_SIZE
+
+    pipeline.put_resumable(
+        client,
+        str(source),
+        "/remote",
+        offset,
+        lambda position: None,
+        pipeline.READ_SIZE,
+    )
+    assert client.files["/remote"] == data
@@ -0,0 +1,81 @@
+import relay
+import subprocess
+from server_data import Server
+from source_data import TransferItem
+from source_scanner import SourceFilter, SourceScanner
+
+
+def make_tree(root, paths: list[str]):
+    for path in paths:
+        target = root / path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_text(path)
+
+
+def run(command: str, paths, relative: bool = False) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        ["sh", "-c", command],
+        input=b"".join(relay.path_list(paths, relative)),
+        capture_output=True,
+        check=True,
+    )
+
+
+def test_build_tiers():
+    targets = [Server("t{}".format(i), hostname="h", password="p") for i in range(7)]
+    tiers = relay.build_tiers(targets, 2)
+    assert [[(p and p.name, c.name) for p, c in tier] for tier in tiers] == [
+        [(None, "t0"), (None, "t1")],
+        [("t0", "t2"), ("t0", "t3"), ("t1", "t4"), ("t1", "t5")],
+        [("t2", "t6")],
+    ]
+
+
+def test_planned_paths_follow_the_plan(tmp_path):
+    make_tree(tmp_path / "src", ["a.py", "a.tmp", "pkg/b.py"])
+    (tmp_path / "single").write_text("single")
+    files = [
+        TransferItem(
+            str(tmp_path / "src"), "/dest", True, None, SourceFilter(exclude=("*.tmp",))
+        ),
+        TransferItem(str(tmp_path / "single"), "/other/single", False),
+    ]
+    assert list(relay.planned_paths(files, SourceScanner())) == [
+        "/dest",
+        "/dest/src",
+        "/dest/src/a.py",
+        "/dest/src/pkg",
+        "/dest/src/pkg/b.py",
+        "/other/single",
+    ]
+
+
+def test_forward_list_leaves_out_files_outside_the_plan(tmp_path):
+    make_tree(tmp_path, ["dir/planned", "dir/extra"])
+    planned = [str(tmp_path / "dir"), str(tmp_path / "dir" / "planned")]
+    create: str = relay.forward_command(Server("c", hostname="h", password="p"))
+    create = create.split(" | ")[0] + " | tar -t"
+    names = run(create, planned, True).stdout.decode().split()
+    assert names == [
+        str(tmp_path / "dir").lstrip("/") + "/",
+        str(tmp_path / "dir" / "planned").lstrip("/"),
+    ]
+
+
+def test_manifest_covers_planned_paths_only(tmp_path):
+    make_tree(tmp_path, ["dir/planned", "dir/other"])
+    planned = [str(tmp_path / "dir"), str(tmp_path / "dir" / "planned")]
+    command: str = relay.manifest_command()
+    digest: bytes = run(command, planned).stdout
+    (tmp_path / "dir" / "other").write_text("changed")
+    (tmp_path / "dir" / "new").write_text("new")
+    assert run(command, planned).stdout == digest
+    (tmp_path / "dir" / "planned").write_text("changed")
+    assert run(command, planned).stdout != digest
+
+
+def test_path_list_chunks(monkeypatch):
+    monkeypatch.setattr(relay, "LIST_CHUNK_SIZE", 10)
+    chunks = list(relay.path_list(["/aaaa", "/bbbb", "/c"], True))
+    assert b"".join(chunks) == b"aaaa\0bbbb\0c\0"
+    assert len(chunks) == 2
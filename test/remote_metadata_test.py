@@ -0,0 +1,40 @@
+import os
+import remote_dirs
+import subprocess
+from remote_metadata import MetadataBatch, metadata_script
+
+
+def test_groups_share_one_command(tmp_path):
+    batch = MetadataBatch()
+    for name in ["a", "b"]:
+        path = tmp_path / name
+        path.write_text(name)
+        os.chmod(path, 0o640)
+        batch.record(str(path), os.stat(path))
+    script: str = batch.script(batch.take(True))
+    assert script.count("chmod 00640 -- ") == 1
+    assert script.count("touch -c -m -d ") <= 2
+
+
+def test_batch_past_arg_max_is_split(tmp_path):
+    # Long names so the paths add up to more than the usual 2 MiB ARG_MAX
+    directory = tmp_path / ("d" * 200)
+    directory.mkdir()
+    batch = MetadataBatch()
+    count: int = 12000
+    for index in range(count):
+        path = directory / "{:0200d}".format(index)
+        path.write_bytes(b"")
+        batch.record(str(path), os.stat(path))
+    entries = batch.take(True)
+    assert sum(len(e.path) for e in entries) > os.sysconf("SC_ARG_MAX")
+    for entry in entries:
+        os.chmod(entry.path, 0o600)
+
+    script: str = metadata_script(entries, False)
+    assert all(
+        len(line) <= remote_dirs.MAX_COMMAND_LENGTH + len(" || status=1")
+        for line in script.splitlines()
+    )
+    subprocess.run(["sh", "-s"], input=script.encode(), check=True)
+    assert all(os.stat(e.path).st_mode & 0o777 == e.mode for e in entries)
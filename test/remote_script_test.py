@@ -0,0 +1,17 @@
+import remote_script
+import subprocess
+
+
+def test_local_deadline_is_past_the_remote_kill():
+    assert remote_script.local_deadline(None) is None
+    assert remote_script.local_deadline(30) > 30 + remote_script.KILL_GRACE
+
+
+def test_timed_out_script_reports_timeout_status(tmp_path):
+    script = tmp_path / "slow.sh"
+    script.write_text("#!/bin/sh\nsleep 5\n")
+    script.chmod(0o755)
+    result = subprocess.run(
+        ["sh", "-c", remote_script.script_command(str(script), 0.2)], timeout=5
+    )
+    assert result.returncode == remote_script.TIMEOUT_STATUS
@@ -0,0 +1,79 @@
+from server_data import expand_hosts, parse_group_tag, parse_range
+
+
+def test_parse_range():
+    assert parse_range("1-3") == [(1, 3, 1)]
+    assert parse_range("01,07-09") == [(1, 1, 2), (7, 9, 2)]
+    assert parse_range("5") == [(5, 5, 1)]
+    assert parse_range("3-1") is None
+    assert parse_range("a-b") is None
+    assert parse_range("") is None
+    assert parse_range("1,") is None
+
+
+def test_expand_hosts_pads_to_start_width():
+    count, hosts = expand_hosts("node[08-11]")
+    assert count == 4
+    assert list(hosts) == ["node08", "node09", "node10", "node11"]
+
+
+def test_expand_hosts_multiple_ranges():
+    count, hosts = expand_hosts("rack[1-2]-node[01,05]")
+    assert count == 4
+    assert list(hosts) == [
+        "rack1-node01",
+        "rack1-node05",
+        "rack2-node01",
+        "rack2-node05",
+    ]
+
+
+def test_expand_hosts_without_range():
+    count, hosts = expand_hosts("single.example.com")
+    assert count == 1
+    assert list(hosts) == ["single.example.com"]
+
+
+def test_expand_hosts_is_lazy():
+    count, hosts = expand_hosts("node[0000001-9999999]")
+    assert count == 9999999
+    assert next(hosts) == "node0000001"
+
+
+def test_expand_hosts_rejects_malformed():
+    assert expand_hosts("node[1-") is None
+    assert expand_hosts("node]1[") is None
+    assert expand_hosts("node[2-1]") is None
+
+
+def test_parse_group_tag_shares_options():
+    count, servers = parse_group_tag(
+        "web", {"hosts": ["web[1-2]", "db"], "username": "deploy", "password": "pw"}
+    )
+    assert count == 3
+    servers = list(servers)
+    assert [s.name for s in servers] == ["web1", "web2", "db"]
+    assert [s.hostname for s in servers] == ["web1", "web2", "db"]
+    assert all(s.username == "deploy" and s.port == 22 for s in servers)
+    # Options of a group are shared, not copied per host
+    assert servers[0].username is servers[1].username
+
+
+def test_parse_group_tag_ignores_hostname():
+    count, servers = parse_group_tag(
+        "web", {"hosts": "web[1-2]", "hostname": "other", "password": "pw"}
+    )
+    assert [s.hostname for s in servers] == ["web1", "web2"]
+
+
+def test_parse_group_tag_rejects_bad_hosts():
+    assert parse_group_tag("web", {"hosts": 5, "password": "pw"}) is None
+    assert parse_group_tag("web", {"hosts": [], "password": "pw"}) is None
+    assert parse_group_tag("web", {"hosts": "web[x]", "password": "pw"}) is None
+
+
+def test_invalid_group_stops_after_first_host():
+    # Without a password or identity every host fails the same way
+    count, servers = parse_group_tag("web", {"hosts": "web[1-1000]"})
+    assert count == 1000
+    assert list(servers) == []
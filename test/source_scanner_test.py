@@ -0,0 +1,59 @@
+import os
+from source_scanner import SourceFilter, SourceScanner, glob_base
+
+
+def make_tree(root, paths: list[str]):
+    for path in paths:
+        target = root / path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_text(path)
+
+
+def test_exclude_component_and_path_patterns():
+    source_filter = SourceFilter(exclude=("*.tmp", "build/cache"))
+    assert source_filter.excluded("a.tmp")
+    assert source_filter.excluded(os.path.join("src", "b.tmp"))
+    assert source_filter.excluded(os.path.join("build", "cache"))
+    assert not source_filter.excluded(os.path.join("src", "build", "cache"))
+    assert not source_filter.excluded(os.path.join("src", "main.py"))
+
+
+def test_include_narrows_files_only():
+    assert SourceFilter().included("anything")
+    source_filter = SourceFilter(include=("*.py", "docs/*.md"))
+    assert source_filter.included(os.path.join("src", "main.py"))
+    assert source_filter.included(os.path.join("docs", "index.md"))
+    assert not source_filter.included(os.path.join("src", "index.md"))
+
+
+def test_glob_base():
+    assert glob_base("/data/**/*.log") == "/data"
+    assert glob_base("/data/x/file") == "/data/x"
+    assert glob_base("/*") == "/"
+    assert glob_base("*.txt") == os.path.abspath(".")
+
+
+def test_glob_filters_relative_to_base(tmp_path):
+    # A component of the absolute path above the pattern must not match
+    root = tmp_path / "tmp"
+    make_tree(root, ["keep.log", "sub/keep.log", "build/cache/drop.log"])
+    scanner = SourceScanner()
+    source_filter = SourceFilter(exclude=("tmp", "build/cache/*"))
+    matches = sorted(scanner.iglob(str(root / "**" / "*.log"), source_filter))
+    assert matches == [str(root / "keep.log"), str(root / "sub" / "keep.log")]
+
+    source_filter = SourceFilter(include=("sub/*.log",))
+    matches = list(scanner.iglob(str(root / "**" / "*.log"), source_filter))
+    assert matches == [str(root / "sub" / "keep.log")]
+
+
+def test_walk_applies_filter(tmp_path):
+    make_tree(tmp_path, ["a.py", "a.tmp", "pkg/b.py", "pkg/__pycache__/b.pyc"])
+    scanner = SourceScanner()
+    source_filter = SourceFilter(include=("*.py",), exclude=("__pycache__",))
+    files = [
+        os.path.relpath(entry.path, tmp_path)
+        for directory in scanner.walk(str(tmp_path), source_filter)
+        for entry in directory.files
+    ]
+    assert files == ["a.py", os.path.join("pkg", "b.py")]
@@ -0,0 +1,69 @@
+import compression
+import io
+import remote_exec
+import subprocess
+import tar_stream
+import tarfile
+from remote_exec import CommandResult
+
+
+def extract(data: bytes) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        ["sh", "-c", tar_stream.extract_command(compression.parse_compression("gzip"))],
+        input=data,
+        capture_output=True,
+    )
+
+
+def archive(tmp_path) -> bytes:
+    (tmp_path / "file").write_text("contents")
+    output = io.BytesIO()
+    with tarfile.open(fileobj=output, mode="w") as tar:
+        tar.add(tmp_path / "file", arcname=str(tmp_path / "out").lstrip("/"))
+    return output.getvalue()
+
+
+def test_compressed_extract(tmp_path):
+    import gzip
+
+    assert extract(gzip.compress(archive(tmp_path))).returncode == 0
+    assert (tmp_path / "out").read_text() == "contents"
+
+
+def test_decompressor_failure_is_reported(tmp_path, monkeypatch):
+    # tar gets a whole archive, only the decompressor fails
+    monkeypatch.setattr(
+        tar_stream, "decompress_command", lambda compress: "sh -c 'cat; exit 3'"
+    )
+    assert extract(archive(tmp_path)).returncode == 3
+
+
+class RecordingChannel:
+    def __init__(self) -> None:
+        self.data: bytearray = bytearray()
+
+    def sendall(self, data: bytes):
+        self.data.extend(data)
+
+
+class FakeConnection:
+    pwd: str = "/home/user"
+
+
+def test_relative_destination_goes_below_login_directory(tmp_path, monkeypatch):
+    channel = RecordingChannel()
+    monkeypatch.setattr(
+        remote_exec, "open_command", lambda ssh, command, timeout=None: channel
+    )
+    monkeypatch.setattr(
+        remote_exec,
+        "finish_command",
+        lambda channel, timeout=None: CommandResult(0, b"", b""),
+    )
+    (tmp_path / "file").write_text("contents")
+    stream = tar_stream.TarStream(FakeConnection())
+    stream.add(str(tmp_path / "file"), "relative/file")
+    stream.add(str(tmp_path / "file"), "/absolute/file")
+    stream.close()
+    with tarfile.open(fileobj=io.BytesIO(bytes(channel.data))) as tar:
+        assert tar.getnames() == ["home/user/relative/file", "absolute/file"]